@@ -0,0 +1,523 @@
+"""
+ann_index.py — Типы FAISS-индексов и оценка их качества относительно точного поиска.
+
+Типы (--index-type в build_index.py):
+  auto      — как раньше: Flat до 100k векторов, иначе IVF-Flat
+  flat      — IndexFlatIP, точный поиск
+  hnsw      — IndexHNSWFlat (граф; параметры M, efConstruction, efSearch)
+  ivf-flat  — IndexIVFFlat (nlist кластеров, nprobe при поиске)
+  ivf-pq    — IndexIVFPQ (product quantization, pq_m байт на вектор)
+  ivf-sq8   — IndexIVFScalarQuantizer, 8 бит на компоненту
+  sq8       — IndexScalarQuantizer, 8 бит на компоненту (в 4 раза меньше Flat)
+  fp16      — IndexScalarQuantizer, float16 (в 2 раза меньше Flat)
+  binary    — IndexBinaryFlat по знакам компонент, 1 бит (в 32 раза меньше),
+              поиск по расстоянию Хэмминга
+
+Все индексы — по inner product (векторы L2-нормированы, т.е. cosine).
+Параметры поиска (nprobe, efSearch) сохраняются внутри файла индекса.
+
+Сжатые типы (sq8, fp16, binary) ищут с пересчётом: сжатые коды отбирают
+shortlist из k * factor кандидатов, итоговые оценки считаются точно по
+исходным float32-векторам (vectors.npy рядом с индексом, читается через mmap
+— в памяти остаются только сжатые коды и страницы отобранных строк).
+Параметры пересчёта — protocols.rescore.json рядом с protocols.faiss.
+
+Оценка: запросы — случайная выборка векторов самого корпуса. Собственный
+вектор запроса исключается и из точного, и из приближённого ответа, поэтому
+выборка работает как отложенная (held-out). Считаются recall@k, латентность
+одиночного запроса p50/p99 и размер индекса на диске.
+
+Поиск по подмножеству (search_subset, фильтр по ICD): маленькие множества
+просматриваются точно (векторы только этих id), большие — поиском FAISS с
+IDSelector; если селектор нашёл меньше k (IVF/HNSW могут не дойти до нужных
+id), досчитывается точный просмотр. Результат всегда полный: min(k, |ids|).
+
+Загрузка (read_index): файл индекса отображается в память только для чтения,
+векторы живут в page cache и разделяются между процессами (uvicorn workers)
+вместо копии в куче каждого процесса.
+"""
+
+import json
+import os
+import threading
+import time
+from pathlib import Path
+from typing import Iterable, Optional
+
+import numpy as np
+
+INDEX_TYPES = ("auto", "flat", "hnsw", "ivf-flat", "ivf-pq", "ivf-sq8", "sq8", "fp16", "binary")
+COMPRESSED_TYPES = ("sq8", "fp16", "binary")   # ищут с точным пересчётом по vectors.npy
+FLAT_LIMIT = 100_000   # до этого размера "auto" строит точный индекс
+RESCORE_VECTORS_FILE = "vectors.npy"
+
+DEFAULT_HNSW_M = 32
+DEFAULT_EF_CONSTRUCTION = 200
+DEFAULT_EF_SEARCH = 64
+DEFAULT_NPROBE = 32
+DEFAULT_EVAL_QUERIES = 1000
+DEFAULT_EVAL_K = 10
+DEFAULT_RESCORE_FACTOR = 4    # sq8 / fp16: порядок почти не меняется
+BINARY_RESCORE_FACTOR = 32    # binary: знаки дают грубую оценку, shortlist шире
+SUBSCAN_MAX_IDS = 32_768      # до этого размера подмножество просматривается точно
+SUBSCAN_BLOCK = 65_536        # строк векторов за один шаг точного просмотра
+
+_POPCOUNT = np.unpackbits(np.arange(256, dtype=np.uint8)[:, None], axis=1).sum(axis=1).astype(np.uint16)
+
+
+def default_nlist(n: int) -> int:
+    return max(1, min(int(np.sqrt(n)), 4096))
+
+
+def default_pq_m(dim: int) -> int:
+    """Наибольший делитель dim не больше 64 (IndexIVFPQ требует dim % m == 0)."""
+    return max(m for m in range(1, min(dim, 64) + 1) if dim % m == 0)
+
+
+def create_index(
+    dim: int,
+    n: int,
+    index_type: str = "auto",
+    *,
+    hnsw_m: int = DEFAULT_HNSW_M,
+    ef_construction: int = DEFAULT_EF_CONSTRUCTION,
+    ef_search: int = DEFAULT_EF_SEARCH,
+    nlist: Optional[int] = None,
+    nprobe: int = DEFAULT_NPROBE,
+    pq_m: Optional[int] = None,
+):
+    """Создаёт (возможно, ещё не обученный) индекс под коллекцию из n векторов."""
+    import faiss
+
+    if index_type not in INDEX_TYPES:
+        raise ValueError(f"Неизвестный тип индекса: {index_type} (доступны: {', '.join(INDEX_TYPES)})")
+    if index_type == "auto":
+        index_type = "flat" if n <= FLAT_LIMIT else "ivf-flat"
+
+    if index_type == "flat":
+        return faiss.IndexFlatIP(dim)
+
+    if index_type in ("sq8", "fp16"):
+        qtype = faiss.ScalarQuantizer.QT_8bit if index_type == "sq8" else faiss.ScalarQuantizer.QT_fp16
+        return faiss.IndexScalarQuantizer(dim, qtype, faiss.METRIC_INNER_PRODUCT)
+
+    if index_type == "binary":
+        return BinaryCodes(dim)
+
+    if index_type == "hnsw":
+        index = faiss.IndexHNSWFlat(dim, hnsw_m, faiss.METRIC_INNER_PRODUCT)
+        index.hnsw.efConstruction = ef_construction
+        index.hnsw.efSearch = ef_search
+        return index
+
+    nlist = nlist or default_nlist(n)
+    quantizer = faiss.IndexFlatIP(dim)
+    if index_type == "ivf-flat":
+        index = faiss.IndexIVFFlat(quantizer, dim, nlist, faiss.METRIC_INNER_PRODUCT)
+    elif index_type == "ivf-pq":
+        pq_m = pq_m or default_pq_m(dim)
+        if dim % pq_m:
+            raise ValueError(f"--pq-m должен делить размерность {dim}, получено: {pq_m}")
+        index = faiss.IndexIVFPQ(quantizer, dim, nlist, pq_m, 8, faiss.METRIC_INNER_PRODUCT)
+    else:  # ivf-sq8
+        index = faiss.IndexIVFScalarQuantizer(
+            quantizer, dim, nlist, faiss.ScalarQuantizer.QT_8bit, faiss.METRIC_INNER_PRODUCT
+        )
+    index.nprobe = min(nprobe, nlist)
+    return index
+
+
+# ─── Сжатые векторы ─────────────────────────────────────────────────────────
+
+class BinaryCodes:
+    """
+    1 бит на компоненту (знак), IndexBinaryFlat. Интерфейс как у float-индекса:
+    add/search принимают float32, оценка — 1 - 2 * hamming / dim (≈ cosine
+    для случайных гиперплоскостей), поэтому годится только для shortlist.
+    """
+
+    is_trained = True
+
+    def __init__(self, dim: int, index=None):
+        import faiss
+
+        self.dim = dim
+        self.index = index if index is not None else faiss.IndexBinaryFlat((dim + 7) // 8 * 8)
+
+    @property
+    def ntotal(self) -> int:
+        return self.index.ntotal
+
+    @property
+    def d(self) -> int:
+        return self.dim
+
+    def encode(self, x: np.ndarray) -> np.ndarray:
+        bits = np.asarray(x) > 0
+        pad = self.index.d - bits.shape[1]
+        if pad:
+            bits = np.pad(bits, ((0, 0), (0, pad)))
+        return np.packbits(bits, axis=1)
+
+    def train(self, x: np.ndarray) -> None:
+        pass
+
+    def add(self, x: np.ndarray) -> None:
+        self.index.add(self.encode(x))
+
+    def search(self, q: np.ndarray, k: int):
+        dist, ids = self.index.search(self.encode(q), k)
+        return (1.0 - 2.0 * dist / self.dim).astype("float32"), ids
+
+    def codes(self) -> np.ndarray:
+        """uint8[ntotal, code_size] — коды индекса без копирования."""
+        import faiss
+
+        n, size = self.index.ntotal, self.index.code_size
+        return faiss.rev_swig_ptr(self.index.xb.data(), n * size).reshape(n, size)
+
+    def scores(self, q: np.ndarray, ids: np.ndarray) -> np.ndarray:
+        """Оценки search() для строк ids: float32[len(q), len(ids)]."""
+        diff = np.bitwise_xor(self.encode(q)[:, None, :], self.codes()[ids][None, :, :])
+        hamming = _POPCOUNT[diff].sum(axis=2)
+        return (1.0 - 2.0 * hamming / self.dim).astype("float32")
+
+
+class RescoredIndex:
+    """
+    Сжатый индекс (sq8/fp16/binary) + точный пересчёт: base отбирает k * factor
+    кандидатов, оценки — скалярные произведения с float32-векторами (np.memmap).
+    """
+
+    def __init__(self, base, vectors: np.ndarray, factor: Optional[int] = None):
+        self.base = base
+        self.vectors = vectors
+        if factor is None:
+            factor = BINARY_RESCORE_FACTOR if isinstance(base, BinaryCodes) else DEFAULT_RESCORE_FACTOR
+        self.factor = max(1, int(factor))
+
+    @property
+    def ntotal(self) -> int:
+        return self.base.ntotal
+
+    @property
+    def d(self) -> int:
+        return self.vectors.shape[1]
+
+    @property
+    def is_trained(self) -> bool:
+        return self.base.is_trained
+
+    def search(self, q: np.ndarray, k: int):
+        q = np.ascontiguousarray(q, dtype="float32")
+        _, cand = self.base.search(q, min(k * self.factor, max(self.ntotal, 1)))
+        scores = np.full((len(q), k), -np.inf, dtype="float32")
+        ids = np.full((len(q), k), -1, dtype="int64")
+        for i, row in enumerate(cand):
+            row = np.sort(row[row >= 0])   # по возрастанию — последовательнее по файлу
+            if not len(row):
+                continue
+            exact = np.asarray(self.vectors[row], dtype="float32") @ q[i]
+            top = np.argsort(-exact)[:k]
+            scores[i, :len(top)] = exact[top]
+            ids[i, :len(top)] = row[top]
+        return scores, ids
+
+
+def with_rescoring(
+    index,
+    vectors_path: str | os.PathLike,
+    blocks: Iterable[np.ndarray],
+    n: int,
+    dim: int,
+    factor: Optional[int] = None,
+) -> RescoredIndex:
+    """Пишет исходные векторы (blocks — по порядку id) в vectors_path и оборачивает index."""
+    vectors_path = Path(vectors_path)
+    tmp = vectors_path.with_name(vectors_path.name + ".tmp")
+    out = np.lib.format.open_memmap(tmp, mode="w+", dtype="float32", shape=(n, dim))
+    offset = 0
+    for block in blocks:
+        out[offset:offset + len(block)] = block
+        offset += len(block)
+    out.flush()
+    del out
+    os.replace(tmp, vectors_path)
+    return RescoredIndex(index, np.load(vectors_path, mmap_mode="r"), factor)
+
+
+# ─── Поиск по подмножеству id ───────────────────────────────────────────────
+
+_direct_map_lock = threading.Lock()
+
+
+def subset_vectors(index, ids: np.ndarray) -> Optional[np.ndarray]:
+    """float32-векторы строк ids (по возрастанию) или None, если индекс их не отдаёт."""
+    if isinstance(index, RescoredIndex):
+        return np.asarray(index.vectors[ids], dtype="float32")
+    if isinstance(index, BinaryCodes):
+        return None
+    if hasattr(index, "nlist"):
+        # IVF восстанавливает векторы только с direct map (n * 8 байт, строится один раз)
+        with _direct_map_lock:
+            if index.direct_map.type == 0:   # DirectMap::NoMap
+                try:
+                    index.make_direct_map()
+                except RuntimeError:
+                    return None
+    try:
+        return index.reconstruct_batch(ids)
+    except RuntimeError:
+        return None
+
+
+def _subscan(index, q: np.ndarray, ids: np.ndarray, k: int):
+    """
+    Точный top-k по строкам ids, блоками по SUBSCAN_BLOCK; None — векторы недоступны.
+    BinaryCodes без векторов для пересчёта просматривается по расстоянию Хэмминга.
+    """
+    best_scores = np.full((len(q), k), -np.inf, dtype="float32")
+    best_ids = np.full((len(q), k), -1, dtype="int64")
+    for start in range(0, len(ids), SUBSCAN_BLOCK):
+        block = ids[start:start + SUBSCAN_BLOCK]
+        if isinstance(index, BinaryCodes):
+            block_scores = index.scores(q, block)
+        else:
+            vectors = subset_vectors(index, block)
+            if vectors is None:
+                return None
+            block_scores = q @ vectors.T
+        all_scores = np.concatenate([best_scores, block_scores], axis=1)
+        all_ids = np.concatenate([best_ids, np.broadcast_to(block, (len(q), len(block)))], axis=1)
+        top = np.argpartition(-all_scores, k - 1, axis=1)[:, :k]
+        best_scores = np.take_along_axis(all_scores, top, axis=1)
+        best_ids = np.take_along_axis(all_ids, top, axis=1)
+    order = np.argsort(-best_scores, axis=1)
+    return np.take_along_axis(best_scores, order, axis=1), np.take_along_axis(best_ids, order, axis=1)
+
+
+def _selector_params(index, selector):
+    """Параметры поиска с селектором; nprobe / efSearch индекса сохраняются."""
+    import faiss
+
+    if hasattr(index, "nlist"):
+        return faiss.SearchParametersIVF(sel=selector, nprobe=index.nprobe)
+    if hasattr(index, "hnsw"):
+        return faiss.SearchParametersHNSW(sel=selector, efSearch=index.hnsw.efSearch)
+    return faiss.SearchParameters(sel=selector)
+
+
+def search_subset(index, q: np.ndarray, k: int, ids: np.ndarray):
+    """
+    Как index.search(q, k), но только среди строк ids (отсортированы, без повторов).
+    Каждая строка результата содержит min(k, len(ids)) найденных id, остальное — -1.
+    """
+    import faiss
+
+    q = np.ascontiguousarray(q, dtype="float32")
+    ids = np.asarray(ids, dtype="int64")
+    empty = np.full((len(q), k), -np.inf, dtype="float32"), np.full((len(q), k), -1, dtype="int64")
+    if not len(ids) or not len(q) or k <= 0:
+        return empty
+    if len(ids) <= SUBSCAN_MAX_IDS or isinstance(index, (RescoredIndex, BinaryCodes)):
+        found = _subscan(index, q, ids, k)
+        if found is not None:
+            return found
+
+    selector = faiss.IDSelectorBatch(ids)
+    scores, found_ids = index.search(q, k, params=_selector_params(index, selector))
+    need = min(k, len(ids))
+    if int((found_ids >= 0).sum(axis=1).min()) < need:
+        exact = _subscan(index, q, ids, k)
+        if exact is not None:
+            return exact
+    return scores, found_ids
+
+
+def _rescore_config_path(path: str | os.PathLike) -> Path:
+    path = Path(path)
+    return path.with_name(path.stem + ".rescore.json")
+
+
+def write_index(index, path: str | os.PathLike) -> None:
+    """faiss.write_index для всех типов; для сжатых — ещё и параметры пересчёта."""
+    import faiss
+
+    path = Path(path)
+    base = index.base if isinstance(index, RescoredIndex) else index
+    if isinstance(base, BinaryCodes):
+        faiss.write_index_binary(base.index, str(path))
+    else:
+        faiss.write_index(base, str(path))
+
+    config_path = _rescore_config_path(path)
+    if isinstance(index, RescoredIndex):
+        with open(config_path, "w", encoding="utf-8") as f:
+            json.dump({"vectors": RESCORE_VECTORS_FILE, "factor": index.factor}, f)
+    else:
+        # Остатки предыдущей сборки сжатого индекса в той же директории
+        config_path.unlink(missing_ok=True)
+        (path.parent / RESCORE_VECTORS_FILE).unlink(missing_ok=True)
+
+
+def describe_index(index) -> str:
+    """Короткое описание для логов: тип и параметры поиска."""
+    if isinstance(index, RescoredIndex):
+        return f"{describe_index(index.base)} + точный пересчёт (shortlist ×{index.factor})"
+    if isinstance(index, BinaryCodes):
+        return f"IndexBinaryFlat ({index.index.d} бит)"
+    name = type(index).__name__
+    if hasattr(index, "hnsw"):
+        return f"{name} (M={index.hnsw.nb_neighbors(0) // 2}, efSearch={index.hnsw.efSearch})"
+    if hasattr(index, "nlist"):
+        return f"{name} (nlist={index.nlist}, nprobe={index.nprobe})"
+    if hasattr(index, "sq"):
+        return f"{name} ({'fp16' if index.sq.qtype == _qt_fp16() else 'int8'})"
+    return name
+
+
+def _qt_fp16() -> int:
+    import faiss
+
+    return faiss.ScalarQuantizer.QT_fp16
+
+
+# ─── Загрузка ───────────────────────────────────────────────────────────────
+
+def _mmap_flags(faiss) -> int:
+    # IO_FLAG_MMAP_IFC (FAISS >= 1.10) отображает коды любых индексов (Flat,
+    # HNSW, IVF); в старых версиях через mmap читаются только списки IVF.
+    flag = getattr(faiss, "IO_FLAG_MMAP_IFC", faiss.IO_FLAG_MMAP)
+    return flag | faiss.IO_FLAG_READ_ONLY
+
+
+def prefetch_file(path: str | os.PathLike, block: int = 1024 ** 2) -> None:
+    """Последовательно читает файл, чтобы его страницы оказались в page cache."""
+    buf = bytearray(block)
+    with open(path, "rb", buffering=0) as f:
+        while f.readinto(buf):
+            pass
+
+
+def read_index(path: str | os.PathLike, mmap: bool = True, prefetch: bool = False):
+    """
+    Загружает FAISS-индекс. mmap=True — только для чтения через mmap (холодный
+    старт не читает файл целиком, N процессов делят одну физическую копию).
+    prefetch=True — прогрев page cache в фоновом потоке.
+    Если mmap не поддерживается для этого индекса, читает обычным способом.
+    Сжатые индексы (protocols.rescore.json рядом) оборачиваются в RescoredIndex,
+    исходные векторы открываются через np.memmap.
+    """
+    import faiss
+
+    path = str(path)
+    config_path = _rescore_config_path(path)
+    rescore = None
+    if config_path.exists():
+        with open(config_path, encoding="utf-8") as f:
+            rescore = json.load(f)
+
+    with open(path, "rb") as f:
+        binary = f.read(2) == b"IB"   # fourcc бинарных индексов FAISS (IBxF, ...)
+
+    index = None
+    if binary:
+        codes = faiss.read_index_binary(path)
+        index = BinaryCodes(codes.d, codes)
+    elif mmap:
+        try:
+            index = faiss.read_index(path, _mmap_flags(faiss))
+        except RuntimeError as e:
+            print(f"  [!] mmap-загрузка недоступна ({e}); индекс читается в память")
+        if index is None:
+            index = faiss.read_index(path)
+        elif prefetch:
+            threading.Thread(target=prefetch_file, args=(path,), name="faiss-prefetch", daemon=True).start()
+    else:
+        index = faiss.read_index(path)
+
+    if rescore is not None:
+        vectors = np.load(config_path.parent / rescore["vectors"], mmap_mode="r")
+        if isinstance(index, BinaryCodes):
+            index.dim = vectors.shape[1]
+        index = RescoredIndex(index, vectors, rescore.get("factor"))
+    return index
+
+
+# ─── Оценка ─────────────────────────────────────────────────────────────────
+
+def exact_topk(
+    queries: np.ndarray,
+    query_ids: np.ndarray,
+    blocks: Iterable[np.ndarray],
+    k: int,
+) -> np.ndarray:
+    """
+    Точные top-k id по inner product, блоками (подходит для mmap-шардов).
+    Вектор с id самого запроса исключается.
+    """
+    nq = len(queries)
+    best_scores = np.full((nq, k), -np.inf, dtype="float32")
+    best_ids = np.full((nq, k), -1, dtype="int64")
+    rows = np.arange(nq)
+    offset = 0
+    for block in blocks:
+        block = np.asarray(block, dtype="float32")
+        scores = queries @ block.T
+        own = (query_ids >= offset) & (query_ids < offset + len(block))
+        scores[rows[own], query_ids[own] - offset] = -np.inf
+
+        ids = np.broadcast_to(np.arange(offset, offset + len(block)), scores.shape)
+        all_scores = np.concatenate([best_scores, scores], axis=1)
+        all_ids = np.concatenate([best_ids, ids], axis=1)
+        top = np.argpartition(-all_scores, k - 1, axis=1)[:, :k]
+        best_scores = np.take_along_axis(all_scores, top, axis=1)
+        best_ids = np.take_along_axis(all_ids, top, axis=1)
+        offset += len(block)
+    return best_ids
+
+
+def evaluate_index(
+    index,
+    queries: np.ndarray,
+    query_ids: np.ndarray,
+    ground_truth: np.ndarray,
+    k: int,
+    index_bytes: int,
+) -> dict:
+    """recall@k против точного поиска + латентность одиночного запроса."""
+    queries = np.ascontiguousarray(queries, dtype="float32")
+    _, found = index.search(queries, k + 1)
+
+    hits = 0
+    for qid, ann, exact in zip(query_ids, found, ground_truth):
+        ann = [i for i in ann if i != qid and i >= 0][:k]
+        hits += len(set(ann) & set(int(i) for i in exact if i >= 0))
+    recall = hits / (len(queries) * k) if len(queries) else 0.0
+
+    latencies = []
+    for i in range(len(queries)):
+        t0 = time.perf_counter()
+        index.search(queries[i:i + 1], k)
+        latencies.append((time.perf_counter() - t0) * 1000)
+
+    return {
+        "index": describe_index(index),
+        "ntotal": int(index.ntotal),
+        "queries": int(len(queries)),
+        "k": k,
+        f"recall@{k}": round(recall, 4),
+        "latency_p50_ms": round(float(np.percentile(latencies, 50)), 3) if latencies else 0.0,
+        "latency_p99_ms": round(float(np.percentile(latencies, 99)), 3) if latencies else 0.0,
+        "index_bytes": int(index_bytes),
+    }
+
+
+def format_report(report: dict) -> str:
+    k = report["k"]
+    return (
+        f"  {report['index']}: {report['ntotal']} векторов, {report['queries']} запросов\n"
+        f"  recall@{k}: {report[f'recall@{k}']:.4f}\n"
+        f"  латентность запроса: p50 {report['latency_p50_ms']:.3f} мс, p99 {report['latency_p99_ms']:.3f} мс\n"
+        f"  размер индекса: {report['index_bytes'] / 1024 ** 2:.1f} MB"
+    )
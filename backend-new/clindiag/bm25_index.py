@@ -0,0 +1,305 @@
+"""
+bm25_index.py — Разреженный BM25-индекс по текстам чанков (русский стемминг).
+
+Плотные эмбеддинги (MiniLM / rubert-tiny2) плохо ловят точные лексические
+якоря: названия препаратов, значения анализов, коды МКБ, набранные врачом.
+BM25 ищет их напрямую; RAGRetriever сливает обе выдачи через reciprocal rank
+fusion (rrf_fuse).
+
+Токены: коды МКБ (j18.9), числа (38.5; запятая → точка) и слова; слова
+стеммируются Snowball (русский для кириллицы, английский для латиницы),
+служебные слова отбрасываются.
+
+Веса BM25 (k1, b) считаются при сборке и хранятся готовыми для каждой пары
+(термин, чанк): запрос — это сумма весов из списков своих терминов, без
+пересчёта длин документов. Формат (<index_dir>/protocols.bm25/):
+  manifest.json  — версия, число чанков/терминов, k1, b, средняя длина, стеммер
+  vocab.json     — термины по порядку строк
+  offsets.i64    — int64[n_terms + 1], CSR-границы
+  chunks.i32     — int32[...], номера чанков (= id в FAISS) внутри термина
+  weights.f32    — float32[...], BM25-вес пары
+
+Бюджет: термины запроса обрабатываются от редких к частым (самые
+информативные — первыми); когда бюджет по времени исчерпан, оставшиеся
+частые термины пропускаются.
+
+Зависимость: snowballstemmer (PyStemmer, если установлен, ускоряет его).
+"""
+
+import json
+import os
+import re
+import shutil
+import tempfile
+import time
+from functools import lru_cache
+from pathlib import Path
+from typing import Iterable, Optional
+
+import numpy as np
+
+BM25_DIRNAME = "protocols.bm25"
+FORMAT_VERSION = 1
+DEFAULT_K1 = 1.2
+DEFAULT_B = 0.75
+RRF_K = 60   # константа reciprocal rank fusion (Cormack et al., 2009)
+
+_TOKEN = re.compile(r"[a-z]\d{2}(?:\.\d{1,2})?\b|[a-zа-я]+|\d+(?:[.,]\d+)?")
+_CYRILLIC = re.compile(r"[а-я]")
+STOP_WORDS = frozenset(
+    "и в во не что он на я с со как а то все она так его но да ты к у же вы за бы по только "
+    "ее мне было вот от меня еще нет о из ему теперь когда даже ну вдруг ли если уже или ни "
+    "быть был него до вас нибудь опять уж вам ведь там потом себя ничего ей может они тут где "
+    "есть надо ней для мы тебя их чем была сам чтоб без будто чего раз тоже себе под будет ж "
+    "тогда кто этот того потому этого какой совсем ним здесь этом один почти мой тем чтобы нее "
+    "были куда зачем всех никогда можно при наконец два об другой хоть после над больше тот "
+    "через эти нас про всего них какая много разве три эту моя впрочем хорошо свою этой перед "
+    "иногда лучше чуть том нельзя такой им более всегда конечно всю между "
+    "the of and to in is for on with by or at as an be are"
+    .split()
+)
+
+
+@lru_cache(maxsize=1)
+def _stemmers():
+    try:
+        import snowballstemmer
+    except ImportError as e:
+        raise ImportError("BM25 требует snowballstemmer: pip install snowballstemmer") from e
+    return snowballstemmer.stemmer("russian"), snowballstemmer.stemmer("english")
+
+
+@lru_cache(maxsize=200_000)
+def _stem(word: str) -> str:
+    russian, english = _stemmers()
+    return (russian if _CYRILLIC.search(word) else english).stemWord(word)
+
+
+def tokenize(text: str) -> list[str]:
+    """Нормализованные термины текста (с повторами, в порядке появления)."""
+    terms = []
+    for token in _TOKEN.findall(text.lower().replace("ё", "е")):
+        if token[0].isdigit():
+            terms.append(token.replace(",", "."))
+        elif token[0].isalpha() and len(token) > 1 and token not in STOP_WORDS:
+            terms.append(token if token[-1].isdigit() else _stem(token))
+    return terms
+
+
+class BM25Builder:
+    """
+    Потоковая сборка: add() батчами чанков в порядке id FAISS, затем save().
+    Списки каждого батча сразу сбрасываются на диск (шард во временной
+    директории внутри spill_dir, по умолч. системный tmp); в памяти остаются
+    только словарь и df терминов. save() раскладывает шарды по спискам
+    терминов прямо в файлы индекса, так что пиковая память — один батч.
+    """
+
+    def __init__(self, k1: float = DEFAULT_K1, b: float = DEFAULT_B, spill_dir: str | Path | None = None):
+        _stemmers()   # ImportError сразу, а не после парсинга корпуса
+        self.k1 = k1
+        self.b = b
+        self.n_chunks = 0
+        self.n_postings = 0
+        self._vocab: dict[str, int] = {}
+        self._df = np.zeros(0, dtype=np.int64)
+        self._total_len = 0
+        self._spill = Path(tempfile.mkdtemp(prefix="_bm25_", dir=spill_dir))
+        self._shards: list[tuple[Path, int]] = []   # (префикс файлов шарда, число пар)
+
+    def add(self, texts: Iterable[str]) -> None:
+        terms, chunks, tfs, lengths = [], [], [], []
+        for text in texts:
+            counts: dict[int, int] = {}
+            tokens = tokenize(text)
+            for token in tokens:
+                term = self._vocab.setdefault(token, len(self._vocab))
+                counts[term] = counts.get(term, 0) + 1
+            terms.extend(counts)
+            tfs.extend(counts.values())
+            chunks.extend([self.n_chunks] * len(counts))
+            lengths.append(len(tokens))
+            self.n_chunks += 1
+        terms = np.array(terms, dtype=np.int32)
+        chunks = np.array(chunks, dtype=np.int32)
+        order = np.lexsort((chunks, terms))
+        prefix = self._spill / f"{len(self._shards):06d}"
+        terms[order].tofile(prefix.with_suffix(".terms"))
+        chunks[order].tofile(prefix.with_suffix(".chunks"))
+        np.array(tfs, dtype=np.float32)[order].tofile(prefix.with_suffix(".tf"))
+        with open(self._spill / "lengths.i32", "ab") as f:
+            np.array(lengths, dtype=np.int32).tofile(f)
+        self._shards.append((prefix, len(terms)))
+        self.n_postings += len(terms)
+        self._total_len += sum(lengths)
+        df = np.bincount(terms, minlength=len(self._vocab))
+        df[:len(self._df)] += self._df
+        self._df = df
+
+    def save(self, out_dir: str | Path) -> Path:
+        """Считает веса, раскладывает шарды по терминам и атомарно публикует директорию."""
+        final_dir = Path(out_dir)
+        tmp_dir = final_dir.with_name(final_dir.name + ".tmp")
+        shutil.rmtree(tmp_dir, ignore_errors=True)
+        tmp_dir.mkdir(parents=True)
+        try:
+            avgdl = self._total_len / self.n_chunks if self.n_chunks else 0.0
+            df = np.zeros(len(self._vocab), dtype=np.int64)
+            df[:len(self._df)] = self._df
+            idf = np.log(1.0 + (self.n_chunks - df + 0.5) / (df + 0.5))
+            offsets = np.zeros(len(self._vocab) + 1, dtype="<i8")
+            offsets[1:] = np.cumsum(df)
+            offsets.tofile(tmp_dir / "offsets.i64")
+            self._merge_shards(tmp_dir, offsets, idf, avgdl)
+            with open(tmp_dir / "vocab.json", "w", encoding="utf-8") as f:
+                json.dump(list(self._vocab), f, ensure_ascii=False)
+            with open(tmp_dir / "manifest.json", "w", encoding="utf-8") as f:
+                json.dump(
+                    {
+                        "version": FORMAT_VERSION,
+                        "n_chunks": self.n_chunks,
+                        "n_terms": len(self._vocab),
+                        "n_postings": self.n_postings,
+                        "k1": self.k1,
+                        "b": self.b,
+                        "avgdl": avgdl,
+                        "stemmer": "snowball-russian",
+                    },
+                    f,
+                )
+        finally:
+            shutil.rmtree(self._spill, ignore_errors=True)
+        shutil.rmtree(final_dir, ignore_errors=True)
+        os.replace(tmp_dir, final_dir)
+        return final_dir
+
+    def _merge_shards(self, out: Path, offsets: np.ndarray, idf: np.ndarray, avgdl: float) -> None:
+        """
+        Шарды идут по возрастанию id чанков и отсортированы по (термин, чанк) внутри,
+        поэтому пары шарда встают в список термина сразу за парами предыдущих шардов.
+        """
+        for name in ("chunks.i32", "weights.f32"):
+            with open(out / name, "wb") as f:
+                f.truncate(self.n_postings * 4)
+        if not self.n_postings:
+            return
+        out_chunks = np.memmap(out / "chunks.i32", dtype="<i4", mode="r+")
+        out_weights = np.memmap(out / "weights.f32", dtype="<f4", mode="r+")
+        lengths = np.memmap(self._spill / "lengths.i32", dtype=np.int32, mode="r")
+        cursor = offsets[:-1].copy()
+        for prefix, n in self._shards:
+            if not n:
+                continue
+            terms = np.fromfile(prefix.with_suffix(".terms"), dtype=np.int32)
+            chunks = np.fromfile(prefix.with_suffix(".chunks"), dtype=np.int32)
+            tf = np.fromfile(prefix.with_suffix(".tf"), dtype=np.float32)
+            norm = self.k1 * (1.0 - self.b + self.b * lengths[chunks] / max(avgdl, 1e-9))
+            uniq, first, counts = np.unique(terms, return_index=True, return_counts=True)
+            pos = cursor[terms] + (np.arange(n) - np.repeat(first, counts))
+            out_chunks[pos] = chunks
+            out_weights[pos] = idf[terms] * tf * (self.k1 + 1.0) / (tf + norm)
+            cursor[uniq] += counts
+        out_chunks.flush()
+        out_weights.flush()
+        del out_chunks, out_weights, lengths
+
+
+def build_bm25(texts: Iterable[str], out_dir: str | Path, k1: float = DEFAULT_K1, b: float = DEFAULT_B) -> Path:
+    builder = BM25Builder(k1, b)
+    builder.add(texts)
+    return builder.save(out_dir)
+
+
+def _column(path: Path, dtype: str) -> np.ndarray:
+    if path.stat().st_size == 0:
+        return np.zeros(0, dtype=dtype)
+    return np.memmap(path, dtype=dtype, mode="r")
+
+
+class BM25Index:
+    """Чтение: списки через mmap, словарь терминов — в памяти."""
+
+    def __init__(self, index_dir: str | Path):
+        self.dir = Path(index_dir)
+        with open(self.dir / "manifest.json", encoding="utf-8") as f:
+            self.manifest = json.load(f)
+        if self.manifest.get("version") != FORMAT_VERSION:
+            raise ValueError(f"Неподдерживаемая версия BM25-индекса: {self.manifest.get('version')}")
+        _stemmers()
+        with open(self.dir / "vocab.json", encoding="utf-8") as f:
+            self._terms = {term: i for i, term in enumerate(json.load(f))}
+        self._offsets = np.fromfile(self.dir / "offsets.i64", dtype="<i8")
+        self._chunks = _column(self.dir / "chunks.i32", "<i4")
+        self._weights = _column(self.dir / "weights.f32", "<f4")
+        self.n_chunks: int = self.manifest["n_chunks"]
+
+    def __len__(self) -> int:
+        return self.n_chunks
+
+    def search(
+        self,
+        query: str,
+        k: int,
+        allowed: Optional[np.ndarray] = None,
+        budget_ms: Optional[float] = None,
+    ) -> tuple[np.ndarray, np.ndarray]:
+        """
+        (оценки, id) top-k чанков по убыванию BM25; может вернуть меньше k.
+        allowed — отсортированные id, среди которых искать (фильтр по ICD).
+        """
+        t0 = time.perf_counter()
+        rows = {self._terms[t] for t in tokenize(query) if t in self._terms}
+        # от редких терминов к частым: при нехватке бюджета теряются наименее информативные
+        rows = sorted(rows, key=lambda r: self._offsets[r + 1] - self._offsets[r])
+        ids, weights = [], []
+        for row in rows:
+            if budget_ms is not None and ids and (time.perf_counter() - t0) * 1000 >= budget_ms:
+                break
+            lo, hi = self._offsets[row], self._offsets[row + 1]
+            ids.append(self._chunks[lo:hi])
+            weights.append(self._weights[lo:hi])
+        if not ids:
+            return np.zeros(0, dtype="float32"), np.zeros(0, dtype="int64")
+
+        ids = np.concatenate(ids).astype(np.int64)
+        weights = np.concatenate(weights)
+        if allowed is not None:
+            pos = np.searchsorted(allowed, ids)
+            keep = pos < len(allowed)
+            keep[keep] = allowed[pos[keep]] == ids[keep]
+            ids, weights = ids[keep], weights[keep]
+        uniq, inverse = np.unique(ids, return_inverse=True)
+        scores = np.bincount(inverse, weights=weights, minlength=len(uniq)).astype("float32")
+        if len(uniq) > k:
+            # равные оценки на границе top-k — меньшие id, как и в итоговой сортировке
+            kth = np.partition(scores, len(scores) - k)[len(scores) - k]
+            above = scores > kth
+            ties = np.flatnonzero(scores == kth)[: k - int(above.sum())]
+            top = np.concatenate([np.flatnonzero(above), ties])
+            uniq, scores = uniq[top], scores[top]
+        order = np.lexsort((uniq, -scores))
+        return scores[order], uniq[order]
+
+
+def rrf_fuse(rankings: list[np.ndarray], k: int, rrf_k: int = RRF_K) -> tuple[np.ndarray, np.ndarray]:
+    """
+    Reciprocal rank fusion: sum(1 / (rrf_k + rank)) по спискам id (-1 пропускаются).
+    Оценка нормирована на максимум (первое место во всех списках = 1.0).
+    Возвращает (оценки, id) top-k; при равенстве выше id из более раннего списка.
+    """
+    ids = np.concatenate([np.asarray(r, dtype=np.int64) for r in rankings]) if rankings else np.zeros(0, np.int64)
+    ranks = np.concatenate([np.arange(1, len(r) + 1) for r in rankings]) if rankings else np.zeros(0)
+    valid = ids >= 0
+    ids, ranks = ids[valid], ranks[valid]
+    if not len(ids):
+        return np.zeros(0, dtype="float32"), np.zeros(0, dtype="int64")
+    uniq, first, inverse = np.unique(ids, return_index=True, return_inverse=True)
+    fused = np.bincount(inverse, weights=1.0 / (rrf_k + ranks), minlength=len(uniq))
+    fused *= (rrf_k + 1) / len(rankings)
+    order = np.lexsort((first, -fused))[:k]
+    return fused[order].astype("float32"), uniq[order]
+
+
+def bm25_exists(index_dir: str | Path) -> bool:
+    return (Path(index_dir) / BM25_DIRNAME / "manifest.json").exists()
+
@@ -9,26 +9,64 @@ build_index.py — Парсинг клинических протоколов Р
 Запуск:
   python build_index.py --source corpus.zip
   python build_index.py --source ./protocols_dir
-  python build_index.py --source corpus.zip --chunk-size 512 --overlap 64
+  python build_index.py --source corpus.zip --chunk-tokens 128 --overlap-tokens 16
+  python build_index.py --source corpus.zip --chunker chars --chunk-size 512 --overlap 64
+  python build_index.py --source corpus.zip --streaming   # out-of-core сборка для больших корпусов
+  python build_index.py --source corpus.zip --index-type hnsw   # тип индекса, см. ann_index.py
+  python build_index.py --source corpus.zip --index-type binary # 1 бит/компоненту + точный пересчёт
+  python build_index.py --source corpus.zip --profile      # время/CPU/RSS по стадиям → JSON
 """
 
 import argparse
+import hashlib
+import io
 import json
 import os
-import pickle
 import re
+import shutil
 import zipfile
 from pathlib import Path
-from typing import Optional
+from typing import Iterable, Iterator, Optional
 
 import numpy as np
 from tqdm import tqdm
 
+from ann_index import (
+    BINARY_RESCORE_FACTOR,
+    COMPRESSED_TYPES,
+    DEFAULT_EF_CONSTRUCTION,
+    DEFAULT_EF_SEARCH,
+    DEFAULT_EVAL_K,
+    DEFAULT_EVAL_QUERIES,
+    DEFAULT_HNSW_M,
+    DEFAULT_NPROBE,
+    DEFAULT_RESCORE_FACTOR,
+    INDEX_TYPES,
+    RESCORE_VECTORS_FILE,
+    RescoredIndex,
+    create_index,
+    describe_index,
+    evaluate_index,
+    exact_topk,
+    format_report,
+    with_rescoring,
+    write_index,
+)
+from bm25_index import BM25_DIRNAME, BM25Builder
+from build_profile import NULL_PROFILER, BuildProfiler
+from chunk_store import STORE_DIRNAME, ChunkStoreWriter, write_chunk_store
+from embedding_cache import DEFAULT_CACHE_PATH, EmbeddingCache
+from near_dup import DEFAULT_THRESHOLD as DEFAULT_DEDUP_THRESHOLD, NearDupIndex
+from token_chunker import DEFAULT_OVERLAP_TOKENS, TokenChunker
+
 # ─── Константы по умолчанию ─────────────────────────────────────────────────
 DEFAULT_MODEL = "sentence-transformers/paraphrase-multilingual-MiniLM-L12-v2"
 DEFAULT_INDEX_DIR = "./index"
-DEFAULT_CHUNK_SIZE = 512   # символов
-DEFAULT_OVERLAP = 64       # символов
+DEFAULT_CHUNK_SIZE = 512   # символов (--chunker chars)
+DEFAULT_OVERLAP = 64       # символов (--chunker chars)
+DEFAULT_PARSE_CACHE = "./.parse_cache"  # кэш извлечённого из PDF/DOCX текста
+DEFAULT_STREAM_BATCH = 20_000   # чанков на один шард эмбеддингов (--streaming)
+DEFAULT_TRAIN_SAMPLE = 100_000  # векторов для обучения IVF (--streaming)
 
 
 # ════════════════════════════════════════════════════════════════════════════
@@ -63,14 +101,14 @@ def _record_from_dict(data: dict, fallback_name: str) -> dict | None:
     }
 
 
-def parse_json_corpus(zip_path: str) -> list[dict]:
+def iter_json_corpus(zip_path: str) -> Iterator[dict]:
     """
-    Читает corpus.zip.
+    Потоково читает corpus.zip и отдаёт записи по одной.
     Поддерживает два формата:
       - отдельные .json файлы (по одному протоколу)
       - один .jsonl файл (все протоколы построчно, формат реального corpus.zip)
+    JSONL читается построчно из архива, без загрузки файла целиком в память.
     """
-    records = []
     with zipfile.ZipFile(zip_path, "r") as zf:
         all_names = zf.namelist()
         jsonl_files = [n for n in all_names if n.endswith(".jsonl")]
@@ -80,20 +118,19 @@ def parse_json_corpus(zip_path: str) -> list[dict]:
             # Формат реального corpus.zip: один protocols_corpus.jsonl
             for name in jsonl_files:
                 print(f"[corpus.zip] читаем JSONL: {name}")
-                with zf.open(name) as f:
-                    lines = f.read().decode("utf-8").splitlines()
-                print(f"  строк: {len(lines)}")
-                for line in tqdm(lines, desc="Парсинг JSONL"):
-                    line = line.strip()
-                    if not line:
-                        continue
-                    try:
-                        data = json.loads(line)
-                    except json.JSONDecodeError:
-                        continue
-                    rec = _record_from_dict(data, name)
-                    if rec:
-                        records.append(rec)
+                with zf.open(name) as raw:
+                    lines = io.TextIOWrapper(raw, encoding="utf-8")
+                    for line in tqdm(lines, desc="Парсинг JSONL"):
+                        line = line.strip()
+                        if not line:
+                            continue
+                        try:
+                            data = json.loads(line)
+                        except json.JSONDecodeError:
+                            continue
+                        rec = _record_from_dict(data, name)
+                        if rec:
+                            yield rec
         elif json_files:
             # Формат: отдельные JSON-файлы
             print(f"[corpus.zip] найдено {len(json_files)} JSON-файлов")
@@ -105,11 +142,14 @@ def parse_json_corpus(zip_path: str) -> list[dict]:
                         continue
                 rec = _record_from_dict(data, name)
                 if rec:
-                    records.append(rec)
+                    yield rec
         else:
             print("[corpus.zip] не найдено ни .json ни .jsonl файлов")
 
-    return records
+
+def parse_json_corpus(zip_path: str) -> list[dict]:
+    """Читает corpus.zip целиком (см. iter_json_corpus)."""
+    return list(iter_json_corpus(zip_path))
 
 
 def parse_pdf(pdf_path: str) -> str:
@@ -139,42 +179,121 @@ def parse_docx(docx_path: str) -> str:
     return "\n".join(paragraphs)
 
 
-def parse_directory(dir_path: str) -> list[dict]:
-    """
-    Сканирует директорию на PDF и DOCX файлы.
-    Возвращает список записей в том же формате, что parse_json_corpus.
-    """
-    records = []
-    path = Path(dir_path)
-    files = list(path.rglob("*.pdf")) + list(path.rglob("*.docx"))
-    print(f"[directory] найдено {len(files)} файлов (PDF + DOCX)")
+def _parse_cache_path(fp: Path, cache_dir: Path) -> Path:
+    """Ключ кэша: абсолютный путь + mtime + размер файла."""
+    st = fp.stat()
+    key = hashlib.sha1(f"{fp.resolve()}|{st.st_mtime_ns}|{st.st_size}".encode("utf-8")).hexdigest()
+    return cache_dir / f"{key}.txt"
 
-    for fp in tqdm(files, desc="Парсинг файлов"):
-        try:
-            if fp.suffix.lower() == ".pdf":
-                text = parse_pdf(str(fp))
-            else:
-                text = parse_docx(str(fp))
-        except Exception as e:
-            print(f"  [!] Ошибка при чтении {fp.name}: {e}")
-            continue
 
-        text = text.strip()
-        if not text:
-            continue
+def _extract_document(job: tuple[str, Optional[str]]) -> tuple[str, Optional[str], Optional[str], bool]:
+    """
+    Извлекает текст одного файла (выполняется в процессе пула).
+    Возвращает (путь, текст, ошибка, взят_из_кэша).
+    """
+    path, cache_dir = job
+    fp = Path(path)
+    cache_path = _parse_cache_path(fp, Path(cache_dir)) if cache_dir else None
+    if cache_path is not None and cache_path.exists():
+        return path, cache_path.read_text(encoding="utf-8"), None, True
 
-        # Пытаемся извлечь ICD-коды из текста (формат: J18.0, K29.1, ...)
-        icd_codes = re.findall(r"\b[A-Z]\d{2}(?:\.\d{1,2})?\b", text)
-        icd_codes = list(set(icd_codes))
+    try:
+        if fp.suffix.lower() == ".pdf":
+            text = parse_pdf(path)
+        else:
+            text = parse_docx(path)
+    except Exception as e:
+        return path, None, str(e), False
+
+    if cache_path is not None:
+        tmp = cache_path.with_suffix(f".{os.getpid()}.tmp")
+        tmp.write_text(text, encoding="utf-8")
+        os.replace(tmp, cache_path)
+    return path, text, None, False
+
+
+def iter_directory(
+    dir_path: str,
+    workers: Optional[int] = None,
+    cache_dir: Optional[str] = DEFAULT_PARSE_CACHE,
+) -> Iterator[dict]:
+    """
+    Сканирует директорию на PDF и DOCX файлы и отдаёт записи по одной
+    в том же формате, что iter_json_corpus.
+
+    Файлы парсятся параллельно в пуле процессов (workers, по умолч. — число ядер).
+    Извлечённый текст кэшируется в cache_dir по ключу путь + mtime + размер,
+    поэтому при пересборке заново парсятся только изменённые документы.
+    После полного прохода из cache_dir удаляются записи, не соответствующие ни
+    одному текущему файлу (изменённые, переименованные, удалённые), — кэш
+    хранит тексты только последней прочитанной директории.
+    cache_dir=None отключает кэш.
+    """
+    from concurrent.futures import ProcessPoolExecutor
 
-        records.append({
-            "id": fp.stem,
-            "text": text,
-            "icd_codes": icd_codes,
-            "source": fp.name,
-            "title": fp.stem.replace("_", " ").replace("-", " "),
-        })
-    return records
+    path = Path(dir_path)
+    files = list(path.rglob("*.pdf")) + list(path.rglob("*.docx"))
+    workers = max(1, workers or os.cpu_count() or 1)
+    print(f"[directory] найдено {len(files)} файлов (PDF + DOCX), процессов: {workers}")
+    if cache_dir:
+        Path(cache_dir).mkdir(parents=True, exist_ok=True)
+
+    jobs = [(str(fp), cache_dir) for fp in files]
+    cached = failed = 0
+    executor = ProcessPoolExecutor(max_workers=workers) if workers > 1 and len(jobs) > 1 else None
+    try:
+        results = executor.map(_extract_document, jobs, chunksize=4) if executor else map(_extract_document, jobs)
+        for file_path, text, error, from_cache in tqdm(results, total=len(jobs), desc="Парсинг файлов"):
+            fp = Path(file_path)
+            if error is not None:
+                failed += 1
+                print(f"  [!] Ошибка при чтении {fp.name}: {error}")
+                continue
+            cached += from_cache
+
+            text = text.strip()
+            if not text:
+                continue
+
+            # Пытаемся извлечь ICD-коды из текста (формат: J18.0, K29.1, ...)
+            icd_codes = re.findall(r"\b[A-Z]\d{2}(?:\.\d{1,2})?\b", text)
+            icd_codes = list(set(icd_codes))
+
+            yield {
+                "id": fp.stem,
+                "text": text,
+                "icd_codes": icd_codes,
+                "source": fp.name,
+                "title": fp.stem.replace("_", " ").replace("-", " "),
+            }
+    finally:
+        if executor:
+            executor.shutdown(cancel_futures=True)
+    print(f"  из кэша: {cached}, распарсено: {len(jobs) - cached - failed}, ошибок: {failed}")
+    if cache_dir:
+        removed = prune_parse_cache(Path(cache_dir), files)
+        if removed:
+            print(f"  удалено устаревших записей кэша: {removed}")
+
+
+def prune_parse_cache(cache_dir: Path, files: list[Path]) -> int:
+    """Удаляет из cache_dir записи (и брошенные .tmp), ключей которых нет среди files."""
+    keep = {_parse_cache_path(fp, cache_dir).name for fp in files if fp.exists()}
+    removed = 0
+    for entry in cache_dir.iterdir():
+        if entry.suffix in (".txt", ".tmp") and entry.name not in keep:
+            entry.unlink(missing_ok=True)
+            removed += 1
+    return removed
+
+
+def parse_directory(
+    dir_path: str,
+    workers: Optional[int] = None,
+    cache_dir: Optional[str] = DEFAULT_PARSE_CACHE,
+) -> list[dict]:
+    """Читает все PDF/DOCX директории (см. iter_directory)."""
+    return list(iter_directory(dir_path, workers, cache_dir))
 
 
 # ════════════════════════════════════════════════════════════════════════════
@@ -226,10 +345,39 @@ def split_into_chunks(
     return chunks
 
 
+def record_to_chunks(
+    rec: dict,
+    chunk_size: int = DEFAULT_CHUNK_SIZE,
+    overlap: int = DEFAULT_OVERLAP,
+    chunker: Optional[TokenChunker] = None,
+) -> tuple[list[str], list[dict]]:
+    """
+    Разбивает одну запись на чанки: (texts, metas).
+    chunker — разбивка по токенам модели (token_chunker.py), иначе по символам.
+    """
+    if chunker is not None:
+        chunks = chunker.split_text(clean_text(rec["text"]))
+    else:
+        chunks = split_into_chunks(rec["text"], chunk_size, overlap)
+    metas = [
+        {
+            "doc_id": rec["id"],
+            "chunk_id": i,
+            "total_chunks": len(chunks),
+            "source": rec["source"],
+            "title": rec["title"],
+            "icd_codes": rec["icd_codes"],
+        }
+        for i in range(len(chunks))
+    ]
+    return chunks, metas
+
+
 def records_to_chunks(
     records: list[dict],
     chunk_size: int = DEFAULT_CHUNK_SIZE,
     overlap: int = DEFAULT_OVERLAP,
+    chunker: Optional[TokenChunker] = None,
 ) -> tuple[list[str], list[dict]]:
     """
     Для каждой записи разбивает текст на чанки.
@@ -241,22 +389,65 @@ def records_to_chunks(
     metas = []
 
     for rec in tqdm(records, desc="Разбивка на чанки"):
-        chunks = split_into_chunks(rec["text"], chunk_size, overlap)
-        for i, chunk in enumerate(chunks):
-            texts.append(chunk)
-            metas.append({
-                "doc_id": rec["id"],
-                "chunk_id": i,
-                "total_chunks": len(chunks),
-                "source": rec["source"],
-                "title": rec["title"],
-                "icd_codes": rec["icd_codes"],
-            })
+        rec_texts, rec_metas = record_to_chunks(rec, chunk_size, overlap, chunker)
+        texts.extend(rec_texts)
+        metas.extend(rec_metas)
 
     print(f"  Итого чанков: {len(texts)} из {len(records)} документов")
     return texts, metas
 
 
+def iter_chunk_batches(
+    records: Iterable[dict],
+    chunk_size: int = DEFAULT_CHUNK_SIZE,
+    overlap: int = DEFAULT_OVERLAP,
+    batch_chunks: int = DEFAULT_STREAM_BATCH,
+    chunker: Optional[TokenChunker] = None,
+) -> Iterator[tuple[list[str], list[dict]]]:
+    """
+    Потоковая разбивка: отдаёт батчи (texts, metas) не больше batch_chunks чанков.
+    Документ целиком попадает в один батч, поэтому батч может немного превысить лимит.
+    """
+    texts: list[str] = []
+    metas: list[dict] = []
+    for rec in records:
+        rec_texts, rec_metas = record_to_chunks(rec, chunk_size, overlap, chunker)
+        texts.extend(rec_texts)
+        metas.extend(rec_metas)
+        if len(texts) >= batch_chunks:
+            yield texts, metas
+            texts, metas = [], []
+    if texts:
+        yield texts, metas
+
+
+def drop_near_duplicates(
+    texts: list[str],
+    metas: list[dict],
+    dedup: NearDupIndex,
+    offset: int = 0,
+) -> tuple[list[str], list[dict], list[tuple[int, dict]]]:
+    """
+    Убирает почти-дубликаты (near_dup.py) до векторизации.
+    dedup хранит уже оставленные чанки (в т.ч. из прошлых батчей), offset —
+    сколько чанков записано до этого батча. Возвращает (texts, metas, links),
+    links — [(номер оставленного чанка, meta дубля)] для ChunkStoreWriter.link.
+    """
+    kept_texts: list[str] = []
+    kept_metas: list[dict] = []
+    links: list[tuple[int, dict]] = []
+    for text, meta in zip(texts, metas):
+        sig = dedup.signature(text)
+        match = dedup.query(sig)
+        if match is not None:
+            links.append((match, meta))
+            continue
+        dedup.add(offset + len(kept_texts), sig)
+        kept_texts.append(text)
+        kept_metas.append(meta)
+    return kept_texts, kept_metas, links
+
+
 # ════════════════════════════════════════════════════════════════════════════
 # 3. ЭМБЕДДИНГИ + FAISS
 # ════════════════════════════════════════════════════════════════════════════
@@ -273,8 +464,24 @@ def embed_texts(
     texts: list[str],
     batch_size: int = 64,
     show_progress: bool = True,
+    cache=None,
 ) -> np.ndarray:
-    """Векторизует список текстов. Возвращает float32 numpy array."""
+    """
+    Векторизует список текстов. Возвращает float32 numpy array.
+    Если передан cache (EmbeddingCache), векторизуются только промахи кэша.
+    """
+    if cache is not None:
+        cached = cache.get_many(texts)
+        miss_idx = [i for i, v in enumerate(cached) if v is None]
+        print(f"Кэш эмбеддингов: {len(texts) - len(miss_idx)} из {len(texts)} чанков найдены")
+        if miss_idx:
+            miss_texts = [texts[i] for i in miss_idx]
+            computed = embed_texts(model, miss_texts, batch_size, show_progress)
+            cache.put_many(miss_texts, computed)
+            for i, vec in zip(miss_idx, computed):
+                cached[i] = vec
+        return np.stack(cached).astype("float32")
+
     print(f"Векторизация {len(texts)} чанков (batch={batch_size})...")
     embeddings = model.encode(
         texts,
@@ -286,31 +493,144 @@ def embed_texts(
     return embeddings.astype("float32")
 
 
-def build_faiss_index(embeddings: np.ndarray):
+# ── Многопроцессная векторизация (CPU) ───────────────────────────────────
+# Каждый процесс пула загружает свою копию модели и ограничен threads потоками
+# torch, чтобы процессы не конкурировали за одни и те же ядра.
+
+_worker_model = None
+
+
+def _init_embed_worker(model_name: str, threads: int) -> None:
+    global _worker_model
+    for var in ("OMP_NUM_THREADS", "MKL_NUM_THREADS", "OPENBLAS_NUM_THREADS"):
+        os.environ[var] = str(threads)
+    import torch
+    torch.set_num_threads(threads)
+    from sentence_transformers import SentenceTransformer
+    _worker_model = SentenceTransformer(model_name, device="cpu")
+
+
+def _embed_shard(job: tuple[int, list[str], int, bool]) -> tuple[int, int, np.ndarray, float]:
+    """Векторизует один шард в процессе пула: (номер шарда, pid, векторы, секунды)."""
+    import time
+
+    shard_idx, texts, batch_size, normalize = job
+    t0 = time.perf_counter()
+    vectors = _worker_model.encode(
+        texts,
+        batch_size=batch_size,
+        show_progress_bar=False,
+        convert_to_numpy=True,
+        normalize_embeddings=normalize,
+    )
+    return shard_idx, os.getpid(), vectors.astype("float32"), time.perf_counter() - t0
+
+
+class EmbeddingPool:
+    """
+    Пул процессов для векторизации на CPU с интерфейсом SentenceTransformer.encode,
+    поэтому подходит для embed_texts вместо модели.
+
+    Тексты режутся на непрерывные шарды, результаты собираются в исходном порядке.
+    После каждого вызова печатается производительность по процессам (чанков/сек).
+    """
+
+    SHARDS_PER_WORKER = 4   # мелкие шарды выравнивают нагрузку между процессами
+
+    def __init__(self, model_name: str, workers: int, threads_per_worker: Optional[int] = None):
+        import multiprocessing as mp
+        from concurrent.futures import ProcessPoolExecutor
+
+        self.workers = workers
+        self.threads = threads_per_worker or max(1, (os.cpu_count() or 1) // workers)
+        print(f"Пул векторизации: {workers} процессов × {self.threads} потоков, модель {model_name}")
+        self._executor = ProcessPoolExecutor(
+            max_workers=workers,
+            mp_context=mp.get_context("spawn"),
+            initializer=_init_embed_worker,
+            initargs=(model_name, self.threads),
+        )
+
+    def encode(
+        self,
+        texts: list[str],
+        batch_size: int = 64,
+        show_progress_bar: bool = True,
+        convert_to_numpy: bool = True,
+        normalize_embeddings: bool = False,
+    ) -> np.ndarray:
+        if not texts:
+            raise ValueError("Пустой список текстов")
+        n_shards = min(len(texts), self.workers * self.SHARDS_PER_WORKER)
+        bounds = np.linspace(0, len(texts), n_shards + 1).astype(int)
+        jobs = [
+            (i, texts[bounds[i]:bounds[i + 1]], batch_size, normalize_embeddings)
+            for i in range(n_shards)
+        ]
+
+        parts: list[Optional[np.ndarray]] = [None] * n_shards
+        per_worker: dict[int, list[float]] = {}
+        results = self._executor.map(_embed_shard, jobs)
+        for shard_idx, pid, vectors, seconds in tqdm(
+            results, total=n_shards, desc="Векторизация (шарды)", disable=not show_progress_bar
+        ):
+            parts[shard_idx] = vectors
+            stats = per_worker.setdefault(pid, [0, 0.0])
+            stats[0] += len(vectors)
+            stats[1] += seconds
+
+        for pid, (count, seconds) in sorted(per_worker.items()):
+            print(f"  процесс {pid}: {count} чанков за {seconds:.1f}s — {count / max(seconds, 1e-9):.1f} чанков/с")
+        return np.concatenate(parts)
+
+    def close(self) -> None:
+        self._executor.shutdown()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+
+def open_embedder(model_name: str = DEFAULT_MODEL, workers: int = 1):
+    """Модель в текущем процессе (workers=1) или EmbeddingPool из workers процессов."""
+    if workers > 1:
+        return EmbeddingPool(model_name, workers)
+    return load_embedder(model_name)
+
+
+def create_faiss_index(dim: int, n: int, index_type: str = "auto", index_params: Optional[dict] = None):
     """
-    Строит FAISS-индекс.
-    До 100k векторов — IndexFlatIP (точный поиск по inner product / cosine).
-    Больше — IVF с квантованием для скорости.
+    Создаёт (возможно, ещё не обученный) FAISS-индекс под коллекцию из n векторов.
+    index_type="auto": до 100k векторов — IndexFlatIP (точный поиск по
+    inner product / cosine), больше — IVF-Flat. Остальные типы — см. ann_index.py.
     """
-    import faiss
+    return create_index(dim, n, index_type, **(index_params or {}))
 
+
+def build_faiss_index(
+    embeddings: np.ndarray,
+    index_type: str = "auto",
+    index_params: Optional[dict] = None,
+    profiler: BuildProfiler = NULL_PROFILER,
+):
+    """Строит FAISS-индекс целиком в памяти (см. create_faiss_index)."""
     dim = embeddings.shape[1]
     n = embeddings.shape[0]
     print(f"Построение FAISS-индекса: {n} векторов, dim={dim}")
 
-    if n <= 100_000:
-        # Точный поиск (inner product после L2-нормировки = cosine)
-        index = faiss.IndexFlatIP(dim)
-    else:
-        # IVF + HNSW для больших коллекций
-        nlist = min(int(np.sqrt(n)), 4096)
-        quantizer = faiss.IndexFlatIP(dim)
-        index = faiss.IndexIVFFlat(quantizer, dim, nlist, faiss.METRIC_INNER_PRODUCT)
-        print(f"  Обучение IVF (nlist={nlist})...")
-        index.train(embeddings)
-        index.nprobe = min(32, nlist)
-
-    index.add(embeddings)
+    index = create_faiss_index(dim, n, index_type, index_params)
+    print(f"  Тип индекса: {describe_index(index)}")
+    if not index.is_trained:
+        print("  Обучение индекса...")
+        with profiler.stage("index-train"):
+            index.train(embeddings)
+        profiler.count("index-train", vectors=n)
+
+    with profiler.stage("index-add"):
+        index.add(embeddings)
+    profiler.count("index-add", vectors=n)
     print(f"  Индекс построен. Всего векторов: {index.ntotal}")
     return index
 
@@ -319,45 +639,286 @@ def build_faiss_index(embeddings: np.ndarray):
 # 4. СОХРАНЕНИЕ / ЗАГРУЗКА
 # ════════════════════════════════════════════════════════════════════════════
 
+def _write_summary(out: Path, total_chunks: int, model_name: str, sample: list[dict]) -> None:
+    """Читаемый JSON с метаданными (без текстов — для отладки)."""
+    with open(out / "metadata_summary.json", "w", encoding="utf-8") as f:
+        json.dump(
+            {
+                "total_chunks": total_chunks,
+                "model": model_name,
+                "sample": sample,
+            },
+            f,
+            ensure_ascii=False,
+            indent=2,
+        )
+
+
 def save_index(
     index,
     metas: list[dict],
     texts: list[str],
     index_dir: str = DEFAULT_INDEX_DIR,
     model_name: str = DEFAULT_MODEL,
+    links: Optional[list[tuple[int, dict]]] = None,
 ) -> None:
-    """Сохраняет FAISS-индекс + метаданные + тексты чанков."""
-    import faiss
-
+    """Сохраняет FAISS-индекс + метаданные + тексты чанков (links — см. drop_near_duplicates)."""
     out = Path(index_dir)
     out.mkdir(parents=True, exist_ok=True)
 
-    faiss.write_index(index, str(out / "protocols.faiss"))
+    write_index(index, out / "protocols.faiss")
 
-    with open(out / "metadata.pkl", "wb") as f:
-        pickle.dump({"metas": metas, "texts": texts, "model": model_name}, f)
+    write_chunk_store(out / STORE_DIRNAME, texts, metas, model_name, links)
+    # Метаданные старого формата в той же директории больше не актуальны
+    (out / "metadata.pkl").unlink(missing_ok=True)
+
+    _write_summary(out, len(texts), model_name, metas[:5])
+    _print_saved(out, index)
 
-    # Также сохраняем читаемый JSON с метаданными (без текстов — для отладки)
-    with open(out / "metadata_summary.json", "w", encoding="utf-8") as f:
-        json.dump(
-            {
-                "total_chunks": len(texts),
-                "model": model_name,
-                "sample": metas[:5],
-            },
-            f,
-            ensure_ascii=False,
-            indent=2,
-        )
 
+def open_bm25(index_dir: str | Path, enabled: bool = True) -> Optional[BM25Builder]:
+    """
+    Сборщик BM25-индекса для гибридного поиска (bm25_index.py) или None.
+    Старый protocols.bm25 удаляется сразу: его номера чанков не совпадут с новым индексом.
+    Списки терминов до save() копятся в шардах на диске внутри index_dir.
+    """
+    shutil.rmtree(Path(index_dir) / BM25_DIRNAME, ignore_errors=True)
+    if not enabled:
+        return None
+    try:
+        Path(index_dir).mkdir(parents=True, exist_ok=True)
+        return BM25Builder(spill_dir=index_dir)
+    except ImportError as e:
+        print(f"  [!] {e} — BM25-индекс не строится, поиск будет только плотным")
+        return None
+
+
+def _print_saved(out: Path, index) -> None:
     print(f"\nИндекс сохранён в: {out.resolve()}")
     print(f"  protocols.faiss  — FAISS-индекс")
-    print(f"  metadata.pkl     — метаданные + тексты чанков")
+    if isinstance(index, RescoredIndex):
+        print(f"  {RESCORE_VECTORS_FILE}      — float32-векторы для точного пересчёта (mmap)")
+    print(f"  {STORE_DIRNAME}/           — тексты + метаданные чанков (колонки, mmap)")
+    if (out / BM25_DIRNAME).exists():
+        print(f"  {BM25_DIRNAME}/    — BM25-индекс для гибридного поиска")
     print(f"  metadata_summary.json — краткая сводка")
 
 
+def report_index_quality(
+    index,
+    index_dir: str,
+    n: int,
+    gather,
+    blocks: Iterable[np.ndarray],
+    eval_queries: int = DEFAULT_EVAL_QUERIES,
+    k: int = DEFAULT_EVAL_K,
+    seed: int = 1,
+) -> dict:
+    """
+    Сравнивает сохранённый индекс с точным поиском на выборке запросов:
+    recall@k, латентность p50/p99, размер protocols.faiss. Печатает сводку и
+    пишет её в index_eval.json — так отчёты разных --index-type легко сравнить.
+    gather(ids) возвращает векторы корпуса по номерам, blocks — весь корпус по частям.
+    """
+    out = Path(index_dir)
+    rng = np.random.default_rng(seed)
+    query_ids = np.sort(rng.choice(n, size=min(eval_queries, n), replace=False)).astype("int64")
+    queries = np.ascontiguousarray(gather(query_ids), dtype="float32")
+    truth = exact_topk(queries, query_ids, blocks, k)
+    report = evaluate_index(index, queries, query_ids, truth, k, (out / "protocols.faiss").stat().st_size)
+
+    with open(out / "index_eval.json", "w", encoding="utf-8") as f:
+        json.dump(report, f, ensure_ascii=False, indent=2)
+    print(format_report(report))
+    return report
+
+
+# ════════════════════════════════════════════════════════════════════════════
+# 5. ПОТОКОВАЯ СБОРКА (out-of-core)
+# ════════════════════════════════════════════════════════════════════════════
+# Записи идут через parse → chunk → embed ограниченными батчами. Эмбеддинги
+# каждого батча сбрасываются на диск в .npy-шард, тексты и метаданные —
+# дописываются в хранилище чанков (chunk_store). IVF обучается на случайной выборке из шардов, векторы
+# добавляются в индекс шард за шардом через mmap. Пиковая память определяется
+# размером батча и самим индексом, а не размером корпуса.
+
+def _gather_from_shards(shards: list[Path], shard_sizes: list[int], picked: np.ndarray) -> np.ndarray:
+    """Векторы с номерами picked (отсортированы по возрастанию) из шардов."""
+    bounds = np.cumsum([0] + shard_sizes)
+    parts = []
+    for i, path in enumerate(shards):
+        lo, hi = np.searchsorted(picked, [bounds[i], bounds[i + 1]])
+        if hi > lo:
+            shard = np.load(path, mmap_mode="r")
+            parts.append(np.asarray(shard[picked[lo:hi] - bounds[i]]))
+    return np.ascontiguousarray(np.concatenate(parts), dtype="float32")
+
+
+def _sample_from_shards(
+    shards: list[Path],
+    shard_sizes: list[int],
+    n_samples: int,
+    seed: int = 0,
+) -> np.ndarray:
+    """Случайная выборка векторов из шардов (для обучения IVF)."""
+    total = sum(shard_sizes)
+    rng = np.random.default_rng(seed)
+    picked = np.sort(rng.choice(total, size=min(n_samples, total), replace=False))
+    return _gather_from_shards(shards, shard_sizes, picked)
+
+
+def build_index_streaming(
+    records: Iterable[dict],
+    index_dir: str = DEFAULT_INDEX_DIR,
+    model_name: str = DEFAULT_MODEL,
+    chunk_size: int = DEFAULT_CHUNK_SIZE,
+    overlap: int = DEFAULT_OVERLAP,
+    batch_size: int = 64,
+    stream_batch: int = DEFAULT_STREAM_BATCH,
+    train_sample: int = DEFAULT_TRAIN_SAMPLE,
+    keep_shards: bool = False,
+    embed_workers: int = 1,
+    cache: Optional[EmbeddingCache] = None,
+    index_type: str = "auto",
+    index_params: Optional[dict] = None,
+    rescore_factor: Optional[int] = None,
+    eval_queries: int = DEFAULT_EVAL_QUERIES,
+    eval_k: int = DEFAULT_EVAL_K,
+    dedup_threshold: Optional[float] = None,
+    chunker: Optional[TokenChunker] = None,
+    profiler: BuildProfiler = NULL_PROFILER,
+    bm25: bool = True,
+) -> None:
+    """
+    Out-of-core сборка: индекс + хранилище чанков + metadata_summary.json в index_dir.
+    eval_queries > 0 — после сборки индекс сравнивается с точным поиском по шардам.
+    dedup_threshold — порог почти-дубликатов (по умолч. None — без дедупликации),
+    сравнение идёт со всеми уже оставленными чанками, а не только внутри батча.
+    Сигнатуры и LSH-таблица держатся в памяти (~3 КБ на чанк), поэтому здесь
+    дедупликация включается только явно.
+    profiler — учёт стадий; время чтения records (parse) отделяется от chunk,
+    если records обёрнут в profiler.iter("parse", ...).
+    Для сжатых типов (sq8/fp16/binary) шарды сливаются в vectors.npy для точного пересчёта.
+    bm25 — рядом строится protocols.bm25 (тексты добавляются по мере записи в хранилище).
+    """
+    out = Path(index_dir)
+    out.mkdir(parents=True, exist_ok=True)
+    shard_dir = out / "_shards"
+    shard_dir.mkdir(exist_ok=True)
+
+    with profiler.stage("embed"):
+        model = open_embedder(model_name, embed_workers)
+    shards: list[Path] = []
+    shard_sizes: list[int] = []
+    sample_metas: list[dict] = []
+    n_docs = 0
+    n_dups = 0
+    dedup = NearDupIndex(dedup_threshold) if dedup_threshold else None
+
+    # ── parse → chunk → embed батчами, эмбеддинги — в шарды на диске ─────
+    store = ChunkStoreWriter(out / STORE_DIRNAME)
+    sparse = open_bm25(out, bm25)
+    batches = profiler.iter(
+        "chunk",
+        iter_chunk_batches(records, chunk_size, overlap, stream_batch, chunker),
+        lambda batch: {"chunks": len(batch[0])},
+    )
+    for texts, metas in batches:
+        n_docs += sum(1 for m in metas if m["chunk_id"] == 0)
+        if dedup is not None:
+            with profiler.stage("dedup"):
+                n_before = len(texts)
+                texts, metas, links = drop_near_duplicates(texts, metas, dedup, store.n_chunks)
+                for chunk, meta in links:
+                    store.link(chunk, meta)
+            profiler.count("dedup", chunks=n_before)
+            n_dups += len(links)
+            if not texts:
+                continue
+        with profiler.stage("embed"):
+            embeddings = embed_texts(model, texts, batch_size=batch_size, show_progress=False, cache=cache)
+            path = shard_dir / f"shard_{len(shards):05d}.npy"
+            np.save(path, embeddings)
+        profiler.count("embed", vectors=len(texts))
+        shards.append(path)
+        shard_sizes.append(len(texts))
+
+        with profiler.stage("save"):
+            store.add(texts, metas)
+        if sparse is not None:
+            with profiler.stage("bm25"):
+                sparse.add(texts)
+            profiler.count("bm25", chunks=len(texts))
+        if len(sample_metas) < 5:
+            sample_metas.extend(metas[: 5 - len(sample_metas)])
+        print(f"  шард {len(shards)}: {len(texts)} чанков (всего {sum(shard_sizes)})")
+    if isinstance(model, EmbeddingPool):
+        with profiler.stage("embed"):
+            model.close()
+
+    n = sum(shard_sizes)
+    if not n:
+        shutil.rmtree(store.dir, ignore_errors=True)
+        shutil.rmtree(shard_dir, ignore_errors=True)
+        print("[!] Документы не найдены. Проверьте путь к источнику.")
+        return
+    print(f"  Итого чанков: {n} из {n_docs} документов, шардов: {len(shards)}")
+    if dedup is not None:
+        print(f"  Почти-дубликатов убрано: {n_dups}")
+
+    # ── обучение на выборке + добавление шард за шардом ──────────────────
+    dim = np.load(shards[0], mmap_mode="r").shape[1]
+    print(f"Построение FAISS-индекса: {n} векторов, dim={dim}")
+    index = create_faiss_index(dim, n, index_type, index_params)
+    print(f"  Тип индекса: {describe_index(index)}")
+    if not index.is_trained:
+        with profiler.stage("index-train"):
+            sample = _sample_from_shards(shards, shard_sizes, train_sample)
+            print(f"  Обучение индекса на выборке из {len(sample)} векторов...")
+            index.train(sample)
+        profiler.count("index-train", vectors=len(sample))
+        del sample
+
+    with profiler.stage("index-add"):
+        for path in tqdm(shards, desc="Добавление шардов"):
+            index.add(np.load(path, mmap_mode="r"))
+    profiler.count("index-add", vectors=n)
+    print(f"  Индекс построен. Всего векторов: {index.ntotal}")
+
+    # ── сохранение ────────────────────────────────────────────────────────
+    with profiler.stage("save"):
+        if index_type in COMPRESSED_TYPES:
+            blocks = (np.load(path, mmap_mode="r") for path in shards)
+            index = with_rescoring(index, out / RESCORE_VECTORS_FILE, blocks, n, dim, rescore_factor)
+        write_index(index, out / "protocols.faiss")
+        store.close(model_name)
+        (out / "metadata.pkl").unlink(missing_ok=True)
+        _write_summary(out, n, model_name, sample_metas)
+    profiler.count("save", vectors=n)
+    if sparse is not None:
+        with profiler.stage("bm25"):
+            sparse.save(out / BM25_DIRNAME)
+
+    _print_saved(out, index)
+
+    if eval_queries > 0:
+        print(f"\nОценка индекса относительно точного поиска:")
+        with profiler.stage("evaluate"):
+            report_index_quality(
+                index,
+                index_dir,
+                n,
+                lambda ids: _gather_from_shards(shards, shard_sizes, ids),
+                (np.load(path, mmap_mode="r") for path in shards),
+                eval_queries,
+                eval_k,
+            )
+    if not keep_shards:
+        shutil.rmtree(shard_dir, ignore_errors=True)
+
+
 # ════════════════════════════════════════════════════════════════════════════
-# 5. ТОЧКА ВХОДА
+# 6. ТОЧКА ВХОДА
 # ════════════════════════════════════════════════════════════════════════════
 
 def main():
@@ -379,17 +940,35 @@ def main():
         default=DEFAULT_MODEL,
         help=f"Sentence-transformers модель (по умолч.: {DEFAULT_MODEL})",
     )
+    parser.add_argument(
+        "--chunker",
+        choices=("tokens", "chars"),
+        default="tokens",
+        help="Разбивка на чанки: по токенам модели (по умолч.) или по символам",
+    )
+    parser.add_argument(
+        "--chunk-tokens",
+        type=int,
+        default=None,
+        help="Размер чанка в токенах вместе со служебными (по умолч. и максимум: max_seq_length модели)",
+    )
+    parser.add_argument(
+        "--overlap-tokens",
+        type=int,
+        default=DEFAULT_OVERLAP_TOKENS,
+        help=f"Перекрытие чанков в токенах (по умолч.: {DEFAULT_OVERLAP_TOKENS})",
+    )
     parser.add_argument(
         "--chunk-size",
         type=int,
         default=DEFAULT_CHUNK_SIZE,
-        help=f"Размер чанка в символах (по умолч.: {DEFAULT_CHUNK_SIZE})",
+        help=f"Размер чанка в символах для --chunker chars (по умолч.: {DEFAULT_CHUNK_SIZE})",
     )
     parser.add_argument(
         "--overlap",
         type=int,
         default=DEFAULT_OVERLAP,
-        help=f"Перекрытие чанков в символах (по умолч.: {DEFAULT_OVERLAP})",
+        help=f"Перекрытие чанков в символах для --chunker chars (по умолч.: {DEFAULT_OVERLAP})",
     )
     parser.add_argument(
         "--batch-size",
@@ -397,25 +976,255 @@ def main():
         default=64,
         help="Размер батча для эмбеддингов (по умолч.: 64)",
     )
+    parser.add_argument(
+        "--embed-workers",
+        type=int,
+        default=1,
+        help="Процессов для векторизации на CPU (по умолч.: 1 — в текущем процессе)",
+    )
+    parser.add_argument(
+        "--embed-cache",
+        default=DEFAULT_CACHE_PATH,
+        help=f"SQLite-кэш эмбеддингов, '' — отключить (по умолч.: {DEFAULT_CACHE_PATH})",
+    )
+    parser.add_argument(
+        "--embed-cache-mb",
+        type=int,
+        default=2048,
+        help="Лимит размера кэша эмбеддингов в MB (по умолч.: 2048)",
+    )
+    parser.add_argument(
+        "--parse-workers",
+        type=int,
+        default=None,
+        help="Процессов для парсинга PDF/DOCX (по умолч.: число ядер)",
+    )
+    parser.add_argument(
+        "--parse-cache",
+        default=DEFAULT_PARSE_CACHE,
+        help=f"Директория кэша извлечённого текста, '' — отключить (по умолч.: {DEFAULT_PARSE_CACHE})",
+    )
+    parser.add_argument(
+        "--streaming",
+        action="store_true",
+        default=False,
+        help="Out-of-core сборка: батчи чанков, эмбеддинги в шардах на диске",
+    )
+    parser.add_argument(
+        "--stream-batch",
+        type=int,
+        default=DEFAULT_STREAM_BATCH,
+        help=f"Чанков на шард в режиме --streaming (по умолч.: {DEFAULT_STREAM_BATCH})",
+    )
+    parser.add_argument(
+        "--train-sample",
+        type=int,
+        default=DEFAULT_TRAIN_SAMPLE,
+        help=f"Векторов для обучения IVF в режиме --streaming (по умолч.: {DEFAULT_TRAIN_SAMPLE})",
+    )
+    parser.add_argument(
+        "--keep-shards",
+        action="store_true",
+        default=False,
+        help="Не удалять шарды эмбеддингов (<index-dir>/_shards) после сборки",
+    )
+    parser.add_argument(
+        "--index-type",
+        choices=INDEX_TYPES,
+        default="auto",
+        help="Тип FAISS-индекса (по умолч.: auto — Flat до 100k векторов, иначе IVF-Flat)",
+    )
+    parser.add_argument(
+        "--hnsw-m",
+        type=int,
+        default=DEFAULT_HNSW_M,
+        help=f"HNSW: число связей на вершину M (по умолч.: {DEFAULT_HNSW_M})",
+    )
+    parser.add_argument(
+        "--ef-construction",
+        type=int,
+        default=DEFAULT_EF_CONSTRUCTION,
+        help=f"HNSW: efConstruction (по умолч.: {DEFAULT_EF_CONSTRUCTION})",
+    )
+    parser.add_argument(
+        "--ef-search",
+        type=int,
+        default=DEFAULT_EF_SEARCH,
+        help=f"HNSW: efSearch, сохраняется в индексе (по умолч.: {DEFAULT_EF_SEARCH})",
+    )
+    parser.add_argument(
+        "--nlist",
+        type=int,
+        default=None,
+        help="IVF: число кластеров (по умолч.: sqrt(n), не больше 4096)",
+    )
+    parser.add_argument(
+        "--nprobe",
+        type=int,
+        default=DEFAULT_NPROBE,
+        help=f"IVF: кластеров на запрос, сохраняется в индексе (по умолч.: {DEFAULT_NPROBE})",
+    )
+    parser.add_argument(
+        "--pq-m",
+        type=int,
+        default=None,
+        help="IVF-PQ: байт на вектор, должно делить размерность (по умолч.: наибольший делитель ≤ 64)",
+    )
+    parser.add_argument(
+        "--rescore-factor",
+        type=int,
+        default=None,
+        help=(
+            f"sq8/fp16/binary: сжатые коды отбирают top_k × N кандидатов, которые пересчитываются "
+            f"точно по float32-векторам (по умолч.: {DEFAULT_RESCORE_FACTOR}, для binary {BINARY_RESCORE_FACTOR})"
+        ),
+    )
+    parser.add_argument(
+        "--eval-queries",
+        type=int,
+        default=DEFAULT_EVAL_QUERIES,
+        help=f"Запросов для сравнения с точным поиском, 0 — не оценивать (по умолч.: {DEFAULT_EVAL_QUERIES})",
+    )
+    parser.add_argument(
+        "--eval-k",
+        type=int,
+        default=DEFAULT_EVAL_K,
+        help=f"k для recall@k (по умолч.: {DEFAULT_EVAL_K})",
+    )
+    parser.add_argument(
+        "--dedup-threshold",
+        type=float,
+        default=0.0,
+        help=(
+            "Порог сходства (MinHash/Жаккар) для схлопывания почти одинаковых чанков, "
+            f"обычно {DEFAULT_DEDUP_THRESHOLD} (по умолч.: 0 — не схлопывать). "
+            "Сигнатуры всех оставленных чанков держатся в памяти, ~3 КБ на чанк "
+            "(~3 ГБ на миллион), поэтому с --streaming память перестаёт быть постоянной"
+        ),
+    )
+    parser.add_argument(
+        "--no-bm25",
+        action="store_true",
+        default=False,
+        help="Не строить BM25-индекс (protocols.bm25) — поиск будет только плотным, без гибридного",
+    )
+    parser.add_argument(
+        "--profile",
+        nargs="?",
+        const="",
+        default=None,
+        metavar="REPORT.json",
+        help=(
+            "Профилировать стадии сборки (wall/CPU/пиковый RSS/пропускная способность) и записать "
+            "JSON-отчёт (по умолч.: <index-dir>/build_profile.json). Сравнить два отчёта: "
+            "python build_profile.py old.json new.json"
+        ),
+    )
     args = parser.parse_args()
+    profiler = BuildProfiler(enabled=args.profile is not None)
+    profile_path = args.profile or os.path.join(args.index_dir, "build_profile.json")
+    profile_config = {
+        "source": args.source,
+        "model": args.model,
+        "streaming": args.streaming,
+        "chunker": args.chunker,
+        "chunk_tokens": args.chunk_tokens,
+        "overlap_tokens": args.overlap_tokens,
+        "chunk_size": args.chunk_size,
+        "overlap": args.overlap,
+        "dedup_threshold": args.dedup_threshold,
+        "batch_size": args.batch_size,
+        "embed_workers": args.embed_workers,
+        "embed_cache": bool(args.embed_cache),
+        "parse_workers": args.parse_workers,
+        "index_type": args.index_type,
+        "rescore_factor": args.rescore_factor,
+        "bm25": not args.no_bm25,
+    }
+    index_params = {
+        "hnsw_m": args.hnsw_m,
+        "ef_construction": args.ef_construction,
+        "ef_search": args.ef_search,
+        "nlist": args.nlist,
+        "nprobe": args.nprobe,
+        "pq_m": args.pq_m,
+    }
 
     source = args.source
+    chunker = None
+    if args.chunker == "tokens":
+        with profiler.stage("chunk"):
+            chunker = TokenChunker.from_model(args.model, args.chunk_tokens, args.overlap_tokens)
+        print(
+            f"Чанки по токенам: до {chunker.max_tokens} токенов "
+            f"({chunker.budget} без служебных), перекрытие {chunker.overlap}"
+        )
+    cache = (
+        EmbeddingCache(args.embed_cache, args.model, args.embed_cache_mb * 1024 ** 2)
+        if args.embed_cache else None
+    )
+
+    if args.streaming:
+        print(f"\n{'='*60}")
+        print("Потоковая сборка: парсинг → чанки → эмбеддинги → FAISS")
+        print(f"{'='*60}")
+        if source.endswith(".zip"):
+            if not os.path.exists(source):
+                raise FileNotFoundError(f"Файл не найден: {source}")
+            records = iter_json_corpus(source)
+        elif os.path.isdir(source):
+            records = iter_directory(source, args.parse_workers, args.parse_cache or None)
+        else:
+            raise ValueError(
+                f"--source должен быть .zip-файлом или директорией, получено: {source}"
+            )
+        build_index_streaming(
+            profiler.iter("parse", records, lambda rec: {"docs": 1}),
+            index_dir=args.index_dir,
+            model_name=args.model,
+            chunk_size=args.chunk_size,
+            overlap=args.overlap,
+            batch_size=args.batch_size,
+            stream_batch=args.stream_batch,
+            train_sample=args.train_sample,
+            keep_shards=args.keep_shards,
+            embed_workers=args.embed_workers,
+            cache=cache,
+            index_type=args.index_type,
+            index_params=index_params,
+            rescore_factor=args.rescore_factor,
+            eval_queries=args.eval_queries,
+            eval_k=args.eval_k,
+            dedup_threshold=args.dedup_threshold,
+            chunker=chunker,
+            profiler=profiler,
+            bm25=not args.no_bm25,
+        )
+        if cache is not None:
+            print(cache.report())
+            cache.close()
+        if profiler.enabled:
+            profiler.save(profile_path, profile_config)
+        print("\nГотово!")
+        return
 
     # ── 1. Парсинг ────────────────────────────────────────────────────────
     print(f"\n{'='*60}")
     print("ШАГ 1: Парсинг документов")
     print(f"{'='*60}")
 
-    if source.endswith(".zip"):
-        if not os.path.exists(source):
-            raise FileNotFoundError(f"Файл не найден: {source}")
-        records = parse_json_corpus(source)
-    elif os.path.isdir(source):
-        records = parse_directory(source)
-    else:
-        raise ValueError(
-            f"--source должен быть .zip-файлом или директорией, получено: {source}"
-        )
+    with profiler.stage("parse"):
+        if source.endswith(".zip"):
+            if not os.path.exists(source):
+                raise FileNotFoundError(f"Файл не найден: {source}")
+            records = parse_json_corpus(source)
+        elif os.path.isdir(source):
+            records = parse_directory(source, args.parse_workers, args.parse_cache or None)
+        else:
+            raise ValueError(
+                f"--source должен быть .zip-файлом или директорией, получено: {source}"
+            )
+    profiler.count("parse", docs=len(records))
 
     if not records:
         print("[!] Документы не найдены. Проверьте путь к источнику.")
@@ -427,27 +1236,74 @@ def main():
     print(f"\n{'='*60}")
     print("ШАГ 2: Разбивка на чанки")
     print(f"{'='*60}")
-    texts, metas = records_to_chunks(records, args.chunk_size, args.overlap)
+    with profiler.stage("chunk"):
+        texts, metas = records_to_chunks(records, args.chunk_size, args.overlap, chunker)
+    profiler.count("chunk", docs=len(records), chunks=len(texts))
+    links = []
+    if args.dedup_threshold:
+        total = len(texts)
+        with profiler.stage("dedup"):
+            texts, metas, links = drop_near_duplicates(texts, metas, NearDupIndex(args.dedup_threshold))
+        profiler.count("dedup", chunks=total)
+        print(f"  Почти-дубликатов убрано: {len(links)} из {total}, осталось чанков: {len(texts)}")
 
     # ── 3. Эмбеддинги ────────────────────────────────────────────────────
     print(f"\n{'='*60}")
     print("ШАГ 3: Векторизация (sentence-transformers)")
     print(f"{'='*60}")
-    model = load_embedder(args.model)
-    embeddings = embed_texts(model, texts, batch_size=args.batch_size)
+    with profiler.stage("embed"):
+        model = open_embedder(args.model, args.embed_workers)
+        embeddings = embed_texts(model, texts, batch_size=args.batch_size, cache=cache)
+        if isinstance(model, EmbeddingPool):
+            model.close()
+    profiler.count("embed", vectors=len(texts))
+    if cache is not None:
+        print(cache.report())
+        cache.close()
 
     # ── 4. FAISS ──────────────────────────────────────────────────────────
     print(f"\n{'='*60}")
     print("ШАГ 4: Построение FAISS-индекса")
     print(f"{'='*60}")
-    index = build_faiss_index(embeddings)
+    index = build_faiss_index(embeddings, args.index_type, index_params, profiler)
 
     # ── 5. Сохранение ─────────────────────────────────────────────────────
     print(f"\n{'='*60}")
     print("ШАГ 5: Сохранение")
     print(f"{'='*60}")
-    save_index(index, metas, texts, args.index_dir, args.model)
-
+    with profiler.stage("save"):
+        if args.index_type in COMPRESSED_TYPES:
+            os.makedirs(args.index_dir, exist_ok=True)
+            vectors_path = os.path.join(args.index_dir, RESCORE_VECTORS_FILE)
+            index = with_rescoring(index, vectors_path, [embeddings], *embeddings.shape, args.rescore_factor)
+        save_index(index, metas, texts, args.index_dir, args.model, links)
+    profiler.count("save", vectors=len(texts))
+    sparse = open_bm25(args.index_dir, not args.no_bm25)
+    if sparse is not None:
+        with profiler.stage("bm25"):
+            sparse.add(texts)
+            path = sparse.save(Path(args.index_dir) / BM25_DIRNAME)
+        profiler.count("bm25", chunks=len(texts))
+        print(f"  {BM25_DIRNAME}/    — BM25-индекс для гибридного поиска ({path.resolve()})")
+
+    # ── 6. Оценка ─────────────────────────────────────────────────────────
+    if args.eval_queries > 0:
+        print(f"\n{'='*60}")
+        print("ШАГ 6: Оценка индекса относительно точного поиска")
+        print(f"{'='*60}")
+        with profiler.stage("evaluate"):
+            report_index_quality(
+                index,
+                args.index_dir,
+                len(embeddings),
+                lambda ids: embeddings[ids],
+                [embeddings],
+                args.eval_queries,
+                args.eval_k,
+            )
+
+    if profiler.enabled:
+        profiler.save(profile_path, profile_config)
     print("\nГотово!")
 
 
@@ -0,0 +1,240 @@
+"""
+build_profile.py — Профилирование сборки индекса по стадиям (build_index.py --profile).
+
+Для каждой стадии (parse, chunk, dedup, embed, index-train, index-add, save, bm25,
+evaluate) считаются:
+  wall_s       — время по часам
+  cpu_s        — процессорное время процесса + завершившихся дочерних
+                 процессов (пулы парсинга/векторизации учитываются в той
+                 стадии, где пул закрывается)
+  peak_rss_mb  — пиковый RSS основного процесса за время стадии
+                 (опрос раз в RSS_SAMPLE_S секунд)
+  counts       — обработано docs / chunks / vectors
+  throughput   — то же в штуках в секунду wall-времени
+
+Время стадий не пересекается: если внутри "chunk" вызывается итератор
+"parse" (потоковая сборка), его время засчитывается только parse.
+
+Отчёт — JSON, два отчёта сравниваются так:
+    python build_profile.py old.json new.json
+"""
+
+import json
+import os
+import platform
+import resource
+import sys
+import threading
+import time
+from contextlib import contextmanager
+from datetime import datetime, timezone
+from typing import Callable, Iterable, Iterator, Optional
+
+REPORT_VERSION = 1
+RSS_SAMPLE_S = 0.05
+
+
+def _rss_bytes() -> int:
+    try:
+        with open("/proc/self/statm") as f:
+            return int(f.read().split()[1]) * os.sysconf("SC_PAGE_SIZE")
+    except (OSError, ValueError):
+        # Нет /proc (macOS): только пик за всё время жизни процесса
+        peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+        return peak if sys.platform == "darwin" else peak * 1024
+
+
+def _cpu_seconds() -> float:
+    t = os.times()
+    return t.user + t.system + t.children_user + t.children_system
+
+
+class _Stage:
+    def __init__(self):
+        self.wall = 0.0
+        self.cpu = 0.0
+        self.peak_rss = 0
+        self.calls = 0
+        self.counts: dict[str, int] = {}
+
+
+class BuildProfiler:
+    """Профайлер стадий. enabled=False — пустые операции (по умолчанию для сборки без --profile)."""
+
+    def __init__(self, enabled: bool = True):
+        self.enabled = enabled
+        self._stages: dict[str, _Stage] = {}
+        self._stack: list[list] = []   # [имя, wall на входе/возобновлении, cpu на входе/возобновлении]
+        self._started = time.perf_counter()
+        self._started_cpu = _cpu_seconds()
+        self._started_at = datetime.now(timezone.utc).isoformat(timespec="seconds")
+        self._peak_rss = 0
+        self._stop = threading.Event()
+        self._sampler = None
+        if enabled:
+            self._sampler = threading.Thread(target=self._sample_rss, name="rss-sampler", daemon=True)
+            self._sampler.start()
+
+    # ── учёт ────────────────────────────────────────────────────────────────
+    def _sample_rss(self) -> None:
+        while not self._stop.wait(RSS_SAMPLE_S):
+            self._observe_rss()
+
+    def _observe_rss(self) -> None:
+        rss = _rss_bytes()
+        self._peak_rss = max(self._peak_rss, rss)
+        try:
+            stage = self._stages[self._stack[-1][0]]
+        except IndexError:   # стек меняется в основном потоке
+            return
+        stage.peak_rss = max(stage.peak_rss, rss)
+
+    def _charge_top(self) -> None:
+        """Засчитывает время с момента входа/возобновления стадии на вершине стека."""
+        name, wall0, cpu0 = self._stack[-1]
+        now, cpu = time.perf_counter(), _cpu_seconds()
+        stage = self._stages[name]
+        stage.wall += now - wall0
+        stage.cpu += cpu - cpu0
+        self._stack[-1][1:] = [now, cpu]
+
+    @contextmanager
+    def stage(self, name: str):
+        if not self.enabled:
+            yield
+            return
+        if self._stack:
+            self._charge_top()
+        stage = self._stages.setdefault(name, _Stage())
+        stage.calls += 1
+        self._stack.append([name, time.perf_counter(), _cpu_seconds()])
+        self._observe_rss()
+        try:
+            yield
+        finally:
+            self._observe_rss()
+            self._charge_top()
+            self._stack.pop()
+            if self._stack:
+                self._stack[-1][1:] = [time.perf_counter(), _cpu_seconds()]
+
+    def count(self, name: str, **counts: int) -> None:
+        if not self.enabled:
+            return
+        stage = self._stages.setdefault(name, _Stage())
+        for key, value in counts.items():
+            stage.counts[key] = stage.counts.get(key, 0) + int(value)
+
+    def iter(self, name: str, items: Iterable, counter: Optional[Callable[[object], dict]] = None) -> Iterator:
+        """Оборачивает итератор: время внутри next() идёт в стадию name, counter(item) — в счётчики."""
+        if not self.enabled:
+            yield from items
+            return
+        it = iter(items)
+        while True:
+            with self.stage(name):
+                try:
+                    item = next(it)
+                except StopIteration:
+                    return
+            if counter is not None:
+                self.count(name, **counter(item))
+            yield item
+
+    # ── отчёт ───────────────────────────────────────────────────────────────
+    def report(self, config: Optional[dict] = None) -> dict:
+        self._observe_rss()
+        stages = {}
+        for name, s in self._stages.items():
+            stages[name] = {
+                "wall_s": round(s.wall, 3),
+                "cpu_s": round(s.cpu, 3),
+                "peak_rss_mb": round(s.peak_rss / 1024 ** 2, 1),
+                "calls": s.calls,
+                "counts": dict(s.counts),
+                "throughput": {
+                    f"{key}_per_s": round(value / s.wall, 2) if s.wall > 0 else None
+                    for key, value in s.counts.items()
+                },
+            }
+        children_peak = resource.getrusage(resource.RUSAGE_CHILDREN).ru_maxrss
+        if sys.platform != "darwin":
+            children_peak *= 1024
+        return {
+            "version": REPORT_VERSION,
+            "started_at": self._started_at,
+            "argv": sys.argv[1:],
+            "config": config or {},
+            "host": {
+                "platform": platform.platform(),
+                "python": platform.python_version(),
+                "cpu_count": os.cpu_count(),
+            },
+            "stages": stages,
+            "total": {
+                "wall_s": round(time.perf_counter() - self._started, 3),
+                "cpu_s": round(_cpu_seconds() - self._started_cpu, 3),
+                "peak_rss_mb": round(self._peak_rss / 1024 ** 2, 1),
+                "children_peak_rss_mb": round(children_peak / 1024 ** 2, 1),
+            },
+        }
+
+    def save(self, path: str, config: Optional[dict] = None) -> dict:
+        self._stop.set()
+        report = self.report(config)
+        with open(path, "w", encoding="utf-8") as f:
+            json.dump(report, f, ensure_ascii=False, indent=2)
+        print(format_report(report))
+        print(f"Отчёт профилирования: {path}")
+        return report
+
+
+NULL_PROFILER = BuildProfiler(enabled=False)
+
+
+def format_report(report: dict) -> str:
+    lines = [f"{'стадия':<12} {'wall, с':>9} {'cpu, с':>9} {'RSS, MB':>9}  пропускная способность"]
+    for name, s in report["stages"].items():
+        rate = ", ".join(f"{v:.1f} {k.replace('_per_s', '')}/s" for k, v in s["throughput"].items() if v)
+        lines.append(f"{name:<12} {s['wall_s']:>9.2f} {s['cpu_s']:>9.2f} {s['peak_rss_mb']:>9.1f}  {rate}")
+    t = report["total"]
+    lines.append(f"{'итого':<12} {t['wall_s']:>9.2f} {t['cpu_s']:>9.2f} {t['peak_rss_mb']:>9.1f}")
+    return "\n".join(lines)
+
+
+def compare(old: dict, new: dict) -> str:
+    """Таблица изменений wall / RSS / пропускной способности по стадиям (new относительно old)."""
+
+    def delta(a, b) -> str:
+        if not a:
+            return "—"
+        return f"{(b - a) / a * 100:+.1f}%"
+
+    lines = [f"{'стадия':<12} {'wall old':>9} {'wall new':>9} {'Δ wall':>8} {'Δ RSS':>8}  Δ throughput"]
+    names = list(old["stages"]) + [n for n in new["stages"] if n not in old["stages"]]
+    for name in names:
+        a, b = old["stages"].get(name), new["stages"].get(name)
+        if a is None or b is None:
+            lines.append(f"{name:<12} {'только в ' + ('new' if a is None else 'old'):>30}")
+            continue
+        rates = ", ".join(
+            f"{k.replace('_per_s', '')} {delta(a['throughput'].get(k), v)}"
+            for k, v in b["throughput"].items() if v is not None
+        )
+        lines.append(
+            f"{name:<12} {a['wall_s']:>9.2f} {b['wall_s']:>9.2f} "
+            f"{delta(a['wall_s'], b['wall_s']):>8} {delta(a['peak_rss_mb'], b['peak_rss_mb']):>8}  {rates}"
+        )
+    ta, tb = old["total"], new["total"]
+    lines.append(
+        f"{'итого':<12} {ta['wall_s']:>9.2f} {tb['wall_s']:>9.2f} "
+        f"{delta(ta['wall_s'], tb['wall_s']):>8} {delta(ta['peak_rss_mb'], tb['peak_rss_mb']):>8}"
+    )
+    return "\n".join(lines)
+
+
+if __name__ == "__main__":
+    if len(sys.argv) != 3:
+        sys.exit("Использование: python build_profile.py old.json new.json")
+    with open(sys.argv[1], encoding="utf-8") as f_old, open(sys.argv[2], encoding="utf-8") as f_new:
+        print(compare(json.load(f_old), json.load(f_new)))
@@ -0,0 +1,337 @@
+"""
+chunk_store.py — Колоночное хранилище чанков, открываемое через mmap.
+
+Заменяет metadata.pkl: вместо распаковки всех текстов и словарей метаданных
+в Python-списки при старте, каждая колонка лежит в отдельном файле и
+отображается в память. Строки материализуются только для тех чанков,
+которые вернул поиск, а страницы файлов разделяются между процессами
+(uvicorn workers) через page cache.
+
+Формат (<index_dir>/chunks/):
+  manifest.json       — версия формата, число чанков/документов, модель
+  texts.bin           — тексты чанков подряд, UTF-8
+  text_offsets.i64    — int64[n + 1], границы текстов в texts.bin
+  chunk_doc.i32       — int32[n], номер документа чанка (строка в docs.json)
+  chunk_pos.i32       — int32[n], номер чанка внутри документа (chunk_id)
+  docs.json           — таблица документов: doc_id, source, title, total_chunks, icd_vocab
+  doc_icd_offsets.i32 — int32[n_docs + 1], CSR-границы ICD-кодов документа
+  doc_icd.i32         — int32[...], номера кодов в icd_vocab
+  also_offsets.i64    — int64[n + 1], CSR-границы списка "также в документах" (v2)
+  also_doc.i32        — int32[...], документы, где встретился почти такой же чанк (v2)
+  icd_keys.json, icd_offsets.i64, icd_chunks.i32
+                      — инвертированный индекс ICD → чанки (v3), см. icd_index.py
+
+Колонки — сырые little-endian массивы без заголовка (dtype задан расширением),
+поэтому их можно дописывать потоково при out-of-core сборке.
+"""
+
+import json
+import mmap
+import os
+import shutil
+from pathlib import Path
+from typing import Optional
+
+import numpy as np
+
+from icd_index import ICDIndex
+
+FORMAT_VERSION = 3
+READABLE_VERSIONS = (1, 2, 3)   # в v1 нет also_* (сборки без дедупликации), до v3 нет icd_*
+STORE_DIRNAME = "chunks"
+
+
+class ChunkStoreWriter:
+    """Потоковая запись хранилища: add() батчами, затем close()."""
+
+    def __init__(self, out_dir: str | Path):
+        self.final_dir = Path(out_dir)
+        self.dir = self.final_dir.with_name(self.final_dir.name + ".tmp")
+        shutil.rmtree(self.dir, ignore_errors=True)
+        self.dir.mkdir(parents=True)
+
+        self._texts = open(self.dir / "texts.bin", "wb")
+        self._offsets = open(self.dir / "text_offsets.i64", "wb")
+        self._chunk_doc = open(self.dir / "chunk_doc.i32", "wb")
+        self._chunk_pos = open(self.dir / "chunk_pos.i32", "wb")
+        np.zeros(1, dtype="<i8").tofile(self._offsets)
+
+        self._pos = 0
+        self.n_chunks = 0
+        self._doc_index: dict[tuple, int] = {}
+        self._docs: list[dict] = []
+        self._icd_vocab: dict[str, int] = {}
+        self._also: list[tuple[int, int]] = []   # (номер чанка, строка документа)
+
+    def _doc_row(self, meta: dict) -> int:
+        key = (meta["doc_id"], meta["source"], meta["title"], tuple(meta["icd_codes"]))
+        row = self._doc_index.get(key)
+        if row is None:
+            row = len(self._docs)
+            self._doc_index[key] = row
+            self._docs.append({
+                "doc_id": meta["doc_id"],
+                "source": meta["source"],
+                "title": meta["title"],
+                "total_chunks": meta.get("total_chunks", 0),
+                "icd": [self._icd_vocab.setdefault(c, len(self._icd_vocab)) for c in meta["icd_codes"]],
+            })
+        return row
+
+    def add(self, texts: list[str], metas: list[dict]) -> None:
+        offsets = np.empty(len(texts), dtype="<i8")
+        for i, text in enumerate(texts):
+            encoded = text.encode("utf-8")
+            self._texts.write(encoded)
+            self._pos += len(encoded)
+            offsets[i] = self._pos
+        offsets.tofile(self._offsets)
+        np.fromiter((self._doc_row(m) for m in metas), dtype="<i4", count=len(metas)).tofile(self._chunk_doc)
+        np.fromiter((m["chunk_id"] for m in metas), dtype="<i4", count=len(metas)).tofile(self._chunk_pos)
+        self.n_chunks += len(texts)
+
+    def link(self, chunk: int, meta: dict) -> None:
+        """Отмечает, что чанк chunk (уже записанный или из текущего батча) встречается и в документе meta."""
+        self._also.append((chunk, self._doc_row(meta)))
+
+    def close(self, model_name: str) -> Path:
+        """Дописывает таблицу документов и атомарно публикует директорию."""
+        for f in (self._texts, self._offsets, self._chunk_doc, self._chunk_pos):
+            f.close()
+
+        # also_in: без повторов и без ссылок на собственный документ чанка
+        chunk_doc = _column(self.dir / "chunk_doc.i32", "<i4")
+        pairs = sorted({(c, d) for c, d in self._also if chunk_doc[c] != d})
+        del chunk_doc
+        also_offsets = np.zeros(self.n_chunks + 1, dtype="<i8")
+        np.add.at(also_offsets, np.array([c + 1 for c, _ in pairs], dtype=np.int64), 1)
+        np.cumsum(also_offsets, out=also_offsets)
+        also_offsets.tofile(self.dir / "also_offsets.i64")
+        also_doc = np.array([d for _, d in pairs], dtype="<i4")
+        also_doc.tofile(self.dir / "also_doc.i32")
+
+        icd_offsets = np.zeros(len(self._docs) + 1, dtype="<i4")
+        icd_offsets[1:] = np.cumsum([len(d["icd"]) for d in self._docs])
+        icd_offsets.tofile(self.dir / "doc_icd_offsets.i32")
+        doc_icd = np.fromiter(
+            (c for d in self._docs for c in d["icd"]), dtype="<i4", count=int(icd_offsets[-1])
+        )
+        doc_icd.tofile(self.dir / "doc_icd.i32")
+
+        chunk_doc = _column(self.dir / "chunk_doc.i32", "<i4")
+        ICDIndex.from_columns(
+            chunk_doc, icd_offsets, doc_icd, list(self._icd_vocab), also_offsets, also_doc
+        ).save(self.dir)
+        del chunk_doc
+
+        with open(self.dir / "docs.json", "w", encoding="utf-8") as f:
+            json.dump(
+                {
+                    "doc_id": [d["doc_id"] for d in self._docs],
+                    "source": [d["source"] for d in self._docs],
+                    "title": [d["title"] for d in self._docs],
+                    "total_chunks": [d["total_chunks"] for d in self._docs],
+                    "icd_vocab": list(self._icd_vocab),
+                },
+                f,
+                ensure_ascii=False,
+            )
+        with open(self.dir / "manifest.json", "w", encoding="utf-8") as f:
+            json.dump(
+                {
+                    "version": FORMAT_VERSION,
+                    "n_chunks": self.n_chunks,
+                    "n_docs": len(self._docs),
+                    "n_also": len(pairs),
+                    "model": model_name,
+                },
+                f,
+            )
+
+        shutil.rmtree(self.final_dir, ignore_errors=True)
+        os.replace(self.dir, self.final_dir)
+        return self.final_dir
+
+
+def write_chunk_store(
+    out_dir: str | Path,
+    texts: list[str],
+    metas: list[dict],
+    model_name: str,
+    links: Optional[list[tuple[int, dict]]] = None,
+) -> Path:
+    """links — [(номер чанка, meta документа-дубля)], см. ChunkStoreWriter.link."""
+    writer = ChunkStoreWriter(out_dir)
+    writer.add(texts, metas)
+    for chunk, meta in links or ():
+        writer.link(chunk, meta)
+    return writer.close(model_name)
+
+
+def _column(path: Path, dtype: str) -> np.ndarray:
+    if path.stat().st_size == 0:
+        return np.zeros(0, dtype=dtype)
+    return np.memmap(path, dtype=dtype, mode="r")
+
+
+class ChunkStore:
+    """Чтение хранилища: колонки через mmap, строки — по запросу."""
+
+    def __init__(self, store_dir: str | Path):
+        self.dir = Path(store_dir)
+        with open(self.dir / "manifest.json", encoding="utf-8") as f:
+            manifest = json.load(f)
+        if manifest.get("version") not in READABLE_VERSIONS:
+            raise ValueError(f"Неподдерживаемая версия хранилища чанков: {manifest.get('version')}")
+        self.model_name: Optional[str] = manifest.get("model")
+
+        self._offsets = _column(self.dir / "text_offsets.i64", "<i8")
+        self.chunk_doc = _column(self.dir / "chunk_doc.i32", "<i4")
+        self.chunk_pos = _column(self.dir / "chunk_pos.i32", "<i4")
+        self._icd_offsets = _column(self.dir / "doc_icd_offsets.i32", "<i4")
+        self._icd = _column(self.dir / "doc_icd.i32", "<i4")
+        if (self.dir / "also_offsets.i64").exists():
+            self._also_offsets = _column(self.dir / "also_offsets.i64", "<i8")
+            self._also_doc = _column(self.dir / "also_doc.i32", "<i4")
+        else:
+            self._also_offsets = None
+
+        with open(self.dir / "docs.json", encoding="utf-8") as f:
+            docs = json.load(f)
+        self.doc_ids: list = docs["doc_id"]
+        self.sources: list[str] = docs["source"]
+        self.titles: list[str] = docs["title"]
+        self.total_chunks: list[int] = docs["total_chunks"]
+        self.icd_vocab: list[str] = docs["icd_vocab"]
+
+        self._texts_file = open(self.dir / "texts.bin", "rb")
+        size = os.fstat(self._texts_file.fileno()).st_size
+        self._texts = mmap.mmap(self._texts_file.fileno(), 0, access=mmap.ACCESS_READ) if size else b""
+
+    def __len__(self) -> int:
+        return len(self.chunk_doc)
+
+    def text(self, i: int) -> str:
+        return self._texts[int(self._offsets[i]):int(self._offsets[i + 1])].decode("utf-8")
+
+    def doc_icd_codes(self, doc: int) -> list[str]:
+        lo, hi = self._icd_offsets[doc], self._icd_offsets[doc + 1]
+        return [self.icd_vocab[c] for c in self._icd[lo:hi]]
+
+    def doc_meta(self, doc: int) -> dict:
+        return {
+            "doc_id": self.doc_ids[doc],
+            "source": self.sources[doc],
+            "title": self.titles[doc],
+            "icd_codes": self.doc_icd_codes(doc),
+        }
+
+    def also_in(self, i: int) -> list[dict]:
+        """Другие документы, в которых встретился почти такой же чанк (см. near_dup.py)."""
+        if self._also_offsets is None:
+            return []
+        lo, hi = self._also_offsets[i], self._also_offsets[i + 1]
+        return [self.doc_meta(int(d)) for d in self._also_doc[lo:hi]]
+
+    def doc_pairs(self, ids: np.ndarray) -> tuple[np.ndarray, np.ndarray]:
+        """
+        Пары (позиция в ids, строка документа): собственный документ каждого
+        чанка и документы из also_in. Отсортированы по позиции, собственный
+        документ — первым.
+        """
+        ids = np.asarray(ids, dtype=np.int64)
+        pos = np.arange(len(ids), dtype=np.int64)
+        docs = np.asarray(self.chunk_doc[ids], dtype=np.int64)
+        if self._also_offsets is None or not len(ids):
+            return pos, docs
+        lo = np.asarray(self._also_offsets[ids], dtype=np.int64)
+        counts = np.asarray(self._also_offsets[ids + 1], dtype=np.int64) - lo
+        total = int(counts.sum())
+        if not total:
+            return pos, docs
+        rows = np.repeat(lo - (np.cumsum(counts) - counts), counts) + np.arange(total)
+        pos = np.concatenate([pos, np.repeat(pos, counts)])
+        docs = np.concatenate([docs, np.asarray(self._also_doc[rows], dtype=np.int64)])
+        order = np.argsort(pos, kind="stable")
+        return pos[order], docs[order]
+
+    def icd_index(self) -> ICDIndex:
+        """Инвертированный индекс ICD из хранилища; для хранилищ до v3 строится по колонкам."""
+        index = ICDIndex.load(self.dir)
+        if index is None:
+            index = ICDIndex.from_columns(
+                self.chunk_doc,
+                self._icd_offsets,
+                self._icd,
+                self.icd_vocab,
+                self._also_offsets,
+                self._also_doc if self._also_offsets is not None else None,
+            )
+        return index
+
+    def meta(self, i: int) -> dict:
+        doc = int(self.chunk_doc[i])
+        return {
+            "doc_id": self.doc_ids[doc],
+            "chunk_id": int(self.chunk_pos[i]),
+            "total_chunks": self.total_chunks[doc],
+            "source": self.sources[doc],
+            "title": self.titles[doc],
+            "icd_codes": self.doc_icd_codes(doc),
+            "also_in": self.also_in(i),
+        }
+
+    def close(self) -> None:
+        if isinstance(self._texts, mmap.mmap):
+            self._texts.close()
+        self._texts_file.close()
+
+
+class InMemoryChunks:
+    """Тот же интерфейс для индексов старого формата (metadata.pkl)."""
+
+    def __init__(self, texts: list[str], metas: list[dict], model_name: Optional[str] = None):
+        self._texts = texts
+        self._metas = metas
+        self.model_name = model_name
+        # Таблица документов (doc_id → строка), как docs.json у ChunkStore
+        self._docs: dict = {}
+        self._doc_metas: list[dict] = []
+        for meta in metas:
+            for doc in [meta, *meta.get("also_in", [])]:
+                self._doc_row(doc)
+
+    def __len__(self) -> int:
+        return len(self._texts)
+
+    def text(self, i: int) -> str:
+        return self._texts[i]
+
+    def meta(self, i: int) -> dict:
+        return self._metas[i]
+
+    def icd_index(self) -> ICDIndex:
+        return ICDIndex.from_metas(self._metas)
+
+    def _doc_row(self, meta: dict) -> int:
+        row = self._docs.get(meta["doc_id"])
+        if row is None:
+            row = self._docs[meta["doc_id"]] = len(self._doc_metas)
+            self._doc_metas.append({k: meta[k] for k in ("doc_id", "source", "title", "icd_codes")})
+        return row
+
+    def doc_pairs(self, ids: np.ndarray) -> tuple[np.ndarray, np.ndarray]:
+        """См. ChunkStore.doc_pairs."""
+        pos, docs = [], []
+        for p, i in enumerate(ids):
+            meta = self._metas[int(i)]
+            for doc in [meta, *meta.get("also_in", [])]:
+                pos.append(p)
+                docs.append(self._docs[doc["doc_id"]])
+        return np.array(pos, dtype=np.int64), np.array(docs, dtype=np.int64)
+
+    def doc_meta(self, doc: int) -> dict:
+        return dict(self._doc_metas[doc])
+
+    def close(self) -> None:
+        pass
@@ -0,0 +1,144 @@
+"""
+embedding_cache.py — Персистентный кэш эмбеддингов чанков (SQLite).
+
+Ключ: (имя модели, sha256 нормализованного текста чанка). При смене размера
+чанка или заголовков большинство текстов совпадает с прошлой сборкой — такие
+чанки берутся из кэша, векторизуются только промахи.
+
+В кэше хранятся L2-нормированные float32-векторы. Размер ограничен max_bytes:
+при превышении вытесняются давно не использованные записи (LRU).
+
+Использование:
+    cache = EmbeddingCache("./.embed_cache.sqlite", model_name)
+    vectors = cache.get_many(texts)          # None для промахов
+    cache.put_many(miss_texts, miss_vectors)
+    print(cache.report())
+"""
+
+import hashlib
+import re
+import sqlite3
+import time
+import unicodedata
+from pathlib import Path
+from typing import Optional
+
+import numpy as np
+
+DEFAULT_CACHE_PATH = "./.embed_cache.sqlite"
+DEFAULT_MAX_BYTES = 2 * 1024 ** 3   # 2 ГБ векторов
+EVICT_TO = 0.9                      # после вытеснения остаётся 90% лимита
+
+_WS = re.compile(r"\s+")
+
+
+def normalize_text(text: str) -> str:
+    """Нормализация перед хэшированием: NFC + схлопывание пробелов."""
+    return _WS.sub(" ", unicodedata.normalize("NFC", text)).strip()
+
+
+def text_key(text: str) -> bytes:
+    return hashlib.sha256(normalize_text(text).encode("utf-8")).digest()
+
+
+class EmbeddingCache:
+    """Кэш векторов чанков на SQLite с вытеснением по размеру (LRU)."""
+
+    def __init__(
+        self,
+        path: str = DEFAULT_CACHE_PATH,
+        model_name: str = "",
+        max_bytes: int = DEFAULT_MAX_BYTES,
+    ):
+        self.path = Path(path)
+        self.path.parent.mkdir(parents=True, exist_ok=True)
+        self.model_name = model_name
+        self.max_bytes = max_bytes
+        self.hits = 0
+        self.misses = 0
+        self.evicted = 0
+
+        self._db = sqlite3.connect(str(self.path))
+        self._db.execute("PRAGMA journal_mode=WAL")
+        self._db.execute("PRAGMA synchronous=NORMAL")
+        self._db.execute(
+            "CREATE TABLE IF NOT EXISTS embeddings ("
+            " model TEXT NOT NULL, key BLOB NOT NULL, vec BLOB NOT NULL,"
+            " last_used REAL NOT NULL, PRIMARY KEY (model, key)) WITHOUT ROWID"
+        )
+        self._db.execute("CREATE INDEX IF NOT EXISTS embeddings_lru ON embeddings(last_used)")
+        self._db.commit()
+        self._total_bytes = self._db.execute(
+            "SELECT COALESCE(SUM(LENGTH(vec)), 0) FROM embeddings"
+        ).fetchone()[0]
+
+    def get_many(self, texts: list[str]) -> list[Optional[np.ndarray]]:
+        """Векторы для texts в том же порядке; None — промах."""
+        keys = [text_key(t) for t in texts]
+        found: dict[bytes, np.ndarray] = {}
+        unique = list(dict.fromkeys(keys))
+        for start in range(0, len(unique), 500):   # лимит параметров SQLite
+            part = unique[start:start + 500]
+            rows = self._db.execute(
+                f"SELECT key, vec FROM embeddings WHERE model = ? AND key IN ({','.join('?' * len(part))})",
+                [self.model_name, *part],
+            ).fetchall()
+            for key, vec in rows:
+                found[key] = np.frombuffer(vec, dtype="float32")
+
+        if found:
+            now = time.time()
+            self._db.executemany(
+                "UPDATE embeddings SET last_used = ? WHERE model = ? AND key = ?",
+                [(now, self.model_name, k) for k in found],
+            )
+            self._db.commit()
+
+        result = [found.get(k) for k in keys]
+        hits = sum(v is not None for v in result)
+        self.hits += hits
+        self.misses += len(result) - hits
+        return result
+
+    def put_many(self, texts: list[str], vectors: np.ndarray) -> None:
+        now = time.time()
+        rows = [
+            (self.model_name, text_key(t), np.asarray(v, dtype="float32").tobytes(), now)
+            for t, v in zip(texts, vectors)
+        ]
+        self._db.executemany("INSERT OR REPLACE INTO embeddings VALUES (?, ?, ?, ?)", rows)
+        self._db.commit()
+        self._total_bytes += sum(len(r[2]) for r in rows)
+        if self._total_bytes > self.max_bytes:
+            self._evict()
+
+    def _evict(self) -> None:
+        """Удаляет самые давно использованные записи до EVICT_TO * max_bytes."""
+        target = int(self.max_bytes * EVICT_TO)
+        while self._total_bytes > target:
+            rows = self._db.execute(
+                "SELECT model, key, LENGTH(vec) FROM embeddings ORDER BY last_used LIMIT 10000"
+            ).fetchall()
+            if not rows:
+                break
+            batch, freed = [], 0
+            for model, key, size in rows:
+                batch.append((model, key))
+                freed += size
+                if self._total_bytes - freed <= target:
+                    break
+            self._db.executemany("DELETE FROM embeddings WHERE model = ? AND key = ?", batch)
+            self._total_bytes -= freed
+            self.evicted += len(batch)
+        self._db.commit()
+
+    def report(self) -> str:
+        total = self.hits + self.misses
+        rate = self.hits / total * 100 if total else 0.0
+        return (
+            f"Кэш эмбеддингов: попаданий {self.hits}, промахов {self.misses} ({rate:.1f}% hit), "
+            f"вытеснено {self.evicted}, размер {self._total_bytes / 1024 ** 2:.1f} MB"
+        )
+
+    def close(self) -> None:
+        self._db.close()
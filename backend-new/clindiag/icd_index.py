@@ -0,0 +1,173 @@
+"""
+icd_index.py — Инвертированный индекс ICD-10 → номера чанков.
+
+Фильтр по ICD раньше искал top_k * 10 кандидатов и отбрасывал лишние в
+Python: запрос тратил поиск впустую и мог вернуть меньше top_k. Теперь
+множество подходящих чанков известно заранее, и поиск идёт только по нему
+(ann_index.search_subset).
+
+Ключи — точные коды и 3-символьные рубрики: по ключу "J18" лежат чанки с
+кодом J18 и со всеми J18.x, по ключу "J18.9" — только с J18.9. Чанк
+относится ко всем кодам своего документа и документов из also_in
+(см. near_dup.py).
+
+Формат (<index_dir>/chunks/, пишется ChunkStoreWriter.close):
+  icd_keys.json      — ключи по порядку строк
+  icd_offsets.i64    — int64[n_keys + 1], CSR-границы
+  icd_chunks.i32     — int32[...], номера чанков по возрастанию внутри ключа
+
+Для хранилищ без этих файлов (и для metadata.pkl) индекс строится при загрузке.
+"""
+
+import json
+import re
+from pathlib import Path
+from typing import Iterable, Optional
+
+import numpy as np
+
+KEYS_FILE = "icd_keys.json"
+OFFSETS_FILE = "icd_offsets.i64"
+CHUNKS_FILE = "icd_chunks.i32"
+
+_CATEGORY = re.compile(r"^[A-Z]\d{2}")
+
+
+def normalize_code(code: str) -> str:
+    return code.strip().upper()
+
+
+def icd_category(code: str) -> Optional[str]:
+    """3-символьная рубрика (J18.9 → J18) или None, если код не похож на ICD-10."""
+    m = _CATEGORY.match(normalize_code(code))
+    return m.group(0) if m else None
+
+
+def _vocab_keys(vocab: list[str]) -> tuple[list[str], np.ndarray, np.ndarray]:
+    """Ключи + для каждого кода словаря номер ключа точного кода и номер ключа рубрики (-1 — нет)."""
+    keys: dict[str, int] = {}
+    exact = np.empty(len(vocab), dtype=np.int64)
+    category = np.full(len(vocab), -1, dtype=np.int64)
+    for i, code in enumerate(vocab):
+        exact[i] = keys.setdefault(normalize_code(code), len(keys))
+        cat = icd_category(code)
+        if cat is not None and cat != normalize_code(code):
+            category[i] = keys.setdefault(cat, len(keys))
+    return list(keys), exact, category
+
+
+def _csr(key_ids: np.ndarray, chunk_ids: np.ndarray, n_keys: int, n_chunks: int) -> tuple[np.ndarray, np.ndarray]:
+    """Пары (ключ, чанк) → CSR без повторов, чанки по возрастанию."""
+    pairs = np.unique(key_ids * max(n_chunks, 1) + chunk_ids)
+    keys_sorted = pairs // max(n_chunks, 1)
+    chunks = (pairs % max(n_chunks, 1)).astype("<i4")
+    offsets = np.zeros(n_keys + 1, dtype="<i8")
+    np.add.at(offsets, keys_sorted + 1, 1)
+    np.cumsum(offsets, out=offsets)
+    return offsets, chunks
+
+
+def build_postings(
+    chunk_doc: np.ndarray,
+    doc_icd_offsets: np.ndarray,
+    doc_icd: np.ndarray,
+    icd_vocab: list[str],
+    also_offsets: Optional[np.ndarray] = None,
+    also_doc: Optional[np.ndarray] = None,
+) -> tuple[list[str], np.ndarray, np.ndarray]:
+    """Из колонок ChunkStore: (ключи, offsets, chunks). Всё в numpy, без цикла по чанкам."""
+    n_chunks = len(chunk_doc)
+    pair_chunk = np.arange(n_chunks, dtype=np.int64)
+    pair_doc = np.asarray(chunk_doc, dtype=np.int64)
+    if also_offsets is not None and also_doc is not None and len(also_doc):
+        pair_chunk = np.concatenate([pair_chunk, np.repeat(pair_chunk, np.diff(also_offsets))])
+        pair_doc = np.concatenate([pair_doc, np.asarray(also_doc, dtype=np.int64)])
+
+    # (чанк, документ) → (чанк, код): разворачиваем CSR кодов документа
+    doc_icd_offsets = np.asarray(doc_icd_offsets, dtype=np.int64)
+    counts = np.diff(doc_icd_offsets)[pair_doc]
+    starts = doc_icd_offsets[pair_doc]
+    total = int(counts.sum())
+    first = np.repeat(np.cumsum(counts) - counts, counts)
+    codes = np.asarray(doc_icd, dtype=np.int64)[np.repeat(starts, counts) + np.arange(total) - first]
+    chunks = np.repeat(pair_chunk, counts)
+
+    keys, exact, category = _vocab_keys(icd_vocab)
+    cat_ids = category[codes]
+    has_cat = cat_ids >= 0
+    key_ids = np.concatenate([exact[codes], cat_ids[has_cat]])
+    chunk_ids = np.concatenate([chunks, chunks[has_cat]])
+    offsets, posting = _csr(key_ids, chunk_ids, len(keys), n_chunks)
+    return keys, offsets, posting
+
+
+class ICDIndex:
+    """Ключ ICD (точный код или рубрика) → отсортированный массив номеров чанков."""
+
+    def __init__(self, keys: list[str], offsets: np.ndarray, chunks: np.ndarray):
+        self.keys = keys
+        self._rows = {k: i for i, k in enumerate(keys)}
+        self._offsets = offsets
+        self._chunks = chunks
+
+    def __len__(self) -> int:
+        return len(self.keys)
+
+    def postings(self, key: str) -> np.ndarray:
+        row = self._rows.get(normalize_code(key))
+        if row is None:
+            return np.zeros(0, dtype=np.int64)
+        return np.asarray(self._chunks[self._offsets[row]:self._offsets[row + 1]], dtype=np.int64)
+
+    def allowed(self, codes: Iterable[str]) -> np.ndarray:
+        """Отсортированные номера чанков, подходящих под любой из codes."""
+        parts = [self.postings(c) for c in codes]
+        if not parts:
+            return np.zeros(0, dtype=np.int64)
+        return parts[0] if len(parts) == 1 else np.unique(np.concatenate(parts))
+
+    def save(self, store_dir: str | Path) -> None:
+        store_dir = Path(store_dir)
+        with open(store_dir / KEYS_FILE, "w", encoding="utf-8") as f:
+            json.dump(self.keys, f, ensure_ascii=False)
+        np.asarray(self._offsets, dtype="<i8").tofile(store_dir / OFFSETS_FILE)
+        np.asarray(self._chunks, dtype="<i4").tofile(store_dir / CHUNKS_FILE)
+
+    @classmethod
+    def load(cls, store_dir: str | Path) -> Optional["ICDIndex"]:
+        """Индекс из файлов хранилища; None — хранилище собрано без него."""
+        store_dir = Path(store_dir)
+        if not (store_dir / KEYS_FILE).exists():
+            return None
+        with open(store_dir / KEYS_FILE, encoding="utf-8") as f:
+            keys = json.load(f)
+        offsets = np.fromfile(store_dir / OFFSETS_FILE, dtype="<i8")
+        chunks_path = store_dir / CHUNKS_FILE
+        chunks = (
+            np.memmap(chunks_path, dtype="<i4", mode="r")
+            if chunks_path.stat().st_size else np.zeros(0, dtype="<i4")
+        )
+        return cls(keys, offsets, chunks)
+
+    @classmethod
+    def from_columns(cls, *args, **kwargs) -> "ICDIndex":
+        """См. build_postings."""
+        return cls(*build_postings(*args, **kwargs))
+
+    @classmethod
+    def from_metas(cls, metas: list[dict]) -> "ICDIndex":
+        """Для индексов старого формата (metadata.pkl): метаданные уже в памяти."""
+        keys: dict[str, int] = {}
+        key_ids, chunk_ids = [], []
+        for i, meta in enumerate(metas):
+            codes = set(meta.get("icd_codes", []))
+            for doc in meta.get("also_in", []):
+                codes.update(doc["icd_codes"])
+            for code in codes:
+                for key in {normalize_code(code), icd_category(code)} - {None}:
+                    key_ids.append(keys.setdefault(key, len(keys)))
+                    chunk_ids.append(i)
+        offsets, chunks = _csr(
+            np.array(key_ids, dtype=np.int64), np.array(chunk_ids, dtype=np.int64), len(keys), len(metas)
+        )
+        return cls(list(keys), offsets, chunks)
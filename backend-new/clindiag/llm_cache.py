@@ -0,0 +1,199 @@
+"""
+llm_cache.py — Персистентный кэш ответов LLM по точному совпадению запроса (SQLite).
+
+Повторные оценочные прогоны, итерации self_refine и повторная отправка того же
+анамнеза шлют 120B-модели байт-в-байт одинаковые chat-запросы. Попадание в кэш
+отвечает за миллисекунды вместо десятков секунд. Ключ — sha256 от модели,
+версии промптов, сообщений целиком, temperature и max_tokens: любое изменение
+промпта или параметров — другая запись. Сохраняются только успешные ответы.
+
+В файле не больше max_entries ответов (вытесняются давно не использованные),
+запись живёт ttl_seconds с момента сохранения. Режим WAL — один файл на
+несколько воркеров uvicorn.
+
+Запрос может обойти кэш (API: заголовок `Cache-Control: no-cache`). Обращения
+считаются в llm_cache_requests_total{result="hit|miss|bypass"} (/metrics) и в stats().
+
+Использование:
+    cache = LLMResponseCache("./.llm_cache.sqlite")
+    key = cache_key(model, messages, temperature, max_tokens, prompts_version)
+    text = cache.get(key)                    # None — промах
+    cache.put(key, model, text, latency_ms)
+"""
+
+import hashlib
+import json
+import sqlite3
+import threading
+import time
+from pathlib import Path
+from typing import Any, Optional
+
+from metrics import Counter
+
+DEFAULT_PATH = "./.llm_cache.sqlite"
+DEFAULT_MAX_ENTRIES = 10_000
+DEFAULT_TTL_SECONDS = 86_400.0
+EVICT_TO = 0.9                      # после вытеснения остаётся 90% лимита
+RESYNC_EVERY = 1000                 # перечитывать COUNT(*) раз в N записей (в тот же файл пишут другие воркеры)
+
+LOOKUPS = Counter("llm_cache_requests_total", "Обращения к кэшу ответов LLM по результату.", ("result",))
+
+
+def cache_key(
+    model: str,
+    messages: list[dict[str, str]],
+    temperature: float,
+    max_tokens: int,
+    prompts_version: Any = "",
+) -> str:
+    payload = json.dumps(
+        {
+            "model": model,
+            "prompts_version": str(prompts_version),
+            "messages": messages,
+            "temperature": temperature,
+            "max_tokens": max_tokens,
+        },
+        ensure_ascii=False,
+        sort_keys=True,
+        separators=(",", ":"),
+    )
+    return hashlib.sha256(payload.encode("utf-8")).hexdigest()
+
+
+class LLMResponseCache:
+    """Потокобезопасный LRU+TTL кэш ответов на SQLite. max_entries=0 — выключен, ttl_seconds=0 — без срока."""
+
+    def __init__(
+        self,
+        path: str = DEFAULT_PATH,
+        max_entries: int = DEFAULT_MAX_ENTRIES,
+        ttl_seconds: float = DEFAULT_TTL_SECONDS,
+    ):
+        self.path = Path(path)
+        self.max_entries = max_entries
+        self.ttl_seconds = ttl_seconds
+        self.hits = self.misses = self.bypassed = self.evicted = self.expired = 0
+        self.saved_ms = 0.0   # сколько ожидания LLM сэкономили попадания
+        self._lock = threading.Lock()
+        self._db: Optional[sqlite3.Connection] = None
+        self._entries = 0  # строк в таблице: считается один раз, дальше ведётся этим процессом
+        self._puts = 0
+        if self.enabled:
+            self.path.parent.mkdir(parents=True, exist_ok=True)
+            self._db = sqlite3.connect(str(self.path), check_same_thread=False, timeout=5.0)
+            self._db.execute("PRAGMA journal_mode=WAL")
+            self._db.execute("PRAGMA synchronous=NORMAL")
+            self._db.execute(
+                "CREATE TABLE IF NOT EXISTS responses ("
+                " key TEXT PRIMARY KEY, model TEXT NOT NULL, response TEXT NOT NULL,"
+                " created REAL NOT NULL, last_used REAL NOT NULL, latency_ms REAL NOT NULL) WITHOUT ROWID"
+            )
+            self._db.execute("CREATE INDEX IF NOT EXISTS responses_lru ON responses(last_used)")
+            self._db.commit()
+            self._entries = self._count()
+
+    @property
+    def enabled(self) -> bool:
+        return self.max_entries > 0
+
+    def _is_expired(self, created: float, now: float) -> bool:
+        return self.ttl_seconds > 0 and now - created > self.ttl_seconds
+
+    def get(self, key: str) -> Optional[str]:
+        """Текст ответа из кэша или None."""
+        if self._db is None:
+            return None
+        now = time.time()
+        with self._lock:
+            row = self._db.execute(
+                "SELECT response, created, latency_ms FROM responses WHERE key = ?", (key,)
+            ).fetchone()
+            if row is not None and self._is_expired(row[1], now):
+                cur = self._db.execute("DELETE FROM responses WHERE key = ?", (key,))
+                self._db.commit()
+                self._entries -= cur.rowcount
+                self.expired += 1
+                row = None
+            if row is None:
+                self.misses += 1
+            else:
+                self._db.execute("UPDATE responses SET last_used = ? WHERE key = ?", (now, key))
+                self._db.commit()
+                self.hits += 1
+                self.saved_ms += row[2]
+        LOOKUPS.inc(result="hit" if row is not None else "miss")
+        return row[0] if row is not None else None
+
+    def put(self, key: str, model: str, response: str, latency_ms: float) -> None:
+        if self._db is None:
+            return
+        now = time.time()
+        with self._lock:
+            cur = self._db.execute(
+                "INSERT OR IGNORE INTO responses VALUES (?, ?, ?, ?, ?, ?)",
+                (key, model, response, now, now, latency_ms),
+            )
+            if cur.rowcount:
+                self._entries += 1
+            else:
+                self._db.execute(
+                    "UPDATE responses SET model = ?, response = ?, created = ?, last_used = ?, latency_ms = ?"
+                    " WHERE key = ?",
+                    (model, response, now, now, latency_ms, key),
+                )
+            self._db.commit()
+            self._puts += 1
+            if self._puts % RESYNC_EVERY == 0:
+                self._entries = self._count()
+            if self._entries > self.max_entries:
+                self._evict(now)
+
+    def record_bypass(self) -> None:
+        with self._lock:
+            self.bypassed += 1
+        LOOKUPS.inc(result="bypass")
+
+    def _count(self) -> int:
+        return self._db.execute("SELECT COUNT(*) FROM responses").fetchone()[0]
+
+    def _evict(self, now: float) -> None:
+        """Удаляет просроченные записи, затем давно не использованные — до EVICT_TO * max_entries."""
+        if self.ttl_seconds > 0:
+            cur = self._db.execute("DELETE FROM responses WHERE created < ?", (now - self.ttl_seconds,))
+            self.expired += cur.rowcount
+        self._entries = self._count()
+        excess = self._entries - int(self.max_entries * EVICT_TO)
+        if excess > 0:
+            cur = self._db.execute(
+                "DELETE FROM responses WHERE key IN (SELECT key FROM responses ORDER BY last_used LIMIT ?)",
+                (excess,),
+            )
+            self._entries -= cur.rowcount
+            self.evicted += cur.rowcount
+        self._db.commit()
+
+    def stats(self) -> dict:
+        with self._lock:
+            entries = self._entries if self._db is not None else 0
+        total = self.hits + self.misses
+        return {
+            "path": str(self.path) if self._db is not None else None,
+            "entries": entries,
+            "max_entries": self.max_entries,
+            "ttl_seconds": self.ttl_seconds,
+            "hits": self.hits,
+            "misses": self.misses,
+            "bypassed": self.bypassed,
+            "hit_rate": round(self.hits / total, 4) if total else 0.0,
+            "expired": self.expired,
+            "evicted": self.evicted,
+            "saved_seconds": round(self.saved_ms / 1000, 1),
+        }
+
+    def close(self) -> None:
+        with self._lock:
+            if self._db is not None:
+                self._db.close()
+                self._db = None
@@ -0,0 +1,212 @@
+"""
+metrics.py — Метрики Prometheus и заголовок Server-Timing (в процессе, без зависимостей).
+
+GET /metrics отдаёт все метрики в текстовом формате Prometheus (0.0.4); никуда
+ничего не отправляется, хватает скрейпера или curl. Метрики свои у каждого
+процесса: при нескольких воркерах uvicorn каждый отдаёт только свои.
+
+  http_requests_total{method,route,status}        счётчик
+  http_requests_in_flight                         gauge
+  http_request_duration_seconds{method,route}     гистограмма
+  stage_duration_seconds{stage}                   гистограмма (embed, faiss_search, llm, json_parse, ...)
+  stage_in_flight{stage}                          gauge
+
+Стадия размечается так: `with stage("llm"): ...` (в sync- и async-коде, в
+любом потоке). Кроме гистограммы, длительность попадает в Server-Timing
+текущего запроса (`embed;dur=12.1, llm;dur=2310.4, total;dur=2330.9`) — по
+одному медленному ответу видно, куда ушло время. Работа вне запроса (старт,
+пакеты RAGBatcher) попадает только в гистограммы. Каждая стадия — ещё и спан
+трассировки (tracing.py): те же имена видны вложенными в файле спанов.
+"""
+
+import threading
+import time
+from contextlib import contextmanager
+from contextvars import ContextVar
+from typing import Iterator, Optional, Sequence
+
+from tracing import Span, span
+
+CONTENT_TYPE = "text/plain; version=0.0.4; charset=utf-8"
+# Секунды: от вектора из кэша (~1 мс) до медленного ответа 120B-модели (~2 мин)
+LATENCY_BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0, 60.0, 120.0)
+
+# Длительности стадий текущего запроса, мс (повторная стадия суммируется)
+_request_stages: ContextVar[Optional[dict[str, float]]] = ContextVar("request_stages", default=None)
+
+
+def _escape(value: str) -> str:
+    return str(value).replace("\\", "\\\\").replace("\n", "\\n").replace('"', '\\"')
+
+
+def _format_labels(names: Sequence[str], values: Sequence[str], extra: str = "") -> str:
+    parts = [f'{n}="{_escape(v)}"' for n, v in zip(names, values)]
+    if extra:
+        parts.append(extra)
+    return "{" + ",".join(parts) + "}" if parts else ""
+
+
+def _format_value(value: float) -> str:
+    return repr(float(value)) if value != int(value) else str(int(value))
+
+
+class _Metric:
+    kind = ""
+
+    def __init__(self, name: str, help_text: str, labels: Sequence[str] = ()):
+        self.name = name
+        self.help = help_text
+        self.labels = tuple(labels)
+        self._lock = threading.Lock()
+        REGISTRY.append(self)
+
+    def _key(self, labels: dict[str, str]) -> tuple[str, ...]:
+        return tuple(str(labels.get(n, "")) for n in self.labels)
+
+    def header(self) -> list:
+        return [f"# HELP {self.name} {self.help}", f"# TYPE {self.name} {self.kind}"]
+
+
+class Counter(_Metric):
+    kind = "counter"
+
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self._values: dict[tuple[str, ...], float] = {}
+
+    def inc(self, amount: float = 1.0, **labels: str) -> None:
+        key = self._key(labels)
+        with self._lock:
+            self._values[key] = self._values.get(key, 0.0) + amount
+
+    def render(self) -> list:
+        with self._lock:
+            items = sorted(self._values.items())
+        return self.header() + [f"{self.name}{_format_labels(self.labels, k)} {_format_value(v)}" for k, v in items]
+
+
+class Gauge(Counter):
+    kind = "gauge"
+
+    def dec(self, amount: float = 1.0, **labels: str) -> None:
+        self.inc(-amount, **labels)
+
+
+class Histogram(_Metric):
+    kind = "histogram"
+
+    def __init__(self, name: str, help_text: str, labels: Sequence[str] = (), buckets: Sequence[float] = LATENCY_BUCKETS):
+        super().__init__(name, help_text, labels)
+        self.buckets = tuple(sorted(buckets))
+        # ключ → (счётчики по корзинам, не накопительные; сумма; число)
+        self._series: dict[tuple[str, ...], list] = {}
+
+    def observe(self, value: float, **labels: str) -> None:
+        key = self._key(labels)
+        i = next((i for i, b in enumerate(self.buckets) if value <= b), len(self.buckets))
+        with self._lock:
+            series = self._series.get(key)
+            if series is None:
+                series = self._series[key] = [[0] * (len(self.buckets) + 1), 0.0, 0]
+            series[0][i] += 1
+            series[1] += value
+            series[2] += 1
+
+    def render(self) -> list:
+        with self._lock:
+            items = sorted((k, (list(s[0]), s[1], s[2])) for k, s in self._series.items())
+        lines = self.header()
+        for key, (counts, total, count) in items:
+            cumulative = 0
+            for bound, n in zip(self.buckets + (float("inf"),), counts):
+                cumulative += n
+                le = "+Inf" if bound == float("inf") else _format_value(bound)
+                labels = _format_labels(self.labels, key, 'le="%s"' % le)
+                lines.append(f"{self.name}_bucket{labels} {cumulative}")
+            lines.append(f"{self.name}_sum{_format_labels(self.labels, key)} {repr(total)}")
+            lines.append(f"{self.name}_count{_format_labels(self.labels, key)} {count}")
+        return lines
+
+
+REGISTRY: list = []
+
+REQUESTS = Counter("http_requests_total", "HTTP-запросы по маршруту и статусу.", ("method", "route", "status"))
+IN_FLIGHT = Gauge("http_requests_in_flight", "HTTP-запросы в обработке.")
+REQUEST_SECONDS = Histogram("http_request_duration_seconds", "Латентность HTTP-запроса.", ("method", "route"))
+STAGE_SECONDS = Histogram("stage_duration_seconds", "Латентность стадии пайплайна.", ("stage",))
+STAGE_IN_FLIGHT = Gauge("stage_in_flight", "Стадии пайплайна, выполняющиеся сейчас.", ("stage",))
+
+
+def render() -> str:
+    lines = []
+    for metric in REGISTRY:
+        lines.extend(metric.render())
+    return "\n".join(lines) + "\n"
+
+
+def observe_stage(name: str, seconds: float) -> None:
+    """Уже замеренная стадия: гистограмма + Server-Timing текущего запроса."""
+    STAGE_SECONDS.observe(seconds, stage=name)
+    stages = _request_stages.get()
+    if stages is not None:
+        stages[name] = stages.get(name, 0.0) + seconds * 1000
+
+
+@contextmanager
+def stage(name: str) -> Iterator[Span]:
+    """Замер стадии; она же — спан трассировки (отдаётся в with для атрибутов)."""
+    STAGE_IN_FLIGHT.inc(stage=name)
+    t0 = time.perf_counter()
+    try:
+        with span(name) as s:
+            yield s
+    finally:
+        STAGE_IN_FLIGHT.dec(stage=name)
+        observe_stage(name, time.perf_counter() - t0)
+
+
+def server_timing(stages: dict[str, float], total_ms: float) -> str:
+    parts = [f"{name};dur={ms:.1f}" for name, ms in stages.items()]
+    parts.append(f"total;dur={total_ms:.1f}")
+    return ", ".join(parts)
+
+
+class MetricsMiddleware:
+    """
+    ASGI-middleware: счётчик и латентность запросов по шаблону маршрута, число
+    запросов в работе и заголовок Server-Timing. Пути из skip (сам скрейп) не считаются.
+    """
+
+    def __init__(self, app, skip: Sequence[str] = ("/metrics",)):
+        self.app = app
+        self.skip = set(skip)
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] != "http" or scope["path"] in self.skip:
+            await self.app(scope, receive, send)
+            return
+        stages: dict[str, float] = {}
+        token = _request_stages.set(stages)
+        status = {"code": 500}
+        t0 = time.perf_counter()
+
+        async def send_with_timing(message):
+            if message["type"] == "http.response.start":
+                status["code"] = message["status"]
+                total_ms = (time.perf_counter() - t0) * 1000
+                headers = list(message.get("headers", []))
+                headers.append((b"server-timing", server_timing(stages, total_ms).encode("latin-1")))
+                message = {**message, "headers": headers}
+            await send(message)
+
+        IN_FLIGHT.inc()
+        try:
+            await self.app(scope, receive, send_with_timing)
+        finally:
+            IN_FLIGHT.dec()
+            _request_stages.reset(token)
+            # Роутер кладёт найденный маршрут в scope; ненайденные пути — под одной меткой
+            route = scope.get("route")
+            label = (getattr(route, "path", "") or "/") if route is not None else "unmatched"
+            REQUESTS.inc(method=scope["method"], route=label, status=str(status["code"]))
+            REQUEST_SECONDS.observe(time.perf_counter() - t0, method=scope["method"], route=label)
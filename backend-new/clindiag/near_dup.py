@@ -0,0 +1,87 @@
+"""
+near_dup.py — Поиск почти одинаковых чанков (MinHash + LSH) перед векторизацией.
+
+В протоколах РК много общих разделов (организационная часть, список
+литературы, таблицы препаратов). Такие чанки схлопываются в один вектор,
+а остальные документы, где встретился тот же текст, записываются к нему
+в список "also_in" хранилища чанков. Индекс меньше, а top-k не забивается
+копиями одного и того же шаблона.
+
+Сходство — оценка коэффициента Жаккара по множествам словесных 3-грамм
+(NUM_PERM хэш-функций вида (a*x + b) mod P). Кандидаты ищутся через LSH
+(BANDS полос по NUM_PERM / BANDS строк) и проверяются по полной сигнатуре.
+
+Использование:
+    dedup = NearDupIndex(threshold=0.9)
+    sig = dedup.signature(text)
+    key = dedup.query(sig)      # ключ уже добавленного похожего чанка или None
+    if key is None:
+        dedup.add(my_key, sig)
+"""
+
+import re
+import zlib
+from typing import Hashable, Optional
+
+import numpy as np
+
+DEFAULT_THRESHOLD = 0.9
+NUM_PERM = 64
+BANDS = 16
+SHINGLE = 3
+_P = 4294967291   # наибольшее простое < 2^32: (a*x + b) не переполняет uint64
+
+_WORD = re.compile(r"\w+", re.UNICODE)
+
+
+class NearDupIndex:
+    """MinHash-сигнатуры + LSH-таблица для поиска почти-дубликатов."""
+
+    def __init__(self, threshold: float = DEFAULT_THRESHOLD, num_perm: int = NUM_PERM, bands: int = BANDS, seed: int = 1):
+        if num_perm % bands:
+            raise ValueError("num_perm должно делиться на bands")
+        self.threshold = threshold
+        self.rows = num_perm // bands
+        self.bands = bands
+        rng = np.random.default_rng(seed)
+        self._a = rng.integers(1, _P, size=num_perm, dtype=np.uint64)
+        self._b = rng.integers(0, _P, size=num_perm, dtype=np.uint64)
+        self._buckets: list[dict[bytes, list]] = [{} for _ in range(bands)]
+        self._sigs: dict[Hashable, np.ndarray] = {}
+
+    def __len__(self) -> int:
+        return len(self._sigs)
+
+    def signature(self, text: str) -> np.ndarray:
+        words = _WORD.findall(text.lower())
+        if len(words) <= SHINGLE:
+            shingles = {" ".join(words)}
+        else:
+            shingles = {" ".join(words[i:i + SHINGLE]) for i in range(len(words) - SHINGLE + 1)}
+        hashes = np.fromiter(
+            (zlib.crc32(s.encode("utf-8")) for s in shingles), dtype=np.uint64, count=len(shingles)
+        )
+        return ((np.outer(self._a, hashes) + self._b[:, None]) % _P).min(axis=1).astype(np.uint32)
+
+    def _band_keys(self, sig: np.ndarray):
+        for band in range(self.bands):
+            yield band, sig[band * self.rows:(band + 1) * self.rows].tobytes()
+
+    def query(self, sig: np.ndarray) -> Optional[Hashable]:
+        """Ключ самого похожего добавленного чанка со сходством >= threshold, иначе None."""
+        best, best_sim = None, self.threshold
+        seen = set()
+        for band, key in self._band_keys(sig):
+            for cand in self._buckets[band].get(key, ()):
+                if cand in seen:
+                    continue
+                seen.add(cand)
+                sim = float(np.mean(self._sigs[cand] == sig))
+                if sim >= best_sim:
+                    best, best_sim = cand, sim
+        return best
+
+    def add(self, key: Hashable, sig: np.ndarray) -> None:
+        self._sigs[key] = sig
+        for band, band_key in self._band_keys(sig):
+            self._buckets[band].setdefault(band_key, []).append(key)
@@ -0,0 +1,264 @@
+"""
+onnx_encoder.py — Кодировщик запросов на ONNX Runtime (опционально int8).
+
+SentenceTransformer на CPU — заметная и постоянная часть времени /diagnose,
+хотя кодируется всего один короткий запрос. OnnxEncoder экспортирует
+трансформер модели в ONNX (пулинг и нормировка считаются в numpy по
+конфигурации самой sentence-transformers модели), при желании квантует веса
+в int8 (dynamic quantization) и выполняет его в ONNX Runtime с заданным
+числом intra-op потоков.
+
+Бэкенды (RAG_ENCODER):
+  torch      — SentenceTransformer, как раньше
+  onnx       — ONNX Runtime, float32
+  onnx-int8  — ONNX Runtime, веса int8
+
+Экспорт делается один раз и кэшируется:
+  <cache_dir>/<модель>/model.onnx, model.int8.onnx, encoder.json + токенизатор
+При загрузке векторы ONNX сверяются с исходной моделью на PARITY_TEXTS:
+если минимальный косинус ниже порога — ParityError, и вызывающий код
+остаётся на PyTorch.
+
+Зависимости: onnxruntime; для экспорта — torch (уже есть у sentence-transformers).
+
+Использование:
+    encoder = load_query_encoder(model_name, backend="onnx-int8")
+    vecs = encoder.encode(["кашель, температура"], normalize_embeddings=True)
+"""
+
+import inspect
+import json
+import os
+from pathlib import Path
+from typing import Optional
+
+import numpy as np
+
+BACKENDS = ("torch", "onnx", "onnx-int8")
+DEFAULT_CACHE_DIR = "./.onnx_cache"
+ONNX_OPSET = 14
+# Минимальный косинус между векторами ONNX и PyTorch на PARITY_TEXTS
+PARITY_MIN_COSINE = {"onnx": 0.9999, "onnx-int8": 0.98}
+PARITY_TEXTS = (
+    "кашель, температура 38.5, одышка",
+    "боль в грудной клетке при физической нагрузке, иррадиирует в левую руку",
+    "ребёнок 3 лет, сыпь на коже, зуд, после приёма амоксициллина",
+    "головная боль, тошнота, светобоязнь, ригидность затылочных мышц",
+    "жажда, частое мочеиспускание, глюкоза натощак 9 ммоль/л",
+)
+
+
+class ParityError(RuntimeError):
+    """Векторы ONNX слишком далеки от исходной модели."""
+
+
+def default_threads() -> int:
+    """ONNX_THREADS или число ядер (не больше 4: один короткий запрос дальше не масштабируется)."""
+    env = os.getenv("ONNX_THREADS", "").strip()
+    return int(env) if env else max(1, min(4, os.cpu_count() or 1))
+
+
+def _model_dir(cache_dir: str | Path, model_name: str) -> Path:
+    return Path(cache_dir) / model_name.replace("/", "__")
+
+
+def _pooling_mode(st_model) -> str:
+    for module in st_model:
+        if type(module).__name__ == "Pooling":
+            # sentence-transformers < 5: get_pooling_mode_str(), новее — атрибут pooling_mode
+            if hasattr(module, "get_pooling_mode_str"):
+                mode = module.get_pooling_mode_str()
+            else:
+                mode = module.pooling_mode
+            if mode not in ("cls", "mean", "max"):
+                raise ValueError(f"Пулинг {mode} не поддерживается ONNX-кодировщиком")
+            return mode
+    raise ValueError("В модели нет слоя Pooling")
+
+
+def export_model(st_model, model_name: str, out_dir: str | Path, quantize: bool = True) -> Path:
+    """Экспортирует трансформер SentenceTransformer в out_dir (+ int8-копию при quantize)."""
+    import torch
+
+    out_dir = Path(out_dir)
+    out_dir.mkdir(parents=True, exist_ok=True)
+    transformer = st_model[0]
+    auto_model = transformer.auto_model.eval()
+    tokenizer = transformer.tokenizer
+
+    dummy = tokenizer(["пример запроса"], return_tensors="pt")
+    input_names = [name for name in ("input_ids", "attention_mask", "token_type_ids") if name in dummy]
+
+    class _Hidden(torch.nn.Module):
+        def __init__(self):
+            super().__init__()
+            self.model = auto_model
+
+        def forward(self, *inputs):
+            return self.model(**dict(zip(input_names, inputs))).last_hidden_state
+
+    axes = {name: {0: "batch", 1: "seq"} for name in [*input_names, "last_hidden_state"]}
+    kwargs = {}
+    if "dynamo" in inspect.signature(torch.onnx.export).parameters:
+        kwargs["dynamo"] = False   # TorchScript-экспорт: стабильные dynamic_axes
+    print(f"Экспорт {model_name} в ONNX: {out_dir}")
+    with torch.no_grad():
+        torch.onnx.export(
+            _Hidden(),
+            tuple(dummy[name] for name in input_names),
+            str(out_dir / "model.onnx"),
+            input_names=input_names,
+            output_names=["last_hidden_state"],
+            dynamic_axes=axes,
+            opset_version=ONNX_OPSET,
+            do_constant_folding=True,
+            **kwargs,
+        )
+    tokenizer.save_pretrained(str(out_dir))
+    with open(out_dir / "encoder.json", "w", encoding="utf-8") as f:
+        json.dump(
+            {
+                "model": model_name,
+                "pooling": _pooling_mode(st_model),
+                "normalize": any(type(m).__name__ == "Normalize" for m in st_model),
+                "max_seq_length": st_model.max_seq_length,
+                "inputs": input_names,
+            },
+            f,
+            ensure_ascii=False,
+            indent=2,
+        )
+    if quantize:
+        quantize_model(out_dir)
+    return out_dir
+
+
+def quantize_model(model_dir: str | Path) -> Path:
+    """Dynamic quantization весов в int8: model.onnx → model.int8.onnx."""
+    from onnxruntime.quantization import QuantType, quantize_dynamic
+
+    model_dir = Path(model_dir)
+    target = model_dir / "model.int8.onnx"
+    print(f"Квантование в int8: {target}")
+    quantize_dynamic(str(model_dir / "model.onnx"), str(target), weight_type=QuantType.QInt8)
+    return target
+
+
+class OnnxEncoder:
+    """
+    Экспортированная модель под ONNX Runtime. encode() совместим с
+    SentenceTransformer.encode, embed_query()/embed_documents() — с
+    langchain Embeddings, поэтому подставляется вместо любого из них.
+    """
+
+    def __init__(self, model_dir: str | Path, quantized: bool = False, threads: Optional[int] = None):
+        import onnxruntime as ort
+        from transformers import AutoTokenizer
+
+        model_dir = Path(model_dir)
+        with open(model_dir / "encoder.json", encoding="utf-8") as f:
+            config = json.load(f)
+        self.model_name: str = config["model"]
+        self.pooling: str = config["pooling"]
+        self.normalize: bool = config["normalize"]
+        self.max_seq_length: int = config["max_seq_length"]
+        self.input_names: list[str] = config["inputs"]
+        self.backend = "onnx-int8" if quantized else "onnx"
+        self.threads = threads or default_threads()
+        self.parity_cosine: Optional[float] = None
+
+        options = ort.SessionOptions()
+        options.intra_op_num_threads = self.threads
+        options.inter_op_num_threads = 1
+        options.execution_mode = ort.ExecutionMode.ORT_SEQUENTIAL
+        options.graph_optimization_level = ort.GraphOptimizationLevel.ORT_ENABLE_ALL
+        path = model_dir / ("model.int8.onnx" if quantized else "model.onnx")
+        self.session = ort.InferenceSession(str(path), options, providers=["CPUExecutionProvider"])
+        self.tokenizer = AutoTokenizer.from_pretrained(str(model_dir))
+
+    def _pool(self, hidden: np.ndarray, mask: np.ndarray) -> np.ndarray:
+        if self.pooling == "cls":
+            return hidden[:, 0]
+        mask = mask[..., None].astype(hidden.dtype)
+        if self.pooling == "max":
+            return np.where(mask > 0, hidden, -1e9).max(axis=1)
+        return (hidden * mask).sum(axis=1) / np.clip(mask.sum(axis=1), 1e-9, None)
+
+    def encode(
+        self,
+        sentences,
+        batch_size: int = 32,
+        convert_to_numpy: bool = True,
+        normalize_embeddings: bool = False,
+        **_,
+    ) -> np.ndarray:
+        single = isinstance(sentences, str)
+        texts = [sentences] if single else list(sentences)
+        out = []
+        for start in range(0, len(texts), batch_size):
+            enc = self.tokenizer(
+                texts[start:start + batch_size],
+                padding=True,
+                truncation=True,
+                max_length=self.max_seq_length,
+                return_tensors="np",
+            )
+            feeds = {name: enc[name].astype("int64") for name in self.input_names}
+            hidden = self.session.run(None, feeds)[0]
+            out.append(self._pool(hidden, enc["attention_mask"]))
+        vectors = np.concatenate(out).astype("float32") if out else np.zeros((0, 0), dtype="float32")
+        if self.normalize or normalize_embeddings:
+            vectors /= np.clip(np.linalg.norm(vectors, axis=1, keepdims=True), 1e-12, None)
+        return vectors[0] if single else vectors
+
+    def embed_query(self, text: str) -> list[float]:
+        return self.encode([text])[0].tolist()
+
+    def embed_documents(self, texts: list[str]) -> list[list[float]]:
+        return self.encode(texts).tolist()
+
+    def get_sentence_embedding_dimension(self) -> int:
+        return int(self.encode(["проверка"]).shape[1])
+
+
+def check_parity(reference, encoder: OnnxEncoder, min_cosine: float, texts=PARITY_TEXTS) -> float:
+    """Минимальный косинус между векторами reference и encoder; ниже min_cosine — ParityError."""
+    expected = reference.encode(list(texts), convert_to_numpy=True, normalize_embeddings=True)
+    actual = encoder.encode(list(texts), normalize_embeddings=True)
+    cosine = float((np.asarray(expected, dtype="float32") * actual).sum(axis=1).min())
+    if cosine < min_cosine:
+        raise ParityError(f"{encoder.backend}: минимальный косинус {cosine:.5f} < {min_cosine}")
+    encoder.parity_cosine = cosine
+    return cosine
+
+
+def load_query_encoder(
+    model_name: str,
+    backend: str = "torch",
+    cache_dir: str | Path = DEFAULT_CACHE_DIR,
+    threads: Optional[int] = None,
+):
+    """
+    SentenceTransformer (backend="torch") или OnnxEncoder, прошедший сверку с
+    исходной моделью. Экспорт выполняется при первом запуске; исключения
+    (нет onnxruntime, ParityError) пробрасываются — решение о fallback за вызывающим.
+    """
+    from sentence_transformers import SentenceTransformer
+
+    if backend not in BACKENDS:
+        raise ValueError(f"Неизвестный бэкенд кодировщика: {backend} (доступны: {', '.join(BACKENDS)})")
+    reference = SentenceTransformer(model_name, device="cpu")
+    if backend == "torch":
+        return reference
+
+    quantized = backend == "onnx-int8"
+    model_dir = _model_dir(cache_dir, model_name)
+    if not (model_dir / "encoder.json").exists():
+        export_model(reference, model_name, model_dir, quantize=quantized)
+    elif quantized and not (model_dir / "model.int8.onnx").exists():
+        quantize_model(model_dir)
+
+    encoder = OnnxEncoder(model_dir, quantized, threads)
+    cosine = check_parity(reference, encoder, PARITY_MIN_COSINE[backend])
+    print(f"Кодировщик {backend} ({encoder.threads} потоков): сверка с PyTorch пройдена, min cos {cosine:.5f}")
+    return encoder
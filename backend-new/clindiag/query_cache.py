@@ -0,0 +1,180 @@
+"""
+query_cache.py — LRU-кэш векторов запросов (в памяти, с TTL).
+
+Врачи и прогоны оценки постоянно присылают одни и те же анамнезы, и каждый
+раз запрос кодируется заново. QueryEmbeddingCache хранит векторы последних
+запросов: ключ — (имя модели, нормализованный текст запроса), размер
+ограничен max_entries (вытесняются давно не использованные), каждая запись
+живёт не дольше ttl_seconds.
+
+Нормализация та же, что у кэша чанков (embedding_cache.normalize_text):
+NFC + схлопывание пробелов. Регистр не приводится — модель его различает,
+и из кэша должен приходить ровно тот вектор, который вернула бы модель.
+
+При заданном path кэш переживает рестарт: load() при создании, save() при
+остановке сервера (запись атомарная, просроченные записи не сохраняются).
+
+Использование:
+    cache = QueryEmbeddingCache(model_name, max_entries=1024, ttl_seconds=3600)
+    vec = cache.get_or_compute(query, lambda q: model.encode([q], normalize_embeddings=True)[0])
+    print(cache.stats())
+"""
+
+import os
+import pickle
+import threading
+import time
+from collections import OrderedDict
+from pathlib import Path
+from typing import Callable, Optional
+
+import numpy as np
+
+from embedding_cache import normalize_text
+
+DEFAULT_MAX_ENTRIES = 1024
+DEFAULT_TTL_SECONDS = 3600.0
+
+
+class QueryEmbeddingCache:
+    """Потокобезопасный LRU+TTL кэш векторов запросов."""
+
+    def __init__(
+        self,
+        model_name: str,
+        max_entries: int = DEFAULT_MAX_ENTRIES,
+        ttl_seconds: float = DEFAULT_TTL_SECONDS,
+        path: str | Path | None = None,
+    ):
+        """max_entries=0 отключает кэш; ttl_seconds=0 — без ограничения по времени."""
+        self.model_name = model_name
+        self.max_entries = max_entries
+        self.ttl_seconds = ttl_seconds
+        self.path = Path(path) if path else None
+        self.hits = 0
+        self.misses = 0
+        self.evicted = 0
+        self.expired = 0
+        # ключ → (время записи по time.time(), вектор); порядок — от давно использованных к свежим
+        self._entries: OrderedDict[tuple[str, str], tuple[float, np.ndarray]] = OrderedDict()
+        self._lock = threading.Lock()
+        if self.path is not None and self.enabled:
+            self.load()
+
+    @classmethod
+    def from_env(cls, model_name: str) -> "QueryEmbeddingCache":
+        """RAG_QUERY_CACHE_SIZE, RAG_QUERY_CACHE_TTL (сек.), RAG_QUERY_CACHE_PATH (пусто — только в памяти)."""
+        return cls(
+            model_name,
+            max_entries=int(os.getenv("RAG_QUERY_CACHE_SIZE", str(DEFAULT_MAX_ENTRIES))),
+            ttl_seconds=float(os.getenv("RAG_QUERY_CACHE_TTL", str(DEFAULT_TTL_SECONDS))),
+            path=os.getenv("RAG_QUERY_CACHE_PATH", "").strip() or None,
+        )
+
+    @property
+    def enabled(self) -> bool:
+        return self.max_entries > 0
+
+    def _key(self, text: str) -> tuple[str, str]:
+        return self.model_name, normalize_text(text)
+
+    def _is_expired(self, stored_at: float, now: float) -> bool:
+        return self.ttl_seconds > 0 and now - stored_at > self.ttl_seconds
+
+    def get(self, text: str) -> Optional[np.ndarray]:
+        """Вектор запроса (только для чтения) или None."""
+        if not self.enabled:
+            return None
+        key = self._key(text)
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is not None and self._is_expired(entry[0], time.time()):
+                del self._entries[key]
+                self.expired += 1
+                entry = None
+            if entry is None:
+                self.misses += 1
+                return None
+            self._entries.move_to_end(key)
+            self.hits += 1
+            return entry[1]
+
+    def put(self, text: str, vector) -> np.ndarray:
+        vec = np.array(vector, dtype="float32")
+        vec.setflags(write=False)
+        if not self.enabled:
+            return vec
+        key = self._key(text)
+        with self._lock:
+            self._entries[key] = (time.time(), vec)
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.max_entries:
+                self._entries.popitem(last=False)
+                self.evicted += 1
+        return vec
+
+    def get_or_compute(self, text: str, compute: Callable[[str], object]) -> np.ndarray:
+        """Вектор из кэша, иначе compute(text) с сохранением результата."""
+        vec = self.get(text)
+        if vec is None:
+            vec = self.put(text, compute(text))
+        return vec
+
+    def clear(self) -> None:
+        with self._lock:
+            self._entries.clear()
+
+    def stats(self) -> dict:
+        total = self.hits + self.misses
+        return {
+            "enabled": self.enabled,
+            "entries": len(self._entries),
+            "max_entries": self.max_entries,
+            "ttl_seconds": self.ttl_seconds,
+            "hits": self.hits,
+            "misses": self.misses,
+            "hit_rate": round(self.hits / total, 4) if total else 0.0,
+            "evicted": self.evicted,
+            "expired": self.expired,
+            "path": str(self.path) if self.path else None,
+        }
+
+    def load(self) -> int:
+        """Читает записи этой модели из path, пропуская просроченные. Возвращает их число."""
+        if self.path is None or not self.path.exists():
+            return 0
+        try:
+            with open(self.path, "rb") as f:
+                rows = pickle.load(f)
+        except Exception as e:
+            print(f"  [!] Кэш запросов {self.path} не прочитан: {e}")
+            return 0
+        now = time.time()
+        loaded = 0
+        with self._lock:
+            # в файле — от давно использованных к свежим, поэтому хвост важнее
+            for model, text, stored_at, vec in rows[-self.max_entries:]:
+                if model != self.model_name or self._is_expired(stored_at, now):
+                    continue
+                vec = np.frombuffer(vec, dtype="float32")
+                self._entries[(model, text)] = (stored_at, vec)
+                loaded += 1
+        return loaded
+
+    def save(self) -> int:
+        """Атомарно пишет непросроченные записи в path. Возвращает их число."""
+        if self.path is None or not self.enabled:
+            return 0
+        now = time.time()
+        with self._lock:
+            rows = [
+                (model, text, stored_at, vec.tobytes())
+                for (model, text), (stored_at, vec) in self._entries.items()
+                if not self._is_expired(stored_at, now)
+            ]
+        self.path.parent.mkdir(parents=True, exist_ok=True)
+        tmp = self.path.with_name(self.path.name + ".tmp")
+        with open(tmp, "wb") as f:
+            pickle.dump(rows, f, protocol=pickle.HIGHEST_PROTOCOL)
+        os.replace(tmp, self.path)
+        return len(rows)
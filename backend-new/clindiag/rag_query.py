@@ -8,14 +8,95 @@ rag_query.py — Поиск по FAISS-индексу клинических п
 
 Использование из командной строки:
     python rag_query.py "кашель, температура 38.5, одышка" --top-k 5
+    python rag_query.py --queries-file cases.txt --aggregate   # пакетный поиск, JSON
+    python rag_query.py --queries-file cases.txt --bench       # задержка: dense vs hybrid
 """
 
 import argparse
+import hashlib
 import json
+import os
 import pickle
+import sys
+import time
+from datetime import datetime, timezone
 from pathlib import Path
 from typing import Optional
 
+from ann_index import read_index, search_subset, subset_vectors
+from bm25_index import BM25_DIRNAME, BM25Index, rrf_fuse
+from chunk_store import STORE_DIRNAME, ChunkStore, InMemoryChunks
+from metrics import stage
+from query_cache import QueryEmbeddingCache
+from tracing import current_span, traced
+
+
+WARMUP_QUERY = "кашель, температура 38.5, одышка"
+# Размер пакета модели в embed_queries: сотни запросов одним пакетом раздувают
+# паддинг и память под attention, выигрыша уже нет
+ENCODE_BATCH_SIZE = 64
+
+# Оценка протокола по его чанкам (search_for_diagnosis):
+#   max     — лучший чанк (как раньше)
+#   sum     — сумма top-m лучших чанков протокола
+#   softmax — сглаженный максимум: T * log(sum(exp(score / T)))
+AGGREGATORS = ("max", "sum", "softmax")
+DIAGNOSIS_DEPTH = 4   # начальная глубина: top_k * 4 чанков, дальше удваивается
+HYBRID_DEPTH = 2      # гибридный режим: FAISS и BM25 дают по k * 2 кандидатов в RRF
+
+
+def aggregate_protocols(
+    docs,
+    scores,
+    method: str = "max",
+    top_m: int = 3,
+    temperature: float = 0.05,
+):
+    """
+    docs, scores — пары (документ, оценка чанка), scores по убыванию.
+    Возвращает (документы, их оценки, индекс лучшей пары документа) по убыванию
+    оценки; при равенстве выше тот, чей лучший чанк нашёлся раньше.
+    """
+    import numpy as np
+
+    if method not in AGGREGATORS:
+        raise ValueError(f"Неизвестный агрегатор: {method} (доступны: {', '.join(AGGREGATORS)})")
+    docs = np.asarray(docs, dtype=np.int64)
+    scores = np.asarray(scores, dtype=np.float64)
+    uniq, first, inverse = np.unique(docs, return_index=True, return_inverse=True)
+    best = scores[first]   # первая пара документа — лучшая, scores убывают
+    if method == "max":
+        agg = best
+    elif method == "sum":
+        order = np.argsort(inverse, kind="stable")   # внутри документа — по убыванию score
+        grouped = inverse[order]
+        rank = np.arange(len(order)) - np.searchsorted(grouped, grouped)
+        keep = order[rank < top_m]
+        agg = np.bincount(inverse[keep], weights=scores[keep], minlength=len(uniq))
+    else:
+        weights = np.exp((scores - best[inverse]) / temperature)
+        agg = best + temperature * np.log(np.bincount(inverse, weights=weights, minlength=len(uniq)))
+    order = np.lexsort((first, -agg))
+    return uniq[order], agg[order], first[order]
+
+
+def _env_flag(name: str, default: bool) -> bool:
+    return os.getenv(name, "1" if default else "0").strip().lower() in ("1", "true", "yes", "on")
+
+
+def index_version(index_dir: str | Path) -> str:
+    """
+    Короткий идентификатор сборки индекса: хэш размеров и mtime файлов
+    индекса и манифеста хранилища. Меняется при каждой пересборке.
+    """
+    index_dir = Path(index_dir)
+    h = hashlib.sha1()
+    for path in (index_dir / "protocols.faiss", index_dir / STORE_DIRNAME / "manifest.json", index_dir / "metadata.pkl"):
+        if path.exists():
+            st = path.stat()
+            h.update(f"{path.name}:{st.st_size}:{st.st_mtime_ns};".encode())
+    return h.hexdigest()[:12]
+
 
 class RAGRetriever:
     """
@@ -23,14 +104,38 @@ class RAGRetriever:
     по клиническим протоколам.
     """
 
-    def __init__(self, index_dir: str = "./index"):
+    def __init__(
+        self,
+        index_dir: str = "./index",
+        mmap: Optional[bool] = None,
+        prefetch: Optional[bool] = None,
+        allow_pickle: bool = True,
+    ):
+        """
+        mmap / prefetch — см. ann_index.read_index; по умолчанию берутся из
+        RAG_INDEX_MMAP (вкл.) и RAG_INDEX_PREFETCH (выкл.).
+        allow_pickle=False — не читать metadata.pkl индексов старого формата
+        (для путей, пришедших извне, например /admin/reload-index).
+        """
         self.index_dir = Path(index_dir)
-        self._load()
-
-    def _load(self):
-        import faiss
-
+        self.allow_pickle = allow_pickle
+        self.mmap = _env_flag("RAG_INDEX_MMAP", True) if mmap is None else mmap
+        self.prefetch = _env_flag("RAG_INDEX_PREFETCH", False) if prefetch is None else prefetch
+        # Агрегация чанков в протоколы для search_for_diagnosis
+        self.aggregator = os.getenv("RAG_AGGREGATOR", "max").strip().lower()
+        self.agg_top_m = int(os.getenv("RAG_AGG_TOP_M", "3"))
+        self.agg_temperature = float(os.getenv("RAG_AGG_TEMPERATURE", "0.05"))
+        self.agg_budget_ms = float(os.getenv("RAG_AGG_BUDGET_MS", "30"))
+        if self.aggregator not in AGGREGATORS:
+            raise ValueError(f"RAG_AGGREGATOR={self.aggregator}: доступны {', '.join(AGGREGATORS)}")
+        # Гибридный поиск: BM25 (bm25_index.py) рядом с FAISS, слияние через RRF
+        self.hybrid_depth = int(os.getenv("RAG_HYBRID_DEPTH", str(HYBRID_DEPTH)))
+        self.hybrid_budget_ms = float(os.getenv("RAG_HYBRID_BUDGET_MS", "5"))
+        self._load(_env_flag("RAG_HYBRID", False))
+
+    def _load(self, hybrid: bool):
         index_path = self.index_dir / "protocols.faiss"
+        store_path = self.index_dir / STORE_DIRNAME
         meta_path = self.index_dir / "metadata.pkl"
 
         if not index_path.exists():
@@ -40,28 +145,147 @@ class RAGRetriever:
             )
 
         print(f"Загрузка FAISS-индекса из {index_path}...")
-        self.index = faiss.read_index(str(index_path))
-
-        with open(meta_path, "rb") as f:
-            data = pickle.load(f)
-
-        self.texts = data["texts"]
-        self.metas = data["metas"]
-        self.model_name = data.get("model", "paraphrase-multilingual-MiniLM-L12-v2")
+        t0 = time.perf_counter()
+        self.version = index_version(self.index_dir)
+        self.index = read_index(index_path, mmap=self.mmap, prefetch=self.prefetch)
+
+        if store_path.exists():
+            # Колоночное хранилище: открывается через mmap, строки читаются по запросу
+            self.chunks = ChunkStore(store_path)
+        elif meta_path.exists():
+            # Индекс старого формата (metadata.pkl целиком в памяти)
+            if not self.allow_pickle:
+                raise ValueError(
+                    f"Индекс старого формата ({meta_path}, pickle) здесь не загружается: "
+                    "пересоберите его через build_index.py"
+                )
+            with open(meta_path, "rb") as f:
+                data = pickle.load(f)
+            self.chunks = InMemoryChunks(data["texts"], data["metas"], data.get("model"))
+        else:
+            raise FileNotFoundError(f"Метаданные индекса не найдены: {store_path} или {meta_path}")
+
+        self.model_name = self.chunks.model_name or "paraphrase-multilingual-MiniLM-L12-v2"
+        # ICD → чанки (icd_index.py): фильтр сужает поиск, а не отсеивает результаты
+        self.icd_index = self.chunks.icd_index()
+        self.bm25 = None
+        bm25_path = self.index_dir / BM25_DIRNAME
+        if hybrid and bm25_path.exists():
+            try:
+                self.bm25 = BM25Index(bm25_path)
+            except (ImportError, ValueError) as e:
+                print(f"  [!] BM25-индекс не загружен, только плотный поиск: {e}")
+        self.load_ms = int((time.perf_counter() - t0) * 1000)
+        self.loaded_at = datetime.now(timezone.utc).isoformat(timespec="seconds")
 
         print(f"  Векторов в индексе: {self.index.ntotal}")
         print(f"  Модель эмбеддингов: {self.model_name}")
+        print(f"  Поиск: {'гибридный (FAISS + BM25, RRF)' if self.hybrid else 'плотный (FAISS)'}")
 
         # Загружаем модель только при первом поиске (lazy loading)
         self._model = None
+        self.encoder = os.getenv("RAG_ENCODER", "torch").strip().lower()
+        # Векторы недавних запросов (RAG_QUERY_CACHE_*, см. query_cache.py)
+        self.query_cache = QueryEmbeddingCache.from_env(self.model_name)
+
+    @property
+    def hybrid(self) -> bool:
+        return self.bm25 is not None
 
     def _get_model(self):
+        """
+        Кодировщик запросов. RAG_ENCODER=onnx | onnx-int8 — ONNX Runtime (см.
+        onnx_encoder.py, кэш экспорта в RAG_ENCODER_CACHE); если экспорт или
+        сверка с PyTorch не удались — обычный SentenceTransformer.
+        """
         if self._model is None:
+            backend = self.encoder
+            if backend != "torch":
+                try:
+                    from onnx_encoder import DEFAULT_CACHE_DIR, load_query_encoder
+
+                    self._model = load_query_encoder(
+                        self.model_name, backend, os.getenv("RAG_ENCODER_CACHE", DEFAULT_CACHE_DIR)
+                    )
+                    return self._model
+                except Exception as e:
+                    print(f"  [!] Кодировщик {backend} недоступен ({e}); используется PyTorch")
             from sentence_transformers import SentenceTransformer
             print(f"Загрузка модели: {self.model_name}")
             self._model = SentenceTransformer(self.model_name)
         return self._model
 
+    def use_torch_encoder(self) -> None:
+        """Переключает кодировщик на PyTorch (ONNX-модель загрузилась, но не работает)."""
+        self.encoder = "torch"
+        self._model = None
+
+    @property
+    def encoder_backend(self) -> Optional[str]:
+        """torch | onnx | onnx-int8; None — модель ещё не загружена."""
+        if self._model is None:
+            return None
+        return getattr(self._model, "backend", "torch")
+
+    def reuse_model(self, other: Optional["RAGRetriever"]) -> None:
+        """
+        Берёт у другого ретривера уже загруженную модель эмбеддингов и кэш
+        векторов запросов, если модель та же (векторы от индекса не зависят).
+        """
+        if other is not None and other.model_name == self.model_name:
+            if other._model is not None:
+                self._model = other._model
+            self.query_cache = other.query_cache
+
+    def embed_query(self, query: str):
+        """L2-нормированный вектор запроса (float32, только для чтения), через кэш."""
+        return self.embed_queries([query])[0]
+
+    def embed_queries(self, queries: list[str]):
+        """
+        Матрица (n, d) L2-нормированных векторов запросов. Запросы из кэша не
+        кодируются, остальные — одним вызовом модели (пакетами по ENCODE_BATCH_SIZE).
+        """
+        import numpy as np
+
+        vecs = [self.query_cache.get(q) for q in queries]
+        missing = list(dict.fromkeys(q for q, v in zip(queries, vecs) if v is None))
+        if missing:
+            model = self._get_model()
+            with stage("embed"):
+                encoded = model.encode(
+                    missing,
+                    batch_size=ENCODE_BATCH_SIZE,
+                    convert_to_numpy=True,
+                    normalize_embeddings=True,
+                )
+            fresh = {q: self.query_cache.put(q, v) for q, v in zip(missing, encoded)}
+            vecs = [fresh[q] if v is None else v for q, v in zip(queries, vecs)]
+        if not vecs:
+            return np.zeros((0, self.index.d), dtype="float32")
+        return np.vstack(vecs).astype("float32")
+
+    def warm_up(self, query: str = WARMUP_QUERY) -> int:
+        """
+        Проверяет индекс перед вводом в работу: число векторов совпадает с
+        хранилищем чанков, размерность — с моделью, тестовый запрос находит
+        протоколы. Заодно загружает модель и прогревает страницы индекса.
+        Возвращает время тестового запроса в мс; при ошибке — ValueError.
+        """
+        if self.index.ntotal == 0:
+            raise ValueError("Индекс пуст")
+        if self.index.ntotal != len(self.chunks):
+            raise ValueError(
+                f"Индекс ({self.index.ntotal} векторов) не соответствует хранилищу чанков ({len(self.chunks)})"
+            )
+        dim = self._get_model().encode(["проверка"], convert_to_numpy=True).shape[1]
+        if dim != self.index.d:
+            raise ValueError(f"Размерность индекса {self.index.d} ≠ размерности модели {self.model_name} ({dim})")
+        t0 = time.perf_counter()
+        if not self.search_for_diagnosis(query, top_k=3):
+            raise ValueError("Тестовый запрос не вернул ни одного протокола")
+        return int((time.perf_counter() - t0) * 1000)
+
     def search(
         self,
         query: str,
@@ -74,106 +298,307 @@ class RAGRetriever:
         Args:
             query:      Текст запроса (симптомы пациента, диагноз, ключевые слова).
             top_k:      Количество возвращаемых результатов.
-            icd_filter: Фильтрация по ICD-кодам (если задано, возвращает только
-                        чанки из протоколов с этими кодами).
+            icd_filter: Фильтрация по ICD-кодам: поиск идёт только среди чанков
+                        протоколов с этими кодами (3-символьная рубрика, напр.
+                        J18, включает все J18.x). Результатов — полные top_k,
+                        если столько подходящих чанков есть.
 
         Returns:
             Список словарей:
               - rank:      порядковый номер
-              - score:     косинусная схожесть [0..1]
+              - score:     косинусная схожесть [0..1] (и в гибридном режиме)
+              - rrf_score: только в гибридном режиме — RRF-оценка [0..1], по ней
+                           упорядочена выдача (1 — первое место и в FAISS, и в BM25)
               - text:      текст чанка
               - doc_id:    идентификатор документа
               - source:    имя исходного файла
               - title:     название протокола
               - icd_codes: ICD-10 коды протокола
               - chunk_id:  номер чанка в документе
+              - also_in:   другие документы с почти таким же чанком
+                           (doc_id, source, title, icd_codes), см. near_dup.py
         """
-        import numpy as np
+        return self.search_batch([query], top_k, icd_filter)[0]
 
-        model = self._get_model()
+    @traced()
+    def search_batch(
+        self,
+        queries: list[str],
+        top_k: int = 5,
+        icd_filter: Optional[list[str]] = None,
+    ) -> list[list[dict]]:
+        """
+        search() для многих запросов сразу: все запросы кодируются одним вызовом
+        модели, FAISS получает одну матрицу (n, d). Результаты — в порядке queries,
+        формат как у search().
+        """
+        queries = list(queries)
+        if not queries:
+            return []
+
+        scores, indices, rrf = self._search_vectors(self.embed_queries(queries), top_k, icd_filter, queries)
+        results = [
+            self._collect(scores[row], indices[row], None if rrf is None else rrf[row])
+            for row in range(len(queries))
+        ]
+        span = current_span()
+        span.set("rag.queries", len(queries))
+        span.set("rag.top_k", top_k)
+        span.set("rag.hybrid", self.bm25 is not None)
+        span.set("rag.icd_filter", list(icd_filter) if icd_filter else None)
+        span.set("rag.chunks", sum(len(r) for r in results))
+        return results
 
-        # Векторизуем запрос
-        q_vec = model.encode(
-            [query],
-            convert_to_numpy=True,
-            normalize_embeddings=True,
-        ).astype("float32")
+    def _search_vectors(
+        self,
+        q_vecs,
+        k: int,
+        icd_filter: Optional[list[str]] = None,
+        queries: Optional[list[str]] = None,
+    ):
+        """
+        (scores, ids, rrf) для готовых векторов запросов: scores — косинусы FAISS.
+        С текстами queries и загруженным BM25 — гибридный поиск (_fuse): ids
+        упорядочены по RRF-оценкам rrf; иначе только FAISS и rrf = None.
+        """
+        # Только чанки протоколов с этими кодами (в т.ч. через also_in)
+        allowed = self.icd_index.allowed(icd_filter) if icd_filter else None
+        hybrid = self.bm25 is not None and queries is not None
+        depth = min(k * self.hybrid_depth, self.index.ntotal) if hybrid else k
+        with stage("faiss_search"):
+            if allowed is not None:
+                scores, ids = search_subset(self.index, q_vecs, depth, allowed)
+            else:
+                scores, ids = self.index.search(q_vecs, depth)
+        if not hybrid:
+            return scores, ids, None
+        with stage("bm25"):
+            return self._fuse(queries, q_vecs, scores, ids, k, depth, allowed)
+
+    def _fuse(self, queries: list[str], q_vecs, dense_scores, dense_ids, k: int, depth: int, allowed=None):
+        """
+        BM25 для каждого запроса (не дольше hybrid_budget_ms) + RRF с выдачей
+        FAISS. Матрицы (n, k) в формате index.search: недостающее — id -1;
+        scores — косинусы найденных чанков, rrf — оценки слияния.
+        """
+        import numpy as np
 
-        # Ищем с запасом, чтобы было что фильтровать
-        search_k = top_k * 10 if icd_filter else top_k
-        scores, indices = self.index.search(q_vec, search_k)
+        scores = np.zeros((len(queries), k), dtype="float32")
+        rrf = np.zeros((len(queries), k), dtype="float32")
+        ids = np.full((len(queries), k), -1, dtype="int64")
+        for row, (query, dense_row) in enumerate(zip(queries, dense_ids)):
+            _, sparse_row = self.bm25.search(query, depth, allowed, self.hybrid_budget_ms)
+            fused_scores, fused_ids = rrf_fuse([dense_row, sparse_row], k)
+            rrf[row, :len(fused_ids)] = fused_scores
+            ids[row, :len(fused_ids)] = fused_ids
+            scores[row, :len(fused_ids)] = self._dense_scores(q_vecs[row], fused_ids, dense_row, dense_scores[row])
+        return scores, ids, rrf
+
+    def _dense_scores(self, q_vec, ids, dense_ids, dense_scores):
+        """
+        Косинусы запроса с чанками ids: найденные FAISS берутся из его выдачи,
+        найденные только BM25 — по восстановленным векторам индекса. Если индекс
+        векторы не отдаёт (binary), — последняя оценка FAISS: эти чанки в его
+        выдачу не попали, значит, ближе они не были.
+        """
+        import numpy as np
 
+        known = {int(i): float(s) for i, s in zip(dense_ids, dense_scores) if i >= 0}
+        missing = np.array(sorted({int(i) for i in ids} - known.keys()), dtype="int64")
+        if len(missing):
+            vectors = subset_vectors(self.index, missing)
+            if vectors is not None:
+                known.update(zip(missing.tolist(), (vectors @ q_vec).tolist()))
+            else:
+                known.update(dict.fromkeys(missing.tolist(), min(known.values(), default=0.0)))
+        return np.array([known[int(i)] for i in ids], dtype="float32")
+
+    def _collect(self, scores, indices, rrf=None) -> list[dict]:
+        """Строка результата FAISS → словари search()."""
         results = []
-        for score, idx in zip(scores[0], indices[0]):
+        for pos, (score, idx) in enumerate(zip(scores, indices)):
             if idx == -1:
                 continue
 
-            meta = self.metas[idx]
-            text = self.texts[idx]
+            meta = self.chunks.meta(idx)
+            text = self.chunks.text(idx)
 
-            # Применяем ICD-фильтр
-            if icd_filter:
-                doc_icds = set(meta.get("icd_codes", []))
-                if not doc_icds.intersection(icd_filter):
-                    continue
+            also_in = meta.get("also_in", [])
 
             results.append({
                 "rank": len(results) + 1,
                 "score": float(score),
+                **({"rrf_score": float(rrf[pos])} if rrf is not None else {}),
                 "text": text,
                 "doc_id": meta["doc_id"],
                 "source": meta["source"],
                 "title": meta["title"],
                 "icd_codes": meta["icd_codes"],
                 "chunk_id": meta["chunk_id"],
+                "also_in": also_in,
             })
 
-            if len(results) >= top_k:
-                break
-
         return results
 
     def search_for_diagnosis(
         self,
         symptoms: str,
         top_k: int = 5,
+        aggregator: Optional[str] = None,
+        budget_ms: Optional[float] = None,
     ) -> list[dict]:
         """
         Специализированный поиск для задачи постановки диагноза.
         Агрегирует чанки по документу и возвращает уникальные протоколы.
+
+        Если несколько длинных протоколов занимают всю выдачу, пул кандидатов
+        расширяется (глубина удваивается), пока не наберётся top_k протоколов
+        или не кончится бюджет budget_ms (по умолч. RAG_AGG_BUDGET_MS; 0 — без
+        расширения). aggregator — max | sum | softmax (по умолч. RAG_AGGREGATOR),
+        score результата — оценка протокола, chunk_score — его лучшего чанка
+        (косинусы); в гибридном режиме протоколы упорядочены по rrf_score —
+        той же агрегации, но по RRF-оценкам чанков.
         """
-        # Берём больше чанков, потом агрегируем
-        raw = self.search(symptoms, top_k=top_k * 4)
+        return self.search_for_diagnosis_batch([symptoms], top_k, aggregator, budget_ms)[0]
 
-        # Группируем по doc_id, берём лучший score
-        seen: dict[str, dict] = {}
-        for r in raw:
-            doc_id = r["doc_id"]
-            if doc_id not in seen or r["score"] > seen[doc_id]["score"]:
-                seen[doc_id] = r
+    @traced()
+    def search_for_diagnosis_batch(
+        self,
+        symptoms_list: list[str],
+        top_k: int = 5,
+        aggregator: Optional[str] = None,
+        budget_ms: Optional[float] = None,
+    ) -> list[list[dict]]:
+        """search_for_diagnosis() для многих запросов: одно кодирование, расширяются только недобравшие."""
+        import numpy as np
 
-        # Сортируем по score
-        aggregated = sorted(seen.values(), key=lambda x: x["score"], reverse=True)
+        t0 = time.perf_counter()
+        method = aggregator or self.aggregator
+        budget_ms = self.agg_budget_ms if budget_ms is None else budget_ms
+        symptoms_list = list(symptoms_list)
+        if not symptoms_list or top_k <= 0:
+            return [[] for _ in symptoms_list]
+
+        q_vecs = self.embed_queries(symptoms_list)
+        found: list = [None] * len(symptoms_list)
+        pending = list(range(len(symptoms_list)))
+        depth = min(top_k * DIAGNOSIS_DEPTH, self.index.ntotal)
+        while pending:
+            scores, indices, rrf = self._search_vectors(
+                q_vecs[pending], depth, queries=[symptoms_list[qi] for qi in pending]
+            )
+            widen = []
+            for row, qi in enumerate(pending):
+                valid = indices[row] >= 0
+                row_rrf = None if rrf is None else rrf[row][valid]
+                found[qi] = self._aggregate(scores[row][valid], indices[row][valid], top_k, method, row_rrf)
+                if len(found[qi][0]) < top_k and depth < self.index.ntotal:
+                    widen.append(qi)
+            if not widen or (time.perf_counter() - t0) * 1000 >= budget_ms:
+                break
+            pending = widen
+            depth = min(depth * 2, self.index.ntotal)
+
+        results = [self._materialize(*item) for item in found]
+        span = current_span()
+        span.set("rag.queries", len(symptoms_list))
+        span.set("rag.top_k", top_k)
+        span.set("rag.hybrid", self.bm25 is not None)
+        span.set("rag.aggregator", method)
+        span.set("rag.depth", depth)
+        span.set("rag.protocols", sum(len(r) for r in results))
+        return results
 
-        # Переназначаем ранги
-        for i, r in enumerate(aggregated[:top_k]):
-            r["rank"] = i + 1
+    def _aggregate(self, scores, ids, top_k: int, method: str, rrf=None):
+        """
+        Чанки одного запроса → (документы, оценки, id лучших чанков, их оценки,
+        RRF-оценки документов или None), не больше top_k.
+        """
+        import numpy as np
 
-        return aggregated[:top_k]
+        pos, docs = self.chunks.doc_pairs(ids)
+        if rrf is None:
+            docs, agg, best = aggregate_protocols(docs, scores[pos], method, self.agg_top_m, self.agg_temperature)
+            best_pos = pos[best[:top_k]]
+            return docs[:top_k], agg[:top_k], ids[best_pos], scores[best_pos], None
+        # Гибрид: порядок и лучший чанк — по RRF, оценка протокола — по косинусам
+        # (пары пересортированы, aggregate_protocols ждёт убывающие оценки)
+        ranked, fused, best = aggregate_protocols(docs, rrf[pos], method, self.agg_top_m, self.agg_temperature)
+        by_cos = np.argsort(-scores[pos], kind="stable")
+        cos_docs, cos_agg, _ = aggregate_protocols(
+            docs[by_cos], scores[pos][by_cos], method, self.agg_top_m, self.agg_temperature
+        )
+        cos_by_doc = dict(zip(cos_docs.tolist(), cos_agg.tolist()))
+        agg = np.array([cos_by_doc[d] for d in ranked[:top_k].tolist()], dtype=np.float64)
+        best_pos = pos[best[:top_k]]
+        return ranked[:top_k], agg, ids[best_pos], scores[best_pos], fused[:top_k]
+
+    def _materialize(self, docs, agg, chunk_ids, chunk_scores, fused=None) -> list[dict]:
+        """Словари результата: лучший чанк протокола + метаданные самого протокола."""
+        results = []
+        for rank, (doc, score, idx, chunk_score) in enumerate(zip(docs, agg, chunk_ids, chunk_scores), 1):
+            results.append({
+                "rank": rank,
+                "score": float(score),
+                **({"rrf_score": float(fused[rank - 1])} if fused is not None else {}),
+                "chunk_score": float(chunk_score),
+                "text": self.chunks.text(int(idx)),
+                "chunk_id": self.chunks.meta(int(idx))["chunk_id"],
+                **self.chunks.doc_meta(int(doc)),
+                "also_in": [],
+            })
+        return results
 
 
 # ════════════════════════════════════════════════════════════════════════════
 # CLI
 # ════════════════════════════════════════════════════════════════════════════
 
+def benchmark(retriever: RAGRetriever, queries: list[str], top_k: int, aggregate: bool, repeats: int = 5) -> dict:
+    """
+    Задержка одиночных запросов: только FAISS vs FAISS + BM25 (RRF), мс.
+    Векторы запросов кодируются заранее (кэш), так что сравнивается сам поиск.
+    """
+    import numpy as np
+
+    run = retriever.search_for_diagnosis if aggregate else retriever.search
+    retriever.embed_queries(queries)
+    bm25 = retriever.bm25
+    report = {}
+    for mode, index in (("dense", None), ("hybrid", bm25)):
+        if mode == "hybrid" and index is None:
+            break
+        retriever.bm25 = index
+        run(queries[0], top_k=top_k)
+        times = []
+        for _ in range(repeats):
+            for query in queries:
+                t0 = time.perf_counter()
+                run(query, top_k=top_k)
+                times.append((time.perf_counter() - t0) * 1000)
+        report[mode] = {
+            "queries": len(times),
+            "p50_ms": round(float(np.percentile(times, 50)), 3),
+            "p95_ms": round(float(np.percentile(times, 95)), 3),
+            "p99_ms": round(float(np.percentile(times, 99)), 3),
+        }
+    retriever.bm25 = bm25
+    return report
+
+
 def main():
     parser = argparse.ArgumentParser(
         description="Поиск по FAISS-индексу клинических протоколов РК"
     )
     parser.add_argument(
         "query",
+        nargs="?",
         help="Запрос: симптомы пациента или ключевые слова",
     )
+    parser.add_argument(
+        "--queries-file", "-f",
+        help="Файл с запросами (по одному на строку): пакетный поиск, вывод — JSON-список",
+    )
     parser.add_argument(
         "--index-dir", "-i",
         default="./index",
@@ -188,7 +613,7 @@ def main():
     parser.add_argument(
         "--icd", "-c",
         nargs="*",
-        help="Фильтр по ICD-кодам, напр.: J18 K29",
+        help="Фильтр по ICD-кодам или рубрикам, напр.: J18 K29.7",
     )
     parser.add_argument(
         "--aggregate", "-a",
@@ -196,6 +621,12 @@ def main():
         default=False,
         help="Агрегировать результаты по документу (для диагностики)",
     )
+    parser.add_argument(
+        "--bench",
+        action="store_true",
+        default=False,
+        help="С --queries-file: сравнить задержку поиска только по FAISS и гибридного (FAISS + BM25)",
+    )
     parser.add_argument(
         "--json",
         action="store_true",
@@ -203,9 +634,32 @@ def main():
         help="Вывод в формате JSON",
     )
     args = parser.parse_args()
+    if not args.query and not args.queries_file:
+        parser.error("укажите запрос или --queries-file")
+    if args.bench and not args.queries_file:
+        parser.error("--bench работает только с --queries-file")
 
     retriever = RAGRetriever(args.index_dir)
 
+    if args.queries_file:
+        with open(args.queries_file, encoding="utf-8") as f:
+            queries = [line.strip() for line in f if line.strip()]
+        if args.bench:
+            print(json.dumps(benchmark(retriever, queries, args.top_k, args.aggregate), indent=2))
+            return
+        t0 = time.perf_counter()
+        if args.aggregate:
+            batch = retriever.search_for_diagnosis_batch(queries, top_k=args.top_k)
+        else:
+            batch = retriever.search_batch(queries, top_k=args.top_k, icd_filter=args.icd)
+        elapsed = time.perf_counter() - t0
+        print(json.dumps(
+            [{"query": q, "results": r} for q, r in zip(queries, batch)],
+            ensure_ascii=False, indent=2,
+        ))
+        print(f"{len(queries)} запросов за {elapsed * 1000:.0f} мс", file=sys.stderr)
+        return
+
     if args.aggregate:
         results = retriever.search_for_diagnosis(args.query, top_k=args.top_k)
     else:
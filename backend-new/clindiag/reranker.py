@@ -0,0 +1,229 @@
+"""
+reranker.py — Переранжирование найденных протоколов cross-encoder'ом.
+
+Bi-encoder (FAISS) кодирует запрос и чанк независимо и ошибается в порядке
+близких кандидатов; cross-encoder читает пару (запрос, чанк) целиком и
+оценивает её точнее, но дороже. Поэтому он смотрит только на кандидатов
+search_for_diagnosis (лучший чанк каждого протокола) — все пары одного
+запроса идут одним батчем через модель.
+
+Бюджет: по прошлым вызовам известна цена одной пары (скользящее среднее),
+и в батч берётся столько кандидатов (в порядке ретривера), сколько влезает
+в budget_ms. Не попавшие в батч идут после переранжированных в прежнем
+порядке.
+
+Кэш: оценка пары хранится по ключу (версия индекса, хэш нормализованного
+запроса, хэш текста чанка) — повторный запрос (оценочные прогоны, повторная
+отправка анамнеза) переранжируется без модели. Ключ — по тексту, а не по
+(doc_id, chunk_id): протокол, засчитанный через also_in, несёт чужой чанк
+под своим doc_id, и номер чанка мог бы совпасть с его собственным. LRU + TTL, как у кэша
+векторов запросов (query_cache.py).
+
+Использование:
+    reranker = CrossEncoderReranker.from_env()
+    ranked = reranker.rerank(query, results, namespace=retriever.version)
+"""
+
+import hashlib
+import os
+import threading
+import time
+from collections import OrderedDict
+from typing import Optional
+
+from embedding_cache import normalize_text
+
+DEFAULT_MODEL = "cross-encoder/mmarco-mMiniLMv2-L12-H384-v1"
+DEFAULT_MAX_LENGTH = 256
+DEFAULT_CACHE_SIZE = 8192
+DEFAULT_CACHE_TTL = 3600.0
+COST_SMOOTHING = 0.2   # вес нового замера в скользящей цене одной пары
+
+
+def query_hash(query: str) -> str:
+    return hashlib.blake2b(normalize_text(query).encode("utf-8"), digest_size=12).hexdigest()
+
+
+def text_hash(text: str) -> str:
+    """Хэш текста ровно в том виде, в каком его видит cross-encoder."""
+    return hashlib.blake2b(text.encode("utf-8"), digest_size=16).hexdigest()
+
+
+class ScoreCache:
+    """Потокобезопасный LRU+TTL кэш оценок пар. max_entries=0 — выключен, ttl_seconds=0 — без срока."""
+
+    def __init__(self, max_entries: int = DEFAULT_CACHE_SIZE, ttl_seconds: float = DEFAULT_CACHE_TTL):
+        self.max_entries = max_entries
+        self.ttl_seconds = ttl_seconds
+        self.hits = 0
+        self.misses = 0
+        self.evicted = 0
+        # ключ → (время записи по time.time(), оценка); от давно использованных к свежим
+        self._entries: OrderedDict[tuple, tuple[float, float]] = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get_many(self, keys: list[tuple]) -> list[Optional[float]]:
+        if self.max_entries <= 0:
+            return [None] * len(keys)
+        now = time.time()
+        found = []
+        with self._lock:
+            for key in keys:
+                entry = self._entries.get(key)
+                if entry is not None and self.ttl_seconds > 0 and now - entry[0] > self.ttl_seconds:
+                    del self._entries[key]
+                    entry = None
+                if entry is None:
+                    self.misses += 1
+                    found.append(None)
+                else:
+                    self._entries.move_to_end(key)
+                    self.hits += 1
+                    found.append(entry[1])
+        return found
+
+    def put_many(self, items: list[tuple[tuple, float]]) -> None:
+        if self.max_entries <= 0:
+            return
+        now = time.time()
+        with self._lock:
+            for key, score in items:
+                self._entries[key] = (now, score)
+                self._entries.move_to_end(key)
+            while len(self._entries) > self.max_entries:
+                self._entries.popitem(last=False)
+                self.evicted += 1
+
+    def clear(self) -> None:
+        with self._lock:
+            self._entries.clear()
+
+    def stats(self) -> dict:
+        total = self.hits + self.misses
+        return {
+            "entries": len(self._entries),
+            "max_entries": self.max_entries,
+            "ttl_seconds": self.ttl_seconds,
+            "hits": self.hits,
+            "misses": self.misses,
+            "hit_rate": round(self.hits / total, 4) if total else 0.0,
+            "evicted": self.evicted,
+        }
+
+
+class CrossEncoderReranker:
+    """Cross-encoder (sentence-transformers) + кэш оценок + бюджет на вызов."""
+
+    def __init__(
+        self,
+        model_name: str = DEFAULT_MODEL,
+        budget_ms: float = 200.0,
+        max_length: int = DEFAULT_MAX_LENGTH,
+        cache: Optional[ScoreCache] = None,
+    ):
+        self.model_name = model_name
+        self.budget_ms = budget_ms
+        self.max_length = max_length
+        self.cache = cache if cache is not None else ScoreCache()
+        self._model = None
+        self._model_lock = threading.Lock()
+        self.pair_ms: Optional[float] = None   # скользящая цена одной пары, мс
+        self.calls = 0
+        self.scored_pairs = 0
+        self.skipped_pairs = 0   # не влезли в бюджет
+
+    @classmethod
+    def from_env(cls) -> "CrossEncoderReranker":
+        """RERANK_MODEL, RERANK_BUDGET_MS, RERANK_MAX_LENGTH, RERANK_CACHE_SIZE, RERANK_CACHE_TTL (сек.)."""
+        return cls(
+            model_name=os.getenv("RERANK_MODEL", DEFAULT_MODEL),
+            budget_ms=float(os.getenv("RERANK_BUDGET_MS", "200")),
+            max_length=int(os.getenv("RERANK_MAX_LENGTH", str(DEFAULT_MAX_LENGTH))),
+            cache=ScoreCache(
+                max_entries=int(os.getenv("RERANK_CACHE_SIZE", str(DEFAULT_CACHE_SIZE))),
+                ttl_seconds=float(os.getenv("RERANK_CACHE_TTL", str(DEFAULT_CACHE_TTL))),
+            ),
+        )
+
+    def _get_model(self):
+        with self._model_lock:
+            if self._model is None:
+                from sentence_transformers import CrossEncoder
+
+                print(f"Загрузка cross-encoder: {self.model_name}")
+                self._model = CrossEncoder(self.model_name, max_length=self.max_length)
+        return self._model
+
+    def warm_up(self, query: str = "кашель, температура 38.5") -> int:
+        """Загружает модель и замеряет цену пары на тестовом батче. Возвращает время в мс."""
+        t0 = time.perf_counter()
+        self._score([(query, query)] * 4)
+        return int((time.perf_counter() - t0) * 1000)
+
+    def _score(self, pairs: list[tuple[str, str]]) -> list[float]:
+        model = self._get_model()
+        t0 = time.perf_counter()
+        scores = model.predict(pairs, batch_size=len(pairs), show_progress_bar=False)
+        per_pair = (time.perf_counter() - t0) * 1000 / len(pairs)
+        self.pair_ms = per_pair if self.pair_ms is None else (
+            (1 - COST_SMOOTHING) * self.pair_ms + COST_SMOOTHING * per_pair
+        )
+        return [float(s) for s in scores]
+
+    def _fits(self, budget_ms: float) -> int:
+        if self.pair_ms is None:
+            return 1 << 30   # цена ещё не замерена (без warm_up) — батч целиком
+        return max(1, int(budget_ms / max(self.pair_ms, 1e-3)))
+
+    def rerank(
+        self,
+        query: str,
+        results: list[dict],
+        top_n: Optional[int] = None,
+        namespace: str = "",
+        budget_ms: Optional[float] = None,
+    ) -> list[dict]:
+        """
+        results в порядке cross-encoder'а (top_n первых; None — все). К каждому
+        оценённому результату добавляется rerank_score; score ретривера и
+        прочие поля не меняются. namespace — версия индекса (часть ключа кэша).
+        """
+        if not results:
+            return []
+        budget_ms = self.budget_ms if budget_ms is None else budget_ms
+        qh = query_hash(query)
+        keys = [(namespace, qh, text_hash(r["text"])) for r in results]
+        scores = self.cache.get_many(keys)
+
+        misses = [i for i, s in enumerate(scores) if s is None]
+        batch = misses[: self._fits(budget_ms)]
+        if batch:
+            fresh = self._score([(query, results[i]["text"]) for i in batch])
+            for i, s in zip(batch, fresh):
+                scores[i] = s
+            self.cache.put_many([(keys[i], s) for i, s in zip(batch, fresh)])
+        self.calls += 1
+        self.scored_pairs += len(batch)
+        self.skipped_pairs += len(misses) - len(batch)
+
+        scored = sorted((i for i, s in enumerate(scores) if s is not None), key=lambda i: -scores[i])
+        rest = [i for i, s in enumerate(scores) if s is None]
+        ranked = []
+        for rank, i in enumerate(scored + rest, 1):
+            item = {**results[i], "rank": rank}
+            if scores[i] is not None:
+                item["rerank_score"] = scores[i]
+            ranked.append(item)
+        return ranked[:top_n] if top_n else ranked
+
+    def stats(self) -> dict:
+        return {
+            "model": self.model_name,
+            "loaded": self._model is not None,
+            "budget_ms": self.budget_ms,
+            "pair_ms": round(self.pair_ms, 3) if self.pair_ms is not None else None,
+            "calls": self.calls,
+            "scored_pairs": self.scored_pairs,
+            "skipped_pairs": self.skipped_pairs,
+            "cache": self.cache.stats(),
+        }
@@ -4,11 +4,28 @@ predict_server.py — FastAPI бэкенд с эндпоинтами /predict и
 Пайплайн /predict:
   1. Принимает анамнез пациента (свободный текст).
   2. Шаг 1 (LLM) — Извлечение ключевых симптомов → JSON.
-  3. Шаг 2 (RAG)  — Поиск релевантных фрагментов протоколов в FAISS.
+  3. Шаг 2 (RAG)  — Поиск релевантных фрагментов протоколов в FAISS
+                   (+ переранжирование cross-encoder'ом, если RERANK=1).
   4. Шаг 3 (LLM) — Постановка диагноза на основе анамнеза + протоколов.
 
 /diagnose — совместим с форматом evaluate.py (принимает {symptoms}, возвращает {diagnoses}).
+/metrics              — метрики Prometheus: счётчики запросов, запросы в работе, гистограммы
+                        латентности по стадиям (llm, llm_cache, json_parse, embed, faiss_search,
+                        bm25, rerank, rag_search, ...); те же стадии — в заголовке Server-Timing (metrics.py).
+                        При заданном TRACE_FILE каждый запрос ещё и трассируется: вложенные спаны
+                        (run_pipeline, QazcodeClient.chat, rag_search, RAGRetriever.*, embed, ...)
+                        пишутся в OTLP/JSON в локальный файл (tracing.py); X-Trace-Id в ответе.
+Одинаковые LLM-запросы (модель, версия промптов, сообщения, temperature,
+max_tokens) отвечаются из персистентного кэша (llm_cache.py, SQLite);
+заголовок `Cache-Control: no-cache` — обойти кэш для одного запроса.
+Доля попаданий — в /health → llm.cache и в /metrics.
+
 /admin/reload-prompts — горячая перезагрузка промптов из prompts.json (для self_refine).
+/admin/reload-index   — замена FAISS-индекса без рестарта: новый индекс загружается,
+                        проверяется и прогревается в фоне, затем подменяется атомарно;
+                        запросы, начатые на старом индексе, дорабатывают на нём.
+                        Действует на один процесс — с несколькими воркерами вызывать
+                        для каждого (или перезапускать их по очереди).
 
 Запуск:
   uvicorn src.predict_server:app --host 0.0.0.0 --port 8080 --reload
@@ -18,30 +35,69 @@ predict_server.py — FastAPI бэкенд с эндпоинтами /predict и
   QAZCODE_API_KEY    — API-ключ
   QAZCODE_MODEL      — Модель (по умолч. oss-120b)
   INDEX_DIR          — Путь к FAISS-индексу (по умолч. ./index)
+  INDEX_ROOT         — Каталог, внутри которого /admin/reload-index принимает index_dir
+                       (по умолч. родительский каталог INDEX_DIR)
+  ADMIN_TOKEN        — Токен заголовка X-Admin-Token для /admin/reload-index
+                       (не задан — эндпоинт отвечает 403)
+  RAG_INDEX_MMAP     — Загружать индекс через mmap (по умолч. 1)
+  RAG_INDEX_PREFETCH — Прогрев page cache индекса при старте (по умолч. 0)
+  RAG_ENCODER        — Кодировщик запросов: torch | onnx | onnx-int8 (по умолч. torch)
+  RAG_ENCODER_CACHE  — Кэш экспортированных ONNX-моделей (по умолч. ./.onnx_cache)
+  ONNX_THREADS       — intra-op потоки ONNX Runtime (по умолч. min(4, ядер))
+  RAG_QUERY_CACHE_SIZE — Размер LRU-кэша векторов запросов (по умолч. 1024, 0 — выкл.)
+  RAG_QUERY_CACHE_TTL  — Время жизни записи кэша в сек. (по умолч. 3600, 0 — без ограничения)
+  RAG_QUERY_CACHE_PATH — Файл для сохранения кэша между рестартами (по умолч. не сохраняется)
   PROMPTS_FILE       — Путь к prompts.json (по умолч. ./prompts.json)
   RAG_TOP_K          — Кол-во протоколов из FAISS (по умолч. 4)
+  RAG_BATCH_WINDOW_MS — Окно сбора RAG-запросов в один пакет, мс (по умолч. 3, 0 — без пакетов)
+  RAG_BATCH_MAX      — Максимальный размер пакета RAG-запросов (по умолч. 32)
+  RAG_AGGREGATOR     — Оценка протокола по чанкам: max | sum | softmax (по умолч. max)
+  RAG_AGG_BUDGET_MS  — Бюджет расширения пула кандидатов до top_k протоколов, мс (по умолч. 30)
+  RAG_HYBRID         — FAISS + BM25 с RRF-слиянием, если в индексе есть protocols.bm25 (по умолч. 0)
+  RAG_HYBRID_BUDGET_MS — Бюджет BM25 на запрос, мс (по умолч. 5)
+  RERANK             — Переранжировать протоколы cross-encoder'ом (по умолч. 0)
+  RERANK_MODEL       — Модель cross-encoder (по умолч. cross-encoder/mmarco-mMiniLMv2-L12-H384-v1)
+  RERANK_CANDIDATES  — Сколько протоколов ретривера переранжировать (по умолч. 12)
+  RERANK_TOP_N       — Сколько лучших после переранжирования идёт в промпт (по умолч. 0 — все top_k)
+  RERANK_BUDGET_MS   — Бюджет на батч cross-encoder'а, мс (по умолч. 200)
+  RERANK_CACHE_SIZE  — Размер LRU-кэша оценок (запрос, чанк) (по умолч. 8192, 0 — выкл.)
+  RERANK_CACHE_TTL   — Время жизни оценки в кэше, сек. (по умолч. 3600)
   LLM_TIMEOUT        — Таймаут LLM-запроса в сек. (по умолч. 60)
+  LLM_CACHE_PATH     — Файл кэша ответов LLM (по умолч. ./.llm_cache.sqlite)
+  LLM_CACHE_SIZE     — Максимум ответов в кэше (по умолч. 10000, 0 — выкл.)
+  LLM_CACHE_TTL      — Время жизни ответа в кэше, сек. (по умолч. 86400, 0 — без ограничения)
+  TRACE_FILE         — Файл спанов трассировки (по умолч. пусто — выключено)
+  TRACE_MAX_BYTES    — Размер файла спанов для ротации (по умолч. 10 МБ)
+  TRACE_BACKUPS      — Сколько старых файлов спанов хранить (по умолч. 5)
+  TRACE_MIN_MS       — Писать только запросы не короче, мс (по умолч. 0 — все)
 """
 
 import asyncio
+import contextvars
 import json
 import logging
 import os
 import re
+import secrets
 import sys
 import time
 from contextlib import asynccontextmanager
+from datetime import datetime, timezone
 from pathlib import Path
 from typing import Any
 
 import httpx
-from fastapi import FastAPI, HTTPException, Request, status
-from fastapi.responses import JSONResponse
+from fastapi import FastAPI, Header, HTTPException, Request, status
+from fastapi.responses import JSONResponse, Response
 from pydantic import BaseModel, Field
 
 ROOT = Path(__file__).parent.parent
 sys.path.insert(0, str(ROOT))
+from llm_cache import LLMResponseCache, cache_key
+from metrics import CONTENT_TYPE as METRICS_CONTENT_TYPE, MetricsMiddleware, observe_stage, render as render_metrics, stage
 from rag_query import RAGRetriever
+from reranker import CrossEncoderReranker
+from tracing import KIND_CLIENT, Span, TracingMiddleware, current_span, span, stats as tracing_stats, traced
 
 
 # ════════════════════════════════════════════════════════════════════════════
@@ -53,10 +109,20 @@ class Config:
     API_KEY: str     = os.environ.get("QAZCODE_API_KEY",  "")
     MODEL: str       = os.environ.get("QAZCODE_MODEL",    "oss-120b")
     INDEX_DIR: str   = os.environ.get("INDEX_DIR",        "./index")
+    INDEX_ROOT: str  = os.environ.get("INDEX_ROOT", "").strip() or os.path.dirname(os.path.abspath(INDEX_DIR))
+    ADMIN_TOKEN: str = os.environ.get("ADMIN_TOKEN", "").strip()
     PROMPTS_FILE: str = os.environ.get("PROMPTS_FILE",    "./prompts.json")
     RAG_TOP_K: int   = int(os.environ.get("RAG_TOP_K",   "6"))
     LLM_TIMEOUT: float = float(os.environ.get("LLM_TIMEOUT", "120.0"))
     MAX_CHUNK_CHARS: int = int(os.environ.get("MAX_CHUNK_CHARS", "3000"))
+    RAG_BATCH_WINDOW_MS: float = float(os.environ.get("RAG_BATCH_WINDOW_MS", "3"))
+    RAG_BATCH_MAX: int = int(os.environ.get("RAG_BATCH_MAX", "32"))
+    RERANK: bool = os.environ.get("RERANK", "0").strip().lower() in ("1", "true", "yes", "on")
+    RERANK_CANDIDATES: int = int(os.environ.get("RERANK_CANDIDATES", "12"))
+    RERANK_TOP_N: int = int(os.environ.get("RERANK_TOP_N", "0"))
+    LLM_CACHE_PATH: str = os.environ.get("LLM_CACHE_PATH", "./.llm_cache.sqlite")
+    LLM_CACHE_SIZE: int = int(os.environ.get("LLM_CACHE_SIZE", "10000"))
+    LLM_CACHE_TTL: float = float(os.environ.get("LLM_CACHE_TTL", "86400"))
 
 
 # ════════════════════════════════════════════════════════════════════════════
@@ -159,7 +225,8 @@ class PromptStore:
 class QazcodeClient:
     CHAT_ENDPOINT = "/v1/chat/completions"
 
-    def __init__(self):
+    def __init__(self, cache: LLMResponseCache | None = None):
+        self.cache = cache
         self._client = httpx.AsyncClient(
             base_url=Config.BASE_URL,
             headers={
@@ -172,6 +239,7 @@ class QazcodeClient:
     async def aclose(self):
         await self._client.aclose()
 
+    @traced(kind=KIND_CLIENT)
     async def chat(
         self,
         messages: list[dict[str, str]],
@@ -179,7 +247,14 @@ class QazcodeClient:
         temperature: float = 0.2,
         max_tokens: int = 2048,
         request_id: str = "",
+        prompts_version: int | str = "",
+        use_cache: bool = True,
     ) -> str:
+        """
+        Текст ответа модели. С кэшем одинаковый запрос (модель, prompts_version,
+        messages, temperature, max_tokens) повторно в LLM не уходит;
+        use_cache=False — без чтения и записи кэша.
+        """
         payload = {
             "model": Config.MODEL,
             "messages": messages,
@@ -191,10 +266,31 @@ class QazcodeClient:
             "%sLLM запрос: модель=%s, сообщений=%d",
             log_prefix, Config.MODEL, len(messages),
         )
+        trace = current_span()
+        trace.set("llm.model", Config.MODEL)
+        trace.set("llm.prompt_chars", sum(len(m["content"]) for m in messages))
+        trace.set("llm.max_tokens", max_tokens)
+
+        key, cached = None, None
+        if self.cache is not None and self.cache.enabled:
+            # Своя стадия: попадания видны в /metrics отдельно от стадии llm
+            with stage("llm_cache") as cache_span:
+                if use_cache:
+                    key = cache_key(Config.MODEL, messages, temperature, max_tokens, prompts_version)
+                    cached = await asyncio.to_thread(self.cache.get, key)
+                else:
+                    self.cache.record_bypass()
+                result = "bypass" if key is None else ("hit" if cached is not None else "miss")
+                cache_span.set("llm.cache", result)
+                trace.set("llm.cache", result)
+            if cached is not None:
+                logger.info("%sLLM ответ из кэша", log_prefix)
+                return cached
         t0 = time.perf_counter()
 
         try:
-            resp = await self._client.post(self.CHAT_ENDPOINT, json=payload)
+            with stage("llm"):
+                resp = await self._client.post(self.CHAT_ENDPOINT, json=payload)
         except httpx.TimeoutException as exc:
             raise LLMError(f"LLM таймаут ({Config.LLM_TIMEOUT}s)") from exc
         except httpx.RequestError as exc:
@@ -202,6 +298,7 @@ class QazcodeClient:
 
         elapsed_ms = int((time.perf_counter() - t0) * 1000)
         logger.info("%sLLM ответ: HTTP %d, %dms", log_prefix, resp.status_code, elapsed_ms)
+        trace.set("http.response.status_code", resp.status_code)
 
         if resp.status_code != 200:
             raise LLMError(
@@ -209,9 +306,111 @@ class QazcodeClient:
                 status_code=resp.status_code,
             )
         try:
-            return resp.json()["choices"][0]["message"]["content"]
+            data = resp.json()
+            content = data["choices"][0]["message"]["content"]
         except (KeyError, IndexError, json.JSONDecodeError) as exc:
             raise LLMError(f"Невалидный формат ответа LLM: {exc}") from exc
+        usage = data.get("usage") or {}
+        trace.set("llm.prompt_tokens", usage.get("prompt_tokens"))
+        trace.set("llm.completion_tokens", usage.get("completion_tokens"))
+        trace.set("llm.response_chars", len(content or ""))
+        if key is not None and content:
+            await asyncio.to_thread(self.cache.put, key, Config.MODEL, content, elapsed_ms)
+        return content
+
+
+# ════════════════════════════════════════════════════════════════════════════
+# МИКРО-БАТЧИНГ RAG-ПОИСКА
+# ════════════════════════════════════════════════════════════════════════════
+
+class RAGBatcher:
+    """
+    Собирает RAG-запросы конкурентных /predict и /diagnose в пакеты.
+
+    Запрос ждёт не дольше window_ms (или пока не наберётся max_batch), затем
+    весь пакет уходит в поток одним search_for_diagnosis_batch: одно
+    кодирование и один поиск FAISS вместо N мелких вызовов, дерущихся за ядра.
+    Результаты раздаются обратно каждому ожидающему. Запросы группируются по
+    (ретривер, top_k): после /admin/reload-index старые запросы дорабатывают
+    на своём индексе. window_ms=0 — без пакетов, как раньше.
+
+    Пакет выполняется в пустом контексте: его стадии (embed, faiss_search)
+    общие для всех запросов пакета и идут только в гистограммы /metrics, а не
+    в Server-Timing того запроса, который случайно запустил сброс. По той же
+    причине пакет — отдельная трасса (спан RAGBatcher.batch) со ссылками (links)
+    на спаны ожидавших запросов; им в ответ ставится атрибут rag.batch_trace_id.
+    """
+
+    def __init__(self, window_ms: float = Config.RAG_BATCH_WINDOW_MS, max_batch: int = Config.RAG_BATCH_MAX):
+        self.window_s = max(0.0, window_ms) / 1000
+        self.max_batch = max(1, max_batch)
+        self._pending: list[tuple[RAGRetriever, str, int, Span, asyncio.Future]] = []
+        self._timer: asyncio.TimerHandle | None = None
+        self._tasks: set[asyncio.Task] = set()
+        self.batches = 0
+        self.requests = 0
+        self.largest = 0
+
+    async def search_for_diagnosis(self, rag: RAGRetriever, query: str, top_k: int) -> list[dict]:
+        if self.window_s == 0:
+            self._count(1)
+            return await asyncio.to_thread(rag.search_for_diagnosis, query, top_k)
+        loop = asyncio.get_running_loop()
+        future = loop.create_future()
+        self._pending.append((rag, query, top_k, current_span(), future))
+        if len(self._pending) >= self.max_batch:
+            self._flush()
+        elif self._timer is None:
+            self._timer = loop.call_later(self.window_s, self._flush)
+        return await future
+
+    def _count(self, size: int) -> None:
+        self.batches += 1
+        self.requests += size
+        self.largest = max(self.largest, size)
+
+    def _flush(self) -> None:
+        if self._timer is not None:
+            self._timer.cancel()
+            self._timer = None
+        pending, self._pending = self._pending, []
+        groups: dict[tuple[int, int], list] = {}
+        for item in pending:
+            groups.setdefault((id(item[0]), item[2]), []).append(item)
+        for items in groups.values():
+            task = asyncio.create_task(self._run(items), context=contextvars.Context())
+            self._tasks.add(task)
+            task.add_done_callback(self._tasks.discard)
+
+    async def _run(self, items: list) -> None:
+        rag, top_k = items[0][0], items[0][2]
+        self._count(len(items))
+        waiting = [item[3] for item in items]
+        try:
+            with span("RAGBatcher.batch", links=waiting, **{"rag.batch_size": len(items)}) as batch:
+                for waiter in waiting:
+                    waiter.set("rag.batch_trace_id", batch.trace_id)
+                results = await asyncio.to_thread(
+                    rag.search_for_diagnosis_batch, [item[1] for item in items], top_k
+                )
+        except Exception as exc:
+            for *_, future in items:
+                if not future.done():
+                    future.set_exception(exc)
+            return
+        for (*_, future), result in zip(items, results):
+            if not future.done():   # клиент мог отключиться
+                future.set_result(result)
+
+    def stats(self) -> dict:
+        return {
+            "window_ms": self.window_s * 1000,
+            "max_batch": self.max_batch,
+            "batches": self.batches,
+            "requests": self.requests,
+            "avg_batch": round(self.requests / self.batches, 2) if self.batches else 0.0,
+            "largest_batch": self.largest,
+        }
 
 
 # ════════════════════════════════════════════════════════════════════════════
@@ -360,6 +559,7 @@ class ExtractedSymptoms(BaseModel):
 class Timing(BaseModel):
     symptom_extraction_ms: int
     rag_search_ms:         int
+    rerank_ms:             int = 0
     diagnosis_ms:          int
     total_ms:              int
 
@@ -379,6 +579,10 @@ class DiagnosisItem(BaseModel):
 class DiagnoseResponse(BaseModel):
     diagnoses: list[DiagnosisItem]
 
+class ReloadIndexRequest(BaseModel):
+    index_dir: str | None = Field(default=None, description="Новый индекс (по умолч. INDEX_DIR)")
+    wait: bool = Field(default=False, description="Дождаться окончания загрузки и вернуть результат")
+
 
 # ════════════════════════════════════════════════════════════════════════════
 # ГЛОБАЛЬНЫЕ ОБЪЕКТЫ И LIFESPAN
@@ -387,14 +591,91 @@ class DiagnoseResponse(BaseModel):
 retriever:    RAGRetriever | None = None
 llm_client:   QazcodeClient | None = None
 prompt_store: PromptStore | None = None
+rag_batcher:  RAGBatcher | None = None
+reranker:     CrossEncoderReranker | None = None
+
+# Переранжирование, не уложившееся в бюджет (ответ идёт в порядке ретривера)
+RERANK_TIMEOUT_FACTOR = 2
+_rerank_timeouts = 0
+
+# Состояние последней перезагрузки индекса (/admin/reload-index)
+_index_reload: dict[str, Any] = {"status": "idle"}
+_index_reload_task: asyncio.Task | None = None
+
+
+def _load_retriever(index_dir: str, current: RAGRetriever | None) -> RAGRetriever:
+    """Загрузка + проверка + прогрев тестовым запросом (в отдельном потоке)."""
+    new = RAGRetriever(index_dir, allow_pickle=False)
+    new.reuse_model(current)
+    warmup_ms = new.warm_up()
+    logger.info(
+        "Индекс %s (версия %s): %d векторов, загрузка %dms, тестовый запрос %dms",
+        index_dir, new.version, new.index.ntotal, new.load_ms, warmup_ms,
+    )
+    return new
+
+
+def _warm_up_retriever(rag: RAGRetriever) -> int:
+    """
+    warm_up() при старте. Сбой ONNX-кодировщика (нет onnxruntime, битая модель,
+    OSError) не роняет сервер: кодировщик переключается на PyTorch и прогрев
+    повторяется; ошибки самого индекса пробрасываются.
+    """
+    try:
+        return rag.warm_up()
+    except Exception as exc:
+        if rag.encoder_backend in (None, "torch"):
+            raise
+        logger.warning("Кодировщик %s не прошёл прогрев (%s); используется PyTorch", rag.encoder_backend, exc)
+        rag.use_torch_encoder()
+        return rag.warm_up()
+
+
+def _now_iso() -> str:
+    return datetime.now(timezone.utc).isoformat(timespec="seconds")
+
+
+def _check_admin_token(token: str | None) -> None:
+    if not Config.ADMIN_TOKEN:
+        raise HTTPException(status_code=403, detail="ADMIN_TOKEN не задан: эндпоинт отключён")
+    if token is None or not secrets.compare_digest(token.encode(), Config.ADMIN_TOKEN.encode()):
+        raise HTTPException(status_code=403, detail="Неверный X-Admin-Token")
+
+
+def _resolve_index_dir(index_dir: str | None) -> str:
+    """INDEX_DIR или подкаталог INDEX_ROOT (после разрешения симлинков и ..)."""
+    if not index_dir:
+        return Config.INDEX_DIR
+    path, root = Path(index_dir).resolve(), Path(Config.INDEX_ROOT).resolve()
+    if path != Path(Config.INDEX_DIR).resolve() and (path == root or not path.is_relative_to(root)):
+        raise HTTPException(status_code=400, detail=f"index_dir должен лежать внутри INDEX_ROOT ({root})")
+    return str(path)
+
+
+async def _reload_index(index_dir: str) -> None:
+    global retriever
+    _index_reload.update(status="loading", index_dir=index_dir, started_at=_now_iso(), finished_at=None, error=None)
+    try:
+        new = await asyncio.to_thread(_load_retriever, index_dir, retriever)
+    except Exception as exc:
+        logger.error("Перезагрузка индекса из %s не удалась: %s", index_dir, exc)
+        _index_reload.update(status="failed", error=str(exc), finished_at=_now_iso())
+        return
+    # Подмена — одно присваивание в потоке event loop; _run_pipeline берёт
+    # ссылку на ретривер один раз, старый объект живёт, пока на него ссылаются.
+    retriever = new
+    _index_reload.update(status="ok", version=new.version, finished_at=_now_iso())
 
 
 @asynccontextmanager
 async def lifespan(app: FastAPI):
-    global retriever, llm_client, prompt_store
+    global retriever, llm_client, prompt_store, rag_batcher, reranker
 
     prompt_store = PromptStore(Config.PROMPTS_FILE)
-    llm_client   = QazcodeClient()
+    llm_client   = QazcodeClient(
+        LLMResponseCache(Config.LLM_CACHE_PATH, Config.LLM_CACHE_SIZE, Config.LLM_CACHE_TTL)
+    )
+    rag_batcher  = RAGBatcher()
     logger.info("LLM-клиент готов (модель=%s)", Config.MODEL)
 
     try:
@@ -405,11 +686,34 @@ async def lifespan(app: FastAPI):
         )
     except FileNotFoundError as exc:
         logger.warning("FAISS-индекс не найден: %s", exc)
+    if retriever is not None:
+        # Кодировщик (и сверка ONNX с PyTorch) загружается до первого запроса
+        try:
+            warmup_ms = await asyncio.to_thread(_warm_up_retriever, retriever)
+            logger.info("Кодировщик запросов: %s, тестовый запрос %dms", retriever.encoder_backend, warmup_ms)
+        except Exception as exc:
+            logger.warning("Проверка индекса при старте: %s", exc)
+    if Config.RERANK:
+        # Загрузка модели + замер цены пары, чтобы бюджет соблюдался с первого запроса
+        candidate = CrossEncoderReranker.from_env()
+        try:
+            warmup_ms = await asyncio.to_thread(candidate.warm_up)
+            reranker = candidate
+            logger.info(
+                "Cross-encoder: %s, прогрев %dms, ~%.1fms на пару, бюджет %gms",
+                reranker.model_name, warmup_ms, reranker.pair_ms, reranker.budget_ms,
+            )
+        except Exception as exc:
+            logger.warning("Cross-encoder %s не загружен, переранжирование выключено: %s", candidate.model_name, exc)
 
     yield
 
+    if retriever is not None and retriever.query_cache.path is not None:
+        saved = await asyncio.to_thread(retriever.query_cache.save)
+        logger.info("Кэш векторов запросов сохранён: %d записей в %s", saved, retriever.query_cache.path)
     if llm_client:
         await llm_client.aclose()
+        llm_client.cache.close()
     logger.info("Сервер остановлен.")
 
 
@@ -418,6 +722,8 @@ app = FastAPI(
     version="2.1.0",
     lifespan=lifespan,
 )
+app.add_middleware(MetricsMiddleware)
+app.add_middleware(TracingMiddleware)
 
 
 # ════════════════════════════════════════════════════════════════════════════
@@ -445,17 +751,39 @@ async def _rag_err(request: Request, exc: RAGError):
 # ОБЩАЯ ЛОГИКА ПАЙПЛАЙНА
 # ════════════════════════════════════════════════════════════════════════════
 
+async def _rerank(query: str, results: list[dict], top_k: int, namespace: str, request_id: str) -> list[dict]:
+    """
+    Переранжирование в потоке. Бюджет соблюдает сам reranker (размер батча по
+    цене пары); если батч всё же затянулся вдвое дольше, запрос идёт дальше с
+    порядком ретривера, а досчитанные оценки попадут в кэш.
+    """
+    global _rerank_timeouts
+    timeout = reranker.budget_ms * RERANK_TIMEOUT_FACTOR / 1000
+    try:
+        return await asyncio.wait_for(
+            asyncio.to_thread(reranker.rerank, query, results, top_k, namespace), timeout
+        )
+    except asyncio.TimeoutError:
+        _rerank_timeouts += 1
+        logger.warning("[%s] Переранжирование не уложилось в %.0fms", request_id, timeout * 1000)
+        return results[:top_k]
+
+
+@traced("run_pipeline")
 async def _run_pipeline(
     anamnesis: str,
     top_k: int,
     request_id: str = "",
     skip_symptom_extraction: bool = False,
+    use_cache: bool = True,
 ) -> tuple[str, dict, list[dict], dict]:
     """
     Выполняет полный RAG-пайплайн и возвращает:
       (diagnosis_text, symptom_data, rag_results, timing)
+    use_cache=False — оба LLM-вызова мимо кэша ответов.
     """
     total_start = time.perf_counter()
+    current_span().set("request.id", request_id)
 
     symptom_extraction_ms = 0
     symptom_data = {"symptoms": [], "duration": None, "severity": None}
@@ -471,11 +799,15 @@ async def _run_pipeline(
             temperature=0.1,
             max_tokens=512,
             request_id=request_id,
+            prompts_version=prompt_store.version,
+            use_cache=use_cache,
         )
         symptom_extraction_ms = int((time.perf_counter() - t1) * 1000)
+        observe_stage("symptom_extraction", symptom_extraction_ms / 1000)
 
         try:
-            symptom_data = extract_json_from_llm(symptom_raw)
+            with stage("json_parse"):
+                symptom_data = extract_json_from_llm(symptom_raw)
         except SymptomExtractionError:
             logger.warning("[%s] Fallback: не удалось распарсить симптомы", request_id)
             symptom_data = {"symptoms": [anamnesis[:300]], "duration": None, "severity": None}
@@ -483,27 +815,45 @@ async def _run_pipeline(
     # ── Шаг 2: RAG-поиск ─────────────────────────────────────────────────
     rag_results: list[dict] = []
     rag_search_ms = 0
+    rerank_ms = 0
+    rerank = reranker
 
-    if retriever is not None:
+    rag = retriever   # индекс может быть подменён во время запроса (/admin/reload-index)
+    if rag is not None:
         search_query = prepare_rag_query(anamnesis)
         logger.info("[%s] RAG запрос (%d симв.): %s...", request_id, len(search_query), search_query[:80])
 
         t2 = time.perf_counter()
-        rag_results = await asyncio.to_thread(
-            retriever.search_for_diagnosis, search_query, top_k
-        )
+        depth = max(top_k, Config.RERANK_CANDIDATES) if rerank is not None else top_k
+        with span("rag_search", **{"rag.query_chars": len(search_query), "rag.top_k": depth}) as rag_span:
+            rag_results = await rag_batcher.search_for_diagnosis(rag, search_query, depth)
+            rag_span.set("rag.protocols", len(rag_results))
         rag_search_ms = int((time.perf_counter() - t2) * 1000)
+        observe_stage("rag_search", rag_search_ms / 1000)
         logger.info("[%s] RAG: %d протоколов за %dms", request_id, len(rag_results), rag_search_ms)
 
+        if rerank is not None and rag_results:
+            t_rerank = time.perf_counter()
+            n_candidates = len(rag_results)
+            with span("rerank", **{"rerank.candidates": n_candidates}):
+                rag_results = await _rerank(search_query, rag_results, top_k, rag.version, request_id)
+            rerank_ms = int((time.perf_counter() - t_rerank) * 1000)
+            observe_stage("rerank", rerank_ms / 1000)
+            logger.info("[%s] Переранжирование: %d → %d за %dms", request_id, n_candidates, len(rag_results), rerank_ms)
+
     # ── Шаг 3: постановка диагноза (LLM с собственными знаниями + RAG контекст) ──
     t3 = time.perf_counter()
 
     # Формируем контекст из RAG-протоколов (если есть)
     protocol_section = ""
-    if rag_results:
+    context_results = rag_results
+    if rerank is not None and Config.RERANK_TOP_N > 0:
+        # После переранжирования хватает меньшего числа протоколов — короче промпт
+        context_results = rag_results[:Config.RERANK_TOP_N]
+    if context_results:
         protocol_section = (
             f"\n\n## Справочная информация из клинических протоколов РК\n\n"
-            f"{build_protocol_context(rag_results)}\n"
+            f"{build_protocol_context(context_results)}\n"
         )
 
     user_msg = (
@@ -524,8 +874,11 @@ async def _run_pipeline(
         temperature=0.1,
         max_tokens=1024,
         request_id=request_id,
+        prompts_version=prompt_store.version,
+        use_cache=use_cache,
     )
     diagnosis_ms = int((time.perf_counter() - t3) * 1000)
+    observe_stage("diagnosis", diagnosis_ms / 1000)
     total_ms     = int((time.perf_counter() - total_start) * 1000)
 
     logger.info("[%s] Диагноз готов за %dms (total=%dms)", request_id, diagnosis_ms, total_ms)
@@ -533,6 +886,7 @@ async def _run_pipeline(
     timing = {
         "symptom_extraction_ms": symptom_extraction_ms,
         "rag_search_ms":         rag_search_ms,
+        "rerank_ms":             rerank_ms,
         "diagnosis_ms":          diagnosis_ms,
         "total_ms":              total_ms,
     }
@@ -543,14 +897,20 @@ async def _run_pipeline(
 # ЭНДПОИНТЫ
 # ════════════════════════════════════════════════════════════════════════════
 
+def _cache_allowed(cache_control: str | None) -> bool:
+    """`Cache-Control: no-cache` (или no-store) — запрос идёт мимо кэша ответов LLM."""
+    directives = (cache_control or "").lower()
+    return "no-cache" not in directives and "no-store" not in directives
+
+
 @app.post("/predict", response_model=PredictResponse)
-async def predict(request: PredictRequest) -> PredictResponse:
+async def predict(request: PredictRequest, cache_control: str | None = Header(None)) -> PredictResponse:
     """Полный RAG-пайплайн, богатый структурированный ответ."""
     rid = f"req-{int(time.perf_counter() * 1000) % 1_000_000:06d}"
     logger.info("[%s] POST /predict | %d симв.", rid, len(request.anamnesis))
 
     diagnosis_text, symptom_data, rag_results, timing = await _run_pipeline(
-        request.anamnesis, request.top_k, rid
+        request.anamnesis, request.top_k, rid, use_cache=_cache_allowed(cache_control)
     )
 
     return PredictResponse(
@@ -575,7 +935,7 @@ async def predict(request: PredictRequest) -> PredictResponse:
 
 
 @app.post("/diagnose", response_model=DiagnoseResponse)
-async def diagnose(request: DiagnoseRequest) -> DiagnoseResponse:
+async def diagnose(request: DiagnoseRequest, cache_control: str | None = Header(None)) -> DiagnoseResponse:
     """
     Формат совместимый с evaluate.py.
     Принимает {symptoms}, возвращает {diagnoses: [{rank, diagnosis, icd10_code, explanation}]}.
@@ -587,7 +947,8 @@ async def diagnose(request: DiagnoseRequest) -> DiagnoseResponse:
         raise HTTPException(status_code=400, detail="'symptoms' не может быть пустым")
 
     diagnosis_text, symptom_data, rag_results, _ = await _run_pipeline(
-        request.symptoms, request.top_k, rid, skip_symptom_extraction=True
+        request.symptoms, request.top_k, rid, skip_symptom_extraction=True,
+        use_cache=_cache_allowed(cache_control),
     )
 
     # Формируем список диагнозов из протоколов + ICD-кодов из текста
@@ -652,19 +1013,77 @@ async def reload_prompts():
     }
 
 
+@app.post("/admin/reload-index")
+async def reload_index(
+    request: ReloadIndexRequest | None = None,
+    x_admin_token: str | None = Header(default=None),
+):
+    """
+    Горячая замена FAISS-индекса. Новый индекс загружается, проверяется и
+    прогревается в фоне; текущий продолжает обслуживать запросы до подмены.
+    Без wait отвечает 202 сразу, ход загрузки виден в /health (rag.reload).
+    Требует X-Admin-Token = ADMIN_TOKEN; index_dir — только внутри INDEX_ROOT.
+    """
+    global _index_reload_task
+    _check_admin_token(x_admin_token)
+    request = request or ReloadIndexRequest()
+    index_dir = _resolve_index_dir(request.index_dir)
+    if _index_reload_task is not None and not _index_reload_task.done():
+        raise HTTPException(status_code=409, detail="Перезагрузка индекса уже выполняется")
+
+    _index_reload_task = asyncio.create_task(_reload_index(index_dir))
+    if not request.wait:
+        return JSONResponse(status_code=202, content={"status": "loading", "index_dir": index_dir})
+
+    await asyncio.shield(_index_reload_task)
+    if _index_reload["status"] != "ok":
+        return JSONResponse(
+            status_code=422,
+            content={"status": "failed", "index_dir": index_dir, "detail": _index_reload.get("error")},
+        )
+    return {
+        "status": "reloaded",
+        "index_dir": index_dir,
+        "version": retriever.version,
+        "total_vectors": retriever.index.ntotal,
+        "load_ms": retriever.load_ms,
+    }
+
+
+@app.get("/metrics")
+async def metrics():
+    """Метрики Prometheus (только этого процесса)."""
+    return Response(render_metrics(), media_type=METRICS_CONTENT_TYPE)
+
+
 @app.get("/health")
 async def health():
     return {
         "status": "ok",
-        "llm": {"model": Config.MODEL, "base_url": Config.BASE_URL},
+        "llm": {
+            "model": Config.MODEL,
+            "base_url": Config.BASE_URL,
+            "cache": llm_client.cache.stats() if llm_client and llm_client.cache else None,
+        },
         "rag": {
             "loaded": retriever is not None,
             "total_vectors": retriever.index.ntotal if retriever else 0,
+            "index_dir": str(retriever.index_dir) if retriever else None,
+            "version": retriever.version if retriever else None,
+            "loaded_at": retriever.loaded_at if retriever else None,
+            "load_ms": retriever.load_ms if retriever else None,
+            "encoder": retriever.encoder_backend if retriever else None,
+            "hybrid": retriever.hybrid if retriever else None,
+            "query_cache": retriever.query_cache.stats() if retriever else None,
+            "batching": rag_batcher.stats() if rag_batcher else None,
+            "reload": dict(_index_reload),
         },
+        "rerank": {"enabled": True, **reranker.stats(), "timeouts": _rerank_timeouts} if reranker else {"enabled": False},
         "prompts": {
             "version": prompt_store.version if prompt_store else None,
             "file": Config.PROMPTS_FILE,
         },
+        "tracing": tracing_stats(),
     }
 
 
@@ -0,0 +1,104 @@
+"""
+token_chunker.py — Разбивка текста на чанки по токенам модели эмбеддингов.
+
+Символьные чанки не знают о лимите модели: у paraphrase-multilingual-MiniLM
+max_seq_length = 128 токенов, и хвост 512-символьного чанка просто
+обрезается энкодером. TokenChunker режет по токенизатору той же модели:
+каждый чанк (вместе со служебными [CLS]/[SEP]) помещается в max_seq_length,
+перекрытие задаётся в токенах. Границы по возможности сдвигаются к концу
+абзаца, предложения или слова.
+
+Заголовки протокола (название, МКБ-10) в текст чанка не добавляются — они
+хранятся отдельными полями в хранилище чанков.
+
+Нужен «быстрый» токенизатор HuggingFace (return_offsets_mapping).
+
+Использование:
+    chunker = TokenChunker.from_model(model_name, overlap=16)
+    chunks = chunker.split_text(text)
+"""
+
+from typing import Optional
+
+DEFAULT_OVERLAP_TOKENS = 16
+_SENTENCE_END = (".", "!", "?", ";", ":")
+
+
+class TokenChunker:
+    def __init__(self, tokenizer, max_tokens: int, overlap: int = DEFAULT_OVERLAP_TOKENS):
+        """max_tokens — лимит модели вместе со служебными токенами."""
+        self.tokenizer = tokenizer
+        self.max_tokens = max_tokens
+        self.budget = max_tokens - tokenizer.num_special_tokens_to_add()
+        if self.budget <= 0:
+            raise ValueError(f"Слишком маленький лимит чанка: {max_tokens} токенов")
+        self.overlap = max(0, min(overlap, self.budget // 2))
+
+    @classmethod
+    def from_model(
+        cls,
+        model_name: str,
+        max_tokens: Optional[int] = None,
+        overlap: int = DEFAULT_OVERLAP_TOKENS,
+    ) -> "TokenChunker":
+        """Токенизатор и max_seq_length берутся из sentence-transformers модели; max_tokens не больше него."""
+        from sentence_transformers import SentenceTransformer
+
+        model = SentenceTransformer(model_name, device="cpu")
+        limit = model.max_seq_length
+        return cls(model.tokenizer, min(max_tokens, limit) if max_tokens else limit, overlap)
+
+    def _offsets(self, text: str) -> list[tuple[int, int]]:
+        enc = self.tokenizer(
+            text, add_special_tokens=False, return_offsets_mapping=True, verbose=False
+        )
+        return [tuple(o) for o in enc["offset_mapping"]]
+
+    def count(self, text: str) -> int:
+        return len(self._offsets(text))
+
+    def _cut(self, text: str, offsets: list, start: int, end: int) -> int:
+        """Конец чанка (не включая) в [start + budget/2, end]: абзац > предложение > слово."""
+        word = None
+        for i in range(end, start + self.budget // 2, -1):
+            gap = text[offsets[i - 1][1]:offsets[i][0]]
+            if "\n" in gap:
+                return i
+            if gap and text[offsets[i - 1][1] - 1] in _SENTENCE_END:
+                return i
+            if gap and word is None:
+                word = i
+        return word or end
+
+    def _word_start(self, text: str, offsets: list, i: int, limit: int) -> int:
+        """Первый токен, начинающий слово, в [i, limit); иначе i."""
+        for j in range(i, limit):
+            if j == 0 or offsets[j][0] > offsets[j - 1][1]:
+                return j
+        return i
+
+    def split_text(self, text: str) -> list[str]:
+        offsets = self._offsets(text)
+        n = len(offsets)
+        if n <= self.budget:
+            return [text.strip()] if text.strip() else []
+
+        chunks = []
+        start = 0
+        while start < n:
+            end = min(start + self.budget, n)
+            if end < n:
+                end = self._cut(text, offsets, start, end)
+            chunk = text[offsets[start][0]:offsets[end - 1][1]].strip()
+            # Повторная токенизация подстроки может дать чуть больше токенов на стыке слов
+            extra = self.count(chunk) - self.budget
+            while extra > 0 and end - start > 1:
+                end = max(start + 1, end - extra)
+                chunk = text[offsets[start][0]:offsets[end - 1][1]].strip()
+                extra = self.count(chunk) - self.budget
+            if chunk:
+                chunks.append(chunk)
+            if end >= n:
+                break
+            start = self._word_start(text, offsets, max(end - self.overlap, start + 1), end)
+        return chunks
@@ -0,0 +1,370 @@
+"""
+tracing.py — Трассировка запросов: вложенные спаны в OTLP/JSON, в локальный файл с ротацией.
+
+По сети ничего не уходит. Каждая завершённая трасса — одна строка в формате
+файлового экспортёра OpenTelemetry (ExportTraceServiceRequest: resourceSpans →
+scopeSpans → spans): файл читается jq, загружается в OpenTelemetry Collector
+(receiver otlpjsonfile) или импортируется в Jaeger позже.
+
+  with span("QazcodeClient.chat") as sp:
+      resp = await client.post(...)
+      sp.set("http.response.status_code", resp.status_code)
+
+  @traced()                       # спан с именем функции
+  def search_batch(self, ...): ...
+
+Вложенность — через ContextVar: задачи asyncio и asyncio.to_thread() наследуют
+родителя. metrics.stage() тоже открывает спан, так что стадии пайплайна
+(embed, faiss_search, bm25, llm, ...) становятся дочерними спанами сами.
+Спан с исключением получает статус ERROR и событие "exception". Спаны одной
+трассы копятся и пишутся, когда закрывается корневой; сериализация и запись
+на диск — в фоновом потоке.
+
+Переменные окружения:
+  TRACE_FILE          — файл спанов; пусто (по умолч.) — трассировка выключена, span() почти бесплатен
+  TRACE_MAX_BYTES     — размер файла для ротации (по умолч. 10 МБ)
+  TRACE_BACKUPS       — сколько старых файлов хранить (по умолч. 5)
+  TRACE_MIN_MS        — писать только трассы с корневым спаном не короче, мс (по умолч. 0)
+  TRACE_SERVICE_NAME  — атрибут ресурса service.name (по умолч. clindiag)
+"""
+
+import atexit
+import functools
+import inspect
+import json
+import logging
+import logging.handlers
+import os
+import queue
+import random
+import threading
+import time
+from contextlib import contextmanager
+from contextvars import ContextVar
+from typing import Any, Iterator, Optional, Sequence
+
+# Значения SpanKind / StatusCode из OTLP
+KIND_INTERNAL, KIND_SERVER, KIND_CLIENT = 1, 2, 3
+STATUS_UNSET, STATUS_OK, STATUS_ERROR = 0, 1, 2
+QUEUE_SIZE = 10_000  # трассы в очереди на запись; сверх этого — отбрасываются
+
+_current: ContextVar[Optional["Span"]] = ContextVar("current_span", default=None)
+
+
+class _Trace:
+    """Завершённые спаны одной трассы — до закрытия корневого."""
+
+    __slots__ = ("spans", "closed", "lock")
+
+    def __init__(self):
+        self.spans: list["Span"] = []
+        self.closed = False
+        self.lock = threading.Lock()
+
+
+class Span:
+    __slots__ = ("name", "kind", "trace_id", "span_id", "parent_id", "start_ns", "end_ns",
+                 "attributes", "events", "links", "status", "status_message", "_trace")
+
+    def __init__(self, name: str, kind: int, parent: Optional["Span"], attributes: dict[str, Any], links: Sequence["Span"]):
+        self.name = name
+        self.kind = kind
+        self.trace_id = parent.trace_id if parent is not None else f"{random.getrandbits(128):032x}"
+        self.span_id = f"{random.getrandbits(64):016x}"
+        self.parent_id = parent.span_id if parent is not None else ""
+        self._trace = parent._trace if parent is not None else _Trace()
+        self.attributes = dict(attributes)
+        self.events: list[dict] = []
+        self.links = [(link.trace_id, link.span_id) for link in links if link.trace_id]
+        self.status = STATUS_UNSET
+        self.status_message = ""
+        self.start_ns = time.time_ns()
+        self.end_ns = 0
+
+    def set(self, key: str, value: Any) -> None:
+        if value is not None:
+            self.attributes[key] = value
+
+    def add_event(self, name: str, **attributes: Any) -> None:
+        self.events.append({"name": name, "time_ns": time.time_ns(), "attributes": attributes})
+
+    def set_error(self, message: str) -> None:
+        self.status = STATUS_ERROR
+        self.status_message = message
+
+    @property
+    def duration_ms(self) -> float:
+        return ((self.end_ns or time.time_ns()) - self.start_ns) / 1e6
+
+
+class _NoopSpan(Span):
+    """Спан при выключенной трассировке: всё принимает, ничего не пишет."""
+
+    trace_id = span_id = ""
+
+    def __init__(self):
+        pass
+
+    def set(self, key: str, value: Any) -> None:
+        pass
+
+    def add_event(self, name: str, **attributes: Any) -> None:
+        pass
+
+    def set_error(self, message: str) -> None:
+        pass
+
+
+NOOP_SPAN = _NoopSpan()
+
+
+def _otlp_value(value: Any) -> dict:
+    if isinstance(value, bool):
+        return {"boolValue": value}
+    if isinstance(value, int):
+        return {"intValue": str(value)}
+    if isinstance(value, float):
+        return {"doubleValue": value}
+    if isinstance(value, (list, tuple)):
+        return {"arrayValue": {"values": [_otlp_value(v) for v in value]}}
+    return {"stringValue": str(value)}
+
+
+def _otlp_attributes(attributes: dict[str, Any]) -> list:
+    return [{"key": k, "value": _otlp_value(v)} for k, v in attributes.items()]
+
+
+def _otlp_span(s: Span) -> dict:
+    out = {
+        "traceId": s.trace_id,
+        "spanId": s.span_id,
+        "parentSpanId": s.parent_id,
+        "name": s.name,
+        "kind": s.kind,
+        "startTimeUnixNano": str(s.start_ns),
+        "endTimeUnixNano": str(s.end_ns),
+        "attributes": _otlp_attributes(s.attributes),
+        "status": {"code": s.status, "message": s.status_message} if s.status_message else {"code": s.status},
+    }
+    if s.events:
+        out["events"] = [
+            {"name": e["name"], "timeUnixNano": str(e["time_ns"]), "attributes": _otlp_attributes(e["attributes"])}
+            for e in s.events
+        ]
+    if s.links:
+        out["links"] = [{"traceId": t, "spanId": i} for t, i in s.links]
+    return out
+
+
+class SpanFileExporter:
+    """Фоновый поток: дописывает строки OTLP/JSON в файл с ротацией по размеру."""
+
+    def __init__(self, path: str, max_bytes: int, backups: int, service_name: str, min_ms: float = 0.0):
+        self.path = path
+        self.min_ms = min_ms
+        self.exported = 0
+        self.dropped = 0
+        directory = os.path.dirname(os.path.abspath(path))
+        os.makedirs(directory, exist_ok=True)
+        self._handler = logging.handlers.RotatingFileHandler(
+            path, maxBytes=max_bytes, backupCount=backups, encoding="utf-8"
+        )
+        self._resource = {
+            "attributes": _otlp_attributes({"service.name": service_name, "process.pid": os.getpid()})
+        }
+        self._queue: "queue.Queue[Optional[list[Span]]]" = queue.Queue(QUEUE_SIZE)
+        self._thread = threading.Thread(target=self._run, name="span-exporter", daemon=True)
+        self._thread.start()
+
+    def export(self, spans: list[Span]) -> None:
+        try:
+            self._queue.put_nowait(spans)
+        except queue.Full:
+            self.dropped += len(spans)
+
+    def _line(self, spans: list[Span]) -> str:
+        return json.dumps(
+            {
+                "resourceSpans": [{
+                    "resource": self._resource,
+                    "scopeSpans": [{"scope": {"name": "clindiag.tracing"}, "spans": [_otlp_span(s) for s in spans]}],
+                }]
+            },
+            ensure_ascii=False,
+            separators=(",", ":"),
+        )
+
+    def _run(self) -> None:
+        while True:
+            spans = self._queue.get()
+            if spans is None:
+                break
+            try:
+                self._handler.emit(logging.makeLogRecord({"msg": self._line(spans)}))
+                self.exported += len(spans)
+            except Exception as e:
+                self.dropped += len(spans)
+                print(f"  [!] Не удалось записать спаны: {e}")
+
+    def shutdown(self) -> None:
+        self._queue.put(None)
+        self._thread.join(timeout=5.0)
+        self._handler.close()
+
+    def stats(self) -> dict:
+        return {"file": self.path, "exported_spans": self.exported, "dropped_spans": self.dropped,
+                "queued_traces": self._queue.qsize(), "min_ms": self.min_ms}
+
+
+_exporter: Optional[SpanFileExporter] = None
+_configured = False
+_config_lock = threading.Lock()
+
+
+def configure(path: Optional[str] = None) -> Optional[SpanFileExporter]:
+    """Запускает экспортёр по TRACE_* (path заменяет TRACE_FILE). span() вызывает её сам при первом спане."""
+    global _exporter, _configured
+    with _config_lock:
+        if _configured and path is None:
+            return _exporter
+        path = (path if path is not None else os.getenv("TRACE_FILE", "")).strip()
+        if _exporter is not None:
+            _exporter.shutdown()
+            _exporter = None
+        if path:
+            try:
+                _exporter = SpanFileExporter(
+                    path,
+                    max_bytes=int(os.getenv("TRACE_MAX_BYTES", str(10 * 1024 * 1024))),
+                    backups=int(os.getenv("TRACE_BACKUPS", "5")),
+                    service_name=os.getenv("TRACE_SERVICE_NAME", "clindiag"),
+                    min_ms=float(os.getenv("TRACE_MIN_MS", "0")),
+                )
+            except OSError as e:
+                print(f"  [!] Трассировка выключена, не открыть {path}: {e}")
+        _configured = True
+        return _exporter
+
+
+def _exporter_or_none() -> Optional[SpanFileExporter]:
+    return _exporter if _configured else configure()
+
+
+@atexit.register
+def shutdown() -> None:
+    """Дописывает трассы из очереди и закрывает файл."""
+    global _exporter
+    with _config_lock:
+        if _exporter is not None:
+            _exporter.shutdown()
+            _exporter = None
+
+
+def stats() -> Optional[dict]:
+    exporter = _exporter_or_none()
+    return exporter.stats() if exporter is not None else None
+
+
+def current_span() -> Span:
+    """Текущий спан (NOOP_SPAN вне спанов или при выключенной трассировке)."""
+    return _current.get() or NOOP_SPAN
+
+
+def _finish(s: Span, exporter: SpanFileExporter) -> None:
+    trace = s._trace
+    with trace.lock:
+        if trace.closed:
+            # Пережил корневой спан (например, фоновая задача) — пишется отдельно
+            batch = [s]
+        elif s.parent_id:
+            trace.spans.append(s)
+            return
+        else:
+            trace.closed = True
+            batch, trace.spans = trace.spans + [s], []
+            if s.duration_ms < exporter.min_ms:
+                return
+    exporter.export(batch)
+
+
+@contextmanager
+def span(name: str, kind: int = KIND_INTERNAL, links: Sequence[Span] = (), **attributes: Any) -> Iterator[Span]:
+    exporter = _exporter_or_none()
+    if exporter is None:
+        yield NOOP_SPAN
+        return
+    parent = _current.get()
+    s = Span(name, kind, parent, attributes, links)
+    token = _current.set(s)
+    try:
+        yield s
+    except BaseException as e:
+        s.set_error(f"{type(e).__name__}: {e}")
+        s.add_event("exception", **{"exception.type": type(e).__name__, "exception.message": str(e)})
+        raise
+    finally:
+        _current.reset(token)
+        s.end_ns = time.time_ns()
+        _finish(s, exporter)
+
+
+def traced(name: Optional[str] = None, kind: int = KIND_INTERNAL):
+    """Декоратор: (sync или async) функция выполняется в спане name или с её qualname."""
+
+    def decorate(fn):
+        span_name = name or fn.__qualname__
+        if inspect.iscoroutinefunction(fn):
+            @functools.wraps(fn)
+            async def async_wrapper(*args, **kwargs):
+                with span(span_name, kind):
+                    return await fn(*args, **kwargs)
+            return async_wrapper
+
+        @functools.wraps(fn)
+        def wrapper(*args, **kwargs):
+            with span(span_name, kind):
+                return fn(*args, **kwargs)
+        return wrapper
+
+    return decorate
+
+
+class TracingMiddleware:
+    """
+    ASGI-middleware: корневой SERVER-спан на каждый HTTP-запрос с именем
+    "<METHOD> <шаблон маршрута>", функцией-обработчиком и кодом ответа; заголовок
+    X-Trace-Id в ответе — чтобы найти трассу в файле.
+    """
+
+    def __init__(self, app, skip: Sequence[str] = ("/metrics", "/health")):
+        self.app = app
+        self.skip = set(skip)
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] != "http" or scope["path"] in self.skip or _exporter_or_none() is None:
+            await self.app(scope, receive, send)
+            return
+        with span(scope["method"], KIND_SERVER, **{"http.request.method": scope["method"], "url.path": scope["path"]}) as s:
+
+            async def send_with_trace_id(message):
+                if message["type"] == "http.response.start":
+                    s.set("http.response.status_code", message["status"])
+                    if message["status"] >= 500:
+                        s.set_error(f"HTTP {message['status']}")
+                    headers = list(message.get("headers", []))
+                    headers.append((b"x-trace-id", s.trace_id.encode("ascii")))
+                    message = {**message, "headers": headers}
+                await send(message)
+
+            try:
+                await self.app(scope, receive, send_with_trace_id)
+            finally:
+                # Маршрут и обработчик роутер кладёт в scope
+                route = getattr(scope.get("route"), "path", None)
+                if route:
+                    s.name = f"{scope['method']} {route}"
+                    s.set("http.route", route)
+                endpoint = scope.get("endpoint")
+                if endpoint is not None:
+                    s.set("code.function", getattr(endpoint, "__name__", ""))
+                    s.set("code.namespace", getattr(endpoint, "__module__", ""))
@@ -4,27 +4,38 @@ Diagnosis engine: RAG (FAISS) + LLM → list of diagnoses.
 REPLACE THIS MODULE when you plug in your friend's high-accuracy model.
 Keep the same interface:
 
-  async def run_diagnosis(query: str, state: DiagnosisEngineState, system_prompt: str) -> list[dict]
+  async def run_diagnosis(query: str, state: DiagnosisEngineState, system_prompt: str, use_cache: bool = True) -> list[dict]
 
 Each returned dict must have: rank, icd10_code, diagnosis, explanation, protocol_id, medelement_url.
 """
 
+import asyncio
 import json
 import logging
+import time
 from typing import Any, List, Protocol
 
 from langchain_core.documents import Document
 from openai import APIError, APIConnectionError, RateLimitError
 
+from llm_cache import cache_key
+from metrics import stage
+from tracing import current_span, traced
+
 logger = logging.getLogger(__name__)
 
+LLM_TEMPERATURE = 0.1
+LLM_MAX_TOKENS = 1500
+
 
 class DiagnosisEngineState(Protocol):
     """State required by run_diagnosis (avoids circular import from main)."""
     faiss_index: Any
     faiss_metadata: Any
     embeddings: Any
+    query_cache: Any  # QueryEmbeddingCache or None
     llm_client: Any
+    llm_cache: Any  # LLMResponseCache or None
     model_id: str
     hf_model: Any
     hf_tokenizer: Any
@@ -66,29 +77,93 @@ def _generate_hf(model, tokenizer, system_prompt: str, user_prompt: str, max_new
     return response.strip() or "{}"
 
 
+def _parse_llm_json(raw: str) -> dict:
+    """The outermost {...} of the LLM reply as a dict ({} when it does not parse)."""
+    data: dict = {}
+    try:
+        if not raw or "{" not in raw:
+            data = {"diagnoses": []}
+        else:
+            start = raw.index("{")
+            end = raw.rindex("}") + 1
+            data = json.loads(raw[start:end])
+    except (ValueError, json.JSONDecodeError):
+        try:
+            data = json.loads(raw) if raw else {}
+        except json.JSONDecodeError:
+            data = {}
+    if not isinstance(data, dict):
+        data = {}
+    return data
+
+
+async def _complete(state: DiagnosisEngineState, messages: List[dict]) -> str:
+    """One LLM call: AsyncOpenAI when configured, else the local HF model in a worker thread."""
+    system_prompt, user_prompt = messages[0]["content"], messages[1]["content"]
+    with stage("llm") as llm_span:
+        llm_span.set("llm.prompt_chars", len(system_prompt) + len(user_prompt))
+        if state.llm_client is not None:
+            llm_span.set("llm.model", state.model_id)
+            try:
+                response = await state.llm_client.chat.completions.create(
+                    model=state.model_id,
+                    messages=messages,
+                    temperature=LLM_TEMPERATURE,
+                    max_tokens=LLM_MAX_TOKENS,
+                )
+            except APIError as e:
+                llm_span.set("http.response.status_code", getattr(e, "status_code", None))
+                raise
+            raw = response.choices[0].message.content
+            usage = getattr(response, "usage", None)
+            if usage is not None:
+                llm_span.set("llm.prompt_tokens", usage.prompt_tokens)
+                llm_span.set("llm.completion_tokens", usage.completion_tokens)
+        else:
+            raw = await asyncio.to_thread(
+                _generate_hf,
+                state.hf_model,
+                state.hf_tokenizer,
+                system_prompt,
+                user_prompt,
+            )
+        llm_span.set("llm.response_chars", len(raw or ""))
+    return raw
+
+
+@traced()
 async def run_diagnosis(
     query: str,
     state: DiagnosisEngineState,
     system_prompt: str,
+    use_cache: bool = True,
 ) -> List[dict]:
     """
     Run RAG + LLM and return list of diagnosis dicts.
     Each dict: rank, icd10_code, diagnosis, explanation, protocol_id.
+    use_cache=False skips the LLM response cache (no lookup, no store) for this request.
     Raises: APIConnectionError, RateLimitError, APIError on LLM failure.
     """
     import faiss
     import numpy as np
 
-    query_vec = state.embeddings.embed_query(query)
-    vec = np.array([query_vec], dtype=np.float32)
-    faiss.normalize_L2(vec)
-    k = min(5, state.faiss_index.ntotal)
-    distances, indices = state.faiss_index.search(vec, k)
+    # One snapshot for the whole request: /admin/reload-index may swap the index meanwhile
+    faiss_index, faiss_metadata = state.faiss_index, state.faiss_metadata
+    with stage("embed"):
+        if state.query_cache is not None:
+            query_vec = state.query_cache.get_or_compute(query, state.embeddings.embed_query)
+        else:
+            query_vec = state.embeddings.embed_query(query)
+    with stage("faiss_search"):
+        vec = np.array([query_vec], dtype=np.float32)
+        faiss.normalize_L2(vec)
+        k = min(5, faiss_index.ntotal)
+        distances, indices = faiss_index.search(vec, k)
     docs: List[Document] = []
     for idx in indices[0]:
         if idx < 0:
             continue
-        meta = state.faiss_metadata[idx]
+        meta = faiss_metadata[idx]
         docs.append(Document(
             page_content=meta.get("text", ""),
             metadata={"protocol_id": meta.get("protocol_id", ""), "icd_codes": meta.get("icd_codes", [])},
@@ -100,49 +175,38 @@ async def run_diagnosis(
         context = "\n\n---\n\n".join(context_parts)
 
     logger.info("Retrieved %s chunks", len(docs))
+    current_span().set("rag.chunks", len(docs))
     logger.info("QUERY: %s", query[:300] + ("..." if len(query) > 300 else ""))
     user_prompt = f"ЖАЛОБЫ ПАЦИЕНТА:\n{query}\n\nНАЙДЕННЫЕ ПРОТОКОЛЫ:\n{context}"
 
-    if state.llm_client is not None:
-        response = await state.llm_client.chat.completions.create(
-            model=state.model_id,
-            messages=[
-                {"role": "system", "content": system_prompt},
-                {"role": "user", "content": user_prompt},
-            ],
-            temperature=0.1,
-            max_tokens=1500,
-        )
-        raw = response.choices[0].message.content
-    else:
-        import asyncio
-        raw = await asyncio.to_thread(
-            _generate_hf,
-            state.hf_model,
-            state.hf_tokenizer,
-            system_prompt,
-            user_prompt,
-        )
+    messages = [
+        {"role": "system", "content": system_prompt},
+        {"role": "user", "content": user_prompt},
+    ]
+    # Exact-match response cache (AsyncOpenAI path only); a hit records llm_cache but no llm stage
+    cache = state.llm_cache if state.llm_client is not None else None
+    key, raw = None, None
+    if cache is not None and cache.enabled:
+        with stage("llm_cache") as cache_span:
+            if use_cache:
+                key = cache_key(state.model_id, messages, LLM_TEMPERATURE, LLM_MAX_TOKENS)
+                raw = await asyncio.to_thread(cache.get, key)
+            else:
+                cache.record_bypass()
+            cache_span.set("llm.cache", "bypass" if key is None else ("hit" if raw is not None else "miss"))
+
+    if raw is None:
+        t0 = time.perf_counter()
+        raw = await _complete(state, messages)
+        if key is not None and raw:
+            await asyncio.to_thread(cache.put, key, state.model_id, raw, (time.perf_counter() - t0) * 1000)
 
     if not raw:
         raw = "{}"
     logger.info("RAW LLM RESPONSE: %s", raw[:800] + ("..." if len(raw) > 800 else ""))
 
-    data: dict = {}
-    try:
-        if not raw or "{" not in raw:
-            data = {"diagnoses": []}
-        else:
-            start = raw.index("{")
-            end = raw.rindex("}") + 1
-            data = json.loads(raw[start:end])
-    except (ValueError, json.JSONDecodeError):
-        try:
-            data = json.loads(raw) if raw else {}
-        except json.JSONDecodeError:
-            data = {}
-    if not isinstance(data, dict):
-        data = {}
+    with stage("json_parse"):
+        data = _parse_llm_json(raw)
 
     raw_diagnoses = data.get("diagnoses", [])
     if not raw_diagnoses and isinstance(data, dict) and ("icd10_code" in data or "code" in data or "icd_code" in data):
@@ -174,4 +238,5 @@ async def run_diagnosis(
             "protocol_id": pid,
             "medelement_url": _medelement_url(code),
         })
+    current_span().set("diagnoses", len(out))
     return out
@@ -0,0 +1,111 @@
+"""
+On-disk embedding cache for ingest (SQLite, stdlib only).
+
+Keyed by (embedding model name, sha256 of the whitespace/NFC-normalized chunk text) and holding
+L2-normalized float32 vectors, so a chunking or header change only re-embeds texts that are new.
+Same schema as clindiag/embedding_cache.py, so both builds can point at one cache file.
+Size-bounded: least recently used rows are evicted once max_bytes is exceeded.
+"""
+import hashlib
+import logging
+import re
+import sqlite3
+import time
+import unicodedata
+from pathlib import Path
+from typing import List, Optional
+
+import numpy as np
+
+logger = logging.getLogger(__name__)
+
+_WS = re.compile(r"\s+")
+
+
+def normalize_text(text: str) -> str:
+    """NFC + collapsed whitespace; shared with the query-vector cache (query_cache.py)."""
+    return _WS.sub(" ", unicodedata.normalize("NFC", text)).strip()
+
+
+def text_key(text: str) -> bytes:
+    return hashlib.sha256(normalize_text(text).encode("utf-8")).digest()
+
+
+class EmbeddingCache:
+    def __init__(self, path: Path, model_name: str, max_bytes: int = 2 * 1024 ** 3):
+        Path(path).parent.mkdir(parents=True, exist_ok=True)
+        self.model_name = model_name
+        self.max_bytes = max_bytes
+        self.hits = self.misses = self.evicted = 0
+        self._db = sqlite3.connect(str(path))
+        self._db.execute("PRAGMA journal_mode=WAL")
+        self._db.execute(
+            "CREATE TABLE IF NOT EXISTS embeddings ("
+            " model TEXT NOT NULL, key BLOB NOT NULL, vec BLOB NOT NULL,"
+            " last_used REAL NOT NULL, PRIMARY KEY (model, key)) WITHOUT ROWID"
+        )
+        self._db.execute("CREATE INDEX IF NOT EXISTS embeddings_lru ON embeddings(last_used)")
+        self._db.commit()
+        self._bytes = self._db.execute("SELECT COALESCE(SUM(LENGTH(vec)), 0) FROM embeddings").fetchone()[0]
+
+    def get_many(self, texts: List[str]) -> List[Optional[np.ndarray]]:
+        keys = [text_key(t) for t in texts]
+        found = {}
+        unique = list(dict.fromkeys(keys))
+        for start in range(0, len(unique), 500):
+            part = unique[start : start + 500]
+            placeholders = ",".join("?" * len(part))
+            for key, vec in self._db.execute(
+                f"SELECT key, vec FROM embeddings WHERE model = ? AND key IN ({placeholders})",
+                [self.model_name, *part],
+            ):
+                found[key] = np.frombuffer(vec, dtype=np.float32)
+        if found:
+            now = time.time()
+            self._db.executemany(
+                "UPDATE embeddings SET last_used = ? WHERE model = ? AND key = ?",
+                [(now, self.model_name, k) for k in found],
+            )
+            self._db.commit()
+        out = [found.get(k) for k in keys]
+        hit = sum(v is not None for v in out)
+        self.hits += hit
+        self.misses += len(out) - hit
+        return out
+
+    def put_many(self, texts: List[str], vectors: np.ndarray) -> None:
+        now = time.time()
+        rows = [(self.model_name, text_key(t), np.asarray(v, dtype=np.float32).tobytes(), now) for t, v in zip(texts, vectors)]
+        self._db.executemany("INSERT OR REPLACE INTO embeddings VALUES (?, ?, ?, ?)", rows)
+        self._db.commit()
+        self._bytes += sum(len(r[2]) for r in rows)
+        if self._bytes > self.max_bytes:
+            self._evict(int(self.max_bytes * 0.9))
+
+    def _evict(self, target: int) -> None:
+        while self._bytes > target:
+            rows = self._db.execute(
+                "SELECT model, key, LENGTH(vec) FROM embeddings ORDER BY last_used LIMIT 10000"
+            ).fetchall()
+            if not rows:
+                break
+            doomed, freed = [], 0
+            for model, key, size in rows:
+                doomed.append((model, key))
+                freed += size
+                if self._bytes - freed <= target:
+                    break
+            self._db.executemany("DELETE FROM embeddings WHERE model = ? AND key = ?", doomed)
+            self._bytes -= freed
+            self.evicted += len(doomed)
+        self._db.commit()
+
+    def log_stats(self) -> None:
+        total = self.hits + self.misses
+        logger.info(
+            "Embedding cache: %s hits, %s misses (%.1f%% hit rate), %s evicted, %.1f MB on disk",
+            self.hits, self.misses, 100.0 * self.hits / total if total else 0.0, self.evicted, self._bytes / 1024 ** 2,
+        )
+
+    def close(self) -> None:
+        self._db.close()
@@ -0,0 +1,363 @@
+"""
+Compact, lazily-read metadata store for the FAISS index (replaces metadata.json).
+
+Layout in data/faiss_index/, every file stamped with the build id of the ingest run that wrote it:
+  index.<build>.faiss   — the FAISS index
+  headers.<build>.json  — protocol headers (protocol_id, title, icd_codes), stored once per protocol
+  chunks.<build>.bin    — chunk bodies, UTF-8, back to back
+  rows.<build>.npy      — int64[next_id, 3] indexed by FAISS vector id: header row (-1 = removed), offset, length
+  also.<build>.npy      — int64[m, 2] (vector id, header row) sorted by id: other protocols containing a
+                          near-identical chunk that was collapsed into this vector (see near_dup.py)
+  signatures.<build>.bin — uint32[next_id, num_perm] MinHash signatures by vector id (ingest only, when
+                          near-duplicate collapsing is on)
+  current.json          — {"build": ..., "index": file name, "headers": ..., ...}: the published build
+
+Ingest writes a new build next to the old one and then replaces current.json (one os.replace), so a
+reader that resolves current.json once always gets an index and a store from the same build. The
+files of the previous build are kept until the next publish for readers that resolved it just before.
+chunks and signatures are append-only and carried over from build to build under the name of the
+build that started them: an older build never reads past the bytes it was published with. Chunks are
+rewritten under a new name once removed bodies outweigh live ones.
+Directories written before build stamps (index.faiss, headers.json, chunks.bin, rows.npy, also.npy)
+are still read; the first stamped publish removes them.
+
+The store is opened with mmap, so loading is O(1) and a lookup by vector id decodes one chunk.
+Rows come back in the shape the old metadata.json had: text (with the "ID ПРОТОКОЛА / НАЗВАНИЕ /
+ОФИЦИАЛЬНЫЕ КОДЫ МКБ-10" header the prompt relies on), protocol_id, icd_codes.
+
+read_faiss_index() maps index.faiss read-only as well, so uvicorn workers share one page-cache copy
+of the vectors instead of each holding its own.
+"""
+import hashlib
+import json
+import logging
+import mmap
+import os
+import re
+import secrets
+import threading
+import time
+from pathlib import Path
+from typing import Dict, List, Optional
+
+import numpy as np
+
+CURRENT_FILE = "current.json"
+# File names before build stamps (and of the metadata.json era)
+LEGACY_FILES = {"index": "index.faiss", "headers": "headers.json", "chunks": "chunks.bin", "rows": "rows.npy", "also": "also.npy"}
+_BUILD_FILE = re.compile(r"^(index|headers|chunks|rows|also|signatures)\.(\d{8}T\d{6}-[0-9a-f]{6})\.(faiss|json|bin|npy)$")
+
+logger = logging.getLogger(__name__)
+
+
+def _codes_str(icd_codes: List[str]) -> str:
+    return ", ".join(icd_codes) if icd_codes else "Коды не указаны"
+
+
+def enriched_text(protocol_id: str, title: str, icd_codes: List[str], body: str, also: List[dict] = ()) -> str:
+    """Chunk text with its protocol header; `also` lists the other protocols sharing the chunk."""
+    also_lines = "".join(
+        f"ТАКЖЕ В ПРОТОКОЛЕ: {a['protocol_id']} ({a['title']}), ОФИЦИАЛЬНЫЕ КОДЫ МКБ-10: {_codes_str(a['icd_codes'])}\n"
+        for a in also
+    )
+    return (
+        f"ID ПРОТОКОЛА: {protocol_id}\n"
+        f"НАЗВАНИЕ: {title}\n"
+        f"ОФИЦИАЛЬНЫЕ КОДЫ МКБ-10: {_codes_str(icd_codes)}\n{also_lines}---\n{body}"
+    )
+
+
+def prefetch_file(path: str, block: int = 1024 ** 2) -> None:
+    """Read the file sequentially so its pages land in the page cache."""
+    buf = bytearray(block)
+    with open(path, "rb", buffering=0) as f:
+        while f.readinto(buf):
+            pass
+
+
+def read_faiss_index(path: str, use_mmap: bool = True, prefetch: bool = False):
+    """faiss.read_index, mmap'ed read-only when possible; prefetch warms the page cache in the background."""
+    import faiss
+
+    if use_mmap:
+        # IO_FLAG_MMAP_IFC (FAISS >= 1.10) maps the codes of any index; older versions only map IVF lists.
+        flags = getattr(faiss, "IO_FLAG_MMAP_IFC", faiss.IO_FLAG_MMAP) | faiss.IO_FLAG_READ_ONLY
+        try:
+            index = faiss.read_index(str(path), flags)
+        except RuntimeError as e:
+            logger.warning("mmap load of %s failed (%s); reading into memory", path, e)
+        else:
+            if prefetch:
+                threading.Thread(target=prefetch_file, args=(str(path),), name="faiss-prefetch", daemon=True).start()
+            return index
+    return faiss.read_index(str(path))
+
+
+def new_build_id() -> str:
+    return time.strftime("%Y%m%dT%H%M%S") + "-" + secrets.token_hex(3)
+
+
+def build_file(kind: str, build: str) -> str:
+    ext = {"index": "faiss", "headers": "json", "chunks": "bin", "rows": "npy", "also": "npy", "signatures": "bin"}[kind]
+    return f"{kind}.{build}.{ext}"
+
+
+def store_files(index_dir: Path) -> Optional[dict]:
+    """File names of the published build (current.json); the fixed pre-stamp names with build None; None if absent."""
+    index_dir = Path(index_dir)
+    current = index_dir / CURRENT_FILE
+    if current.exists():
+        with open(current, "r", encoding="utf-8") as f:
+            return json.load(f)
+    if all((index_dir / LEGACY_FILES[k]).exists() for k in ("index", "headers", "chunks", "rows")):
+        return {"build": None, **LEGACY_FILES}
+    return None
+
+
+def publish_build(index_dir: Path, files: dict) -> None:
+    """Point current.json at `files` in one os.replace, then delete builds other than this one and the previous."""
+    index_dir = Path(index_dir)
+    previous = store_files(index_dir) or {}
+    tmp = index_dir / (CURRENT_FILE + ".tmp")
+    with open(tmp, "w", encoding="utf-8") as f:
+        json.dump(files, f, ensure_ascii=False)
+    os.replace(tmp, index_dir / CURRENT_FILE)
+
+    keep = {name for name in (*files.values(), *previous.values()) if isinstance(name, str)}
+    for path in index_dir.iterdir():
+        stale = _BUILD_FILE.match(path.name) or path.name in LEGACY_FILES.values() or path.name == "metadata.json"
+        if stale and path.name not in keep:
+            path.unlink(missing_ok=True)
+
+
+def index_version(index_dir: Path) -> str:
+    """Build id of the published index; for unstamped directories a hash of size + mtime of the files."""
+    files = store_files(index_dir)
+    if files is not None and files.get("build"):
+        return files["build"]
+    h = hashlib.sha1()
+    for name in ("index.faiss", LEGACY_FILES["rows"], LEGACY_FILES["chunks"], "metadata.json"):
+        path = Path(index_dir) / name
+        if path.exists():
+            st = path.stat()
+            h.update(f"{name}:{st.st_size}:{st.st_mtime_ns};".encode())
+    return h.hexdigest()[:12]
+
+
+def store_exists(index_dir: Path) -> bool:
+    return store_files(index_dir) is not None
+
+
+def _header_key(h: dict) -> tuple:
+    return h["protocol_id"], h["title"], tuple(h["icd_codes"])
+
+
+class StoreWriter:
+    """Write side for ingest: starts from a published build (or empty) and writes the next one.
+
+    Only changed vector ids are touched: removed rows are marked, bodies of new chunks are appended to
+    the chunks file, new signatures to the signatures file; rows, headers and also are small and are
+    written out whole under the new build's names.
+    """
+
+    def __init__(self, index_dir: Path, files: Optional[dict] = None):
+        self.index_dir = Path(index_dir)
+        self.files = dict(files or {})
+        if files:
+            with open(self.index_dir / files["headers"], "r", encoding="utf-8") as f:
+                self.headers: List[dict] = json.load(f)
+            self.rows = np.load(self.index_dir / files["rows"])
+            also_path = self.index_dir / files["also"]
+            self.also = np.load(also_path) if also_path.exists() else np.zeros((0, 2), dtype=np.int64)
+        else:
+            self.headers, self.rows, self.also = [], np.zeros((0, 3), dtype=np.int64), np.zeros((0, 2), dtype=np.int64)
+        self._header_rows = {_header_key(h): i for i, h in enumerate(self.headers)}
+        self._new: Dict[int, tuple] = {}          # vector id -> (header row, body bytes)
+        self._new_sigs: Dict[int, np.ndarray] = {}
+        self._links: Dict[tuple, int] = {}        # (vector id, protocol_id) -> header row
+
+    def __len__(self) -> int:
+        return int((self.rows[:, 0] >= 0).sum()) + len(self._new)
+
+    def _header_row(self, c: dict) -> int:
+        key = _header_key(c)
+        if key not in self._header_rows:
+            self._header_rows[key] = len(self.headers)
+            self.headers.append({"protocol_id": c["protocol_id"], "title": c["title"], "icd_codes": list(c["icd_codes"])})
+        return self._header_rows[key]
+
+    def live_ids(self) -> np.ndarray:
+        """Ids of the kept rows of the previous build."""
+        return np.flatnonzero(self.rows[:, 0] >= 0)
+
+    def protocol_of(self, vector_id: int) -> str:
+        row = self._new[vector_id][0] if vector_id in self._new else int(self.rows[vector_id, 0])
+        return self.headers[row]["protocol_id"]
+
+    def also_protocols(self, vector_id: int) -> List[str]:
+        lo, hi = np.searchsorted(self.also[:, 0], [vector_id, vector_id + 1])
+        return [self.headers[int(h)]["protocol_id"] for h in self.also[lo:hi, 1]]
+
+    def signatures(self, num_perm: int) -> Optional[np.ndarray]:
+        """Stored MinHash signatures of the previous build, uint32[len(rows), num_perm]; None if not stored."""
+        name = self.files.get("signatures")
+        count = len(self.rows) * num_perm
+        if not name or not (self.index_dir / name).exists() or (self.index_dir / name).stat().st_size < count * 4:
+            return None
+        return np.fromfile(self.index_dir / name, dtype=np.uint32, count=count).reshape(len(self.rows), num_perm)
+
+    def remove(self, vector_ids, protocol_ids) -> None:
+        """Drops rows of vector_ids and every also link to protocol_ids."""
+        ids = np.asarray(list(vector_ids), dtype=np.int64)
+        self.rows[ids] = (-1, 0, 0)
+        protocol_ids = set(protocol_ids)
+        gone = [i for i, h in enumerate(self.headers) if h["protocol_id"] in protocol_ids]
+        self.also = self.also[~(np.isin(self.also[:, 0], ids) | np.isin(self.also[:, 1], gone))]
+
+    def add(self, vector_id: int, chunk: dict, signature: Optional[np.ndarray] = None) -> None:
+        """chunk: {protocol_id, title, icd_codes, body}; ids must continue the previous build's next_id."""
+        self._new[vector_id] = (self._header_row(chunk), chunk["body"].encode("utf-8"))
+        if signature is not None:
+            self._new_sigs[vector_id] = signature
+
+    def link(self, vector_id: int, chunk: dict) -> None:
+        """Records that chunk's protocol also contains the chunk stored under vector_id."""
+        self._links.setdefault((vector_id, chunk["protocol_id"]), self._header_row(chunk))
+
+    def _write_chunks(self, rows: np.ndarray, build: str) -> str:
+        name = self.files.get("chunks")
+        path = self.index_dir / name if name else None
+        old_live = self.rows[:, 0] >= 0
+        live_bytes = int(self.rows[old_live, 2].sum()) + sum(len(body) for _, body in self._new.values())
+        dead_bytes = (path.stat().st_size if path else 0) - int(self.rows[old_live, 2].sum())
+        if path is not None and _BUILD_FILE.match(name) and dead_bytes <= live_bytes:
+            with open(path, "ab") as f:
+                offset = os.fstat(f.fileno()).st_size
+                for vid in sorted(self._new):
+                    header_row, body = self._new[vid]
+                    f.write(body)
+                    rows[vid] = (header_row, offset, len(body))
+                    offset += len(body)
+            return name
+
+        # First build, pre-stamp layout or mostly dead bytes: copy live bodies into a fresh file
+        name = build_file("chunks", build)
+        offset = 0
+        with open(self.index_dir / name, "wb") as f:
+            if path is not None:
+                with open(path, "rb") as old:
+                    for vid in np.flatnonzero(old_live):
+                        old.seek(int(self.rows[vid, 1]))
+                        body = old.read(int(self.rows[vid, 2]))
+                        f.write(body)
+                        rows[vid, 1:] = (offset, len(body))
+                        offset += len(body)
+            for vid in sorted(self._new):
+                header_row, body = self._new[vid]
+                f.write(body)
+                rows[vid] = (header_row, offset, len(body))
+                offset += len(body)
+        return name
+
+    def _write_signatures(self, next_id: int, build: str) -> Optional[str]:
+        if not self._new_sigs and not self.files.get("signatures"):
+            return None
+        name = self.files.get("signatures") or build_file("signatures", build)
+        num_perm = len(next(iter(self._new_sigs.values()))) if self._new_sigs else 0
+        start = len(self.rows)
+        path = self.index_dir / name
+        with open(path, "r+b" if path.exists() else "wb") as f:
+            if num_perm:
+                # drop whatever an interrupted run appended past the previous build
+                f.truncate(start * num_perm * 4)
+                f.seek(start * num_perm * 4)
+                blank = np.zeros(num_perm, dtype=np.uint32)
+                for vid in range(start, next_id):
+                    f.write(self._new_sigs.get(vid, blank).astype(np.uint32).tobytes())
+        return name
+
+    def write(self, next_id: int, build: str) -> dict:
+        """Writes the store for `build` next to the previous one; returns the file names (for publish_build)."""
+        rows = np.full((next_id, 3), -1, dtype=np.int64)
+        rows[:, 1:] = 0
+        rows[: len(self.rows)] = self.rows
+        files = {kind: build_file(kind, build) for kind in ("headers", "rows", "also")}
+        files["chunks"] = self._write_chunks(rows, build)
+        signatures = self._write_signatures(next_id, build)
+        if signatures:
+            files["signatures"] = signatures
+
+        also = np.concatenate([self.also, np.array([(vid, row) for (vid, _), row in self._links.items()], dtype=np.int64).reshape(-1, 2)])
+        also = also[np.argsort(also[:, 0], kind="stable")]
+        # drop headers of protocols no longer referenced, renumbering the rest
+        live = rows[:, 0] >= 0
+        used = np.unique(np.concatenate([rows[live, 0], also[:, 1]]))
+        remap = np.full(len(self.headers), -1, dtype=np.int64)
+        remap[used] = np.arange(len(used))
+        rows[live, 0] = remap[rows[live, 0]]
+        also[:, 1] = remap[also[:, 1]]
+
+        with open(self.index_dir / files["headers"], "w", encoding="utf-8") as f:
+            json.dump([self.headers[int(i)] for i in used], f, ensure_ascii=False)
+        with open(self.index_dir / files["rows"], "wb") as f:
+            np.save(f, rows)
+        with open(self.index_dir / files["also"], "wb") as f:
+            np.save(f, also)
+        return files
+
+
+class MetadataStore:
+    """Read side: store[vector_id] -> row dict; len(store) is the number of live vectors."""
+
+    def __init__(self, index_dir: Path, files: Optional[dict] = None):
+        index_dir = Path(index_dir)
+        files = files or store_files(index_dir)
+        if files is None:
+            raise FileNotFoundError(f"No metadata store in {index_dir}")
+        self.build: Optional[str] = files.get("build")
+        with open(index_dir / files["headers"], "r", encoding="utf-8") as f:
+            self.headers: List[dict] = json.load(f)
+        self.rows = np.load(index_dir / files["rows"], mmap_mode="r")
+        also_path = index_dir / files["also"]
+        self.also = np.load(also_path) if also_path.exists() else np.zeros((0, 2), dtype=np.int64)
+        self._file = open(index_dir / files["chunks"], "rb")
+        size = os.fstat(self._file.fileno()).st_size
+        self._bodies = mmap.mmap(self._file.fileno(), 0, access=mmap.ACCESS_READ) if size else b""
+        self._live = int((self.rows[:, 0] >= 0).sum()) if len(self.rows) else 0
+
+    def __len__(self) -> int:
+        return self._live
+
+    def get(self, vector_id: int) -> Optional[dict]:
+        if vector_id < 0 or vector_id >= len(self.rows):
+            return None
+        header_row, offset, length = (int(x) for x in self.rows[vector_id])
+        if header_row < 0:
+            return None
+        header = self.headers[header_row]
+        body = self._bodies[offset : offset + length].decode("utf-8")
+        lo, hi = np.searchsorted(self.also[:, 0], [vector_id, vector_id + 1])
+        also = [dict(self.headers[int(h)]) for h in self.also[lo:hi, 1]]
+        return {
+            "id": vector_id,
+            "protocol_id": header["protocol_id"],
+            "title": header["title"],
+            "icd_codes": header["icd_codes"],
+            "body": body,
+            "also": also,
+            "text": enriched_text(header["protocol_id"], header["title"], header["icd_codes"], body, also),
+        }
+
+    def __getitem__(self, vector_id: int) -> dict:
+        row = self.get(int(vector_id))
+        if row is None:
+            raise KeyError(vector_id)
+        return row
+
+    def live_ids(self) -> np.ndarray:
+        return np.flatnonzero(self.rows[:, 0] >= 0)
+
+    def close(self) -> None:
+        if isinstance(self._bodies, mmap.mmap):
+            self._bodies.close()
+        self._file.close()
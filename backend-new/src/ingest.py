@@ -1,17 +1,37 @@
 """
-FAISS index from protocols_corpus.jsonl with enriched chunks (ID, title, ОФИЦИАЛЬНЫЕ КОДЫ МКБ-10).
+FAISS index from protocols_corpus.jsonl. Chunks are cut by the embedding model's tokenizer to fit
+its max_seq_length; protocol headers (ID, title, ОФИЦИАЛЬНЫЕ КОДЫ МКБ-10) are stored as fields and
+rendered for the prompt by index_store, not embedded with every chunk.
 Run from backend-new: py src/ingest.py  or  uv run python src/ingest.py
-Output: data/faiss_index/index.faiss + metadata.json
+Incremental by default: manifest.json keeps a content hash per protocol_id, so only new or
+changed protocols are re-chunked and re-embedded and removed ones are dropped. --full rebuilds.
+--workers N embeds on N processes (CPU build boxes), each pinned to cores/N torch threads.
+Near-identical chunks (shared boilerplate) are embedded once; the vector keeps a list of every
+other protocol it stands for (--dedup-threshold, 0 disables).
+Kept chunks are not re-read: MinHash signatures are stored by vector id and new bodies are appended
+to the store, so a run costs in proportion to what changed.
+Output: data/faiss_index/ — index + metadata store stamped with a build id, current.json naming the
+published build (see index_store.py), manifest.json
 """
+import argparse
+import hashlib
 import json
+import os
 import re
 import logging
+import multiprocessing as mp
+import time
+from concurrent.futures import ProcessPoolExecutor
 from pathlib import Path
 
 import faiss
 import numpy as np
 from langchain_community.embeddings import HuggingFaceEmbeddings
-from langchain_text_splitters import RecursiveCharacterTextSplitter
+
+from embedding_cache import EmbeddingCache
+from index_store import StoreWriter, build_file, new_build_id, publish_build, store_files
+from near_dup import DEFAULT_THRESHOLD as DEFAULT_DEDUP_THRESHOLD, NUM_PERM, NearDupIndex
+from token_chunker import TokenChunker
 
 logging.basicConfig(level=logging.INFO)
 logger = logging.getLogger(__name__)
@@ -19,8 +39,14 @@ logger = logging.getLogger(__name__)
 PROJECT_ROOT = Path(__file__).resolve().parent.parent
 CORPUS_PATH = PROJECT_ROOT / "data" / "protocols_corpus.jsonl"
 FAISS_INDEX_DIR = PROJECT_ROOT / "data" / "faiss_index"
-FAISS_INDEX_PATH = FAISS_INDEX_DIR / "index.faiss"
-METADATA_PATH = FAISS_INDEX_DIR / "metadata.json"
+MANIFEST_PATH = FAISS_INDEX_DIR / "manifest.json"
+EMBEDDING_CACHE_PATH = PROJECT_ROOT / "data" / "embedding_cache.sqlite"
+
+EMBEDDING_MODEL_NAME = "cointegrated/rubert-tiny2"
+CHUNK_TOKENS = 256           # capped by the model's max_seq_length
+CHUNK_OVERLAP_TOKENS = 48
+EMBED_BATCH_SIZE = 128
+MANIFEST_VERSION = 5
 
 ICD10_CANONICAL = re.compile(r"^[A-Z]\d{2}(?:\.\d+)?$")
 ICD10_IN_TEXT = re.compile(r"[A-Za-zА-Яа-яЁё]\s*\d{2}(?:\s*\.\s*\d+)?", re.IGNORECASE)
@@ -55,15 +81,21 @@ def clean_icd_codes(raw_codes, text):
     return sorted(valid)
 
 
-def main():
-    FAISS_INDEX_DIR.mkdir(parents=True, exist_ok=True)
-    if not CORPUS_PATH.exists():
-        raise FileNotFoundError(f"Corpus not found: {CORPUS_PATH}")
+def build_config(dedup_threshold: float) -> dict:
+    """Everything that changes chunk texts or vectors; a mismatch forces a full rebuild."""
+    return {
+        "version": MANIFEST_VERSION,
+        "model": EMBEDDING_MODEL_NAME,
+        "chunk_tokens": CHUNK_TOKENS,
+        "chunk_overlap_tokens": CHUNK_OVERLAP_TOKENS,
+        "dedup_threshold": dedup_threshold,
+        "dedup_num_perm": NUM_PERM,
+    }
 
-    splitter = RecursiveCharacterTextSplitter(
-        chunk_size=900, chunk_overlap=220, length_function=len, separators=["\n\n", "\n", ". ", " ", ""]
-    )
-    chunks_meta = []
+
+def load_corpus() -> dict[str, list[dict]]:
+    """Reads the corpus grouped by protocol_id (a protocol may span several lines)."""
+    protocols: dict[str, list[dict]] = {}
     skipped = 0
     with open(CORPUS_PATH, "r", encoding="utf-8") as f:
         for line in f:
@@ -76,46 +108,269 @@ def main():
                 skipped += 1
                 continue
             protocol_id = str(data.get("protocol_id") or "").strip()
-            title = str(data.get("title") or "").strip()
             full_text = str(data.get("text") or "")
-            raw_icd = data.get("icd_codes") or []
-            final_codes = clean_icd_codes(raw_icd, full_text)
-            codes_str = ", ".join(final_codes) if final_codes else "Коды не указаны"
-            for chunk_text in splitter.split_text(full_text):
-                if not chunk_text or not chunk_text.strip():
-                    continue
-                enriched = (
-                    f"ID ПРОТОКОЛА: {protocol_id}\n"
-                    f"НАЗВАНИЕ: {title}\n"
-                    f"ОФИЦИАЛЬНЫЕ КОДЫ МКБ-10: {codes_str}\n---\n{chunk_text}"
-                )
-                chunks_meta.append({"text": enriched, "protocol_id": protocol_id, "icd_codes": final_codes})
-
-    if not chunks_meta:
-        raise RuntimeError("No chunks produced from corpus.")
+            protocols.setdefault(protocol_id, []).append({
+                "title": str(data.get("title") or "").strip(),
+                "text": full_text,
+                "icd_codes": clean_icd_codes(data.get("icd_codes") or [], full_text),
+            })
     if skipped:
         logger.warning("Skipped %s bad lines", skipped)
+    return protocols
+
+
+def protocol_hash(entries: list[dict]) -> str:
+    payload = json.dumps(entries, ensure_ascii=False, sort_keys=True)
+    return hashlib.sha256(payload.encode("utf-8")).hexdigest()
+
+
+def chunk_protocol(protocol_id: str, entries: list[dict], splitter: TokenChunker) -> list[dict]:
+    """"text" is what gets embedded: the chunk body alone, the header lives in title/icd_codes."""
+    chunks = []
+    for entry in entries:
+        final_codes = entry["icd_codes"]
+        for chunk_text in splitter.split_text(entry["text"]):
+            if not chunk_text or not chunk_text.strip():
+                continue
+            chunks.append({
+                "text": chunk_text,
+                "body": chunk_text,
+                "protocol_id": protocol_id,
+                "title": entry["title"],
+                "icd_codes": final_codes,
+            })
+    return chunks
 
-    logger.info("Chunks: %s. Loading embedding model...", len(chunks_meta))
-    embeddings = HuggingFaceEmbeddings(model_name="cointegrated/rubert-tiny2")
-    batch_size = 128
+
+_worker_embeddings = None
+
+
+def _init_embed_worker(threads: int) -> None:
+    global _worker_embeddings
+    os.environ["OMP_NUM_THREADS"] = str(threads)
+    import torch
+    torch.set_num_threads(threads)
+    _worker_embeddings = HuggingFaceEmbeddings(model_name=EMBEDDING_MODEL_NAME)
+
+
+def _embed_batch(texts: list[str]) -> tuple[int, list[list[float]], float]:
+    t0 = time.perf_counter()
+    vectors = _worker_embeddings.embed_documents(texts)
+    return os.getpid(), vectors, time.perf_counter() - t0
+
+
+def embed_chunks(chunks: list[dict], workers: int = 1, cache: EmbeddingCache | None = None) -> np.ndarray:
+    """Embeds chunk texts in order, computing only what the embedding cache does not have yet."""
+    texts = [c["text"] for c in chunks]
+    if cache is None:
+        return embed_texts(texts, workers)
+    vectors = cache.get_many(texts)
+    misses = [i for i, v in enumerate(vectors) if v is None]
+    logger.info("Embedding cache: %s / %s chunks already embedded", len(texts) - len(misses), len(texts))
+    if misses:
+        miss_texts = [texts[i] for i in misses]
+        computed = embed_texts(miss_texts, workers)
+        cache.put_many(miss_texts, computed)
+        for i, vec in zip(misses, computed):
+            vectors[i] = vec
+    return np.stack(vectors).astype(np.float32)
+
+
+def embed_texts(texts: list[str], workers: int = 1) -> np.ndarray:
+    """Embeds texts in order; with workers > 1 batches are spread over a spawn process pool."""
+    batches = [texts[i : i + EMBED_BATCH_SIZE] for i in range(0, len(texts), EMBED_BATCH_SIZE)]
+    threads = max(1, (os.cpu_count() or 1) // workers)
+    executor = None
+    if workers > 1:
+        logger.info("Embedding on %s processes x %s threads", workers, threads)
+        executor = ProcessPoolExecutor(
+            max_workers=workers, mp_context=mp.get_context("spawn"),
+            initializer=_init_embed_worker, initargs=(threads,),
+        )
+        results = executor.map(_embed_batch, batches)
+    else:
+        _init_embed_worker(threads)
+        results = map(_embed_batch, batches)
+
+    logger.info("Embedding %s chunks...", len(texts))
     all_vectors = []
-    for start in range(0, len(chunks_meta), batch_size):
-        batch = chunks_meta[start : start + batch_size]
-        vecs = embeddings.embed_documents([c["text"] for c in batch])
-        all_vectors.extend(vecs)
-        logger.info("Embedded %s / %s", min(start + batch_size, len(chunks_meta)), len(chunks_meta))
+    per_worker: dict[int, list[float]] = {}
+    try:
+        for pid, vectors, seconds in results:
+            all_vectors.extend(vectors)
+            stats = per_worker.setdefault(pid, [0, 0.0])
+            stats[0] += len(vectors)
+            stats[1] += seconds
+            logger.info("Embedded %s / %s", len(all_vectors), len(texts))
+    finally:
+        if executor:
+            executor.shutdown()
+    for pid, (count, seconds) in sorted(per_worker.items()):
+        logger.info("Worker %s: %s chunks in %.1fs (%.1f chunks/s)", pid, count, seconds, count / max(seconds, 1e-9))
 
     arr = np.array(all_vectors, dtype=np.float32)
     faiss.normalize_L2(arr)
-    index = faiss.IndexFlatIP(arr.shape[1])
-    index.add(arr)
+    return arr
+
+
+def load_previous(config: dict):
+    """Returns (index, store writer, manifest) of the last run, or None if a full rebuild is needed."""
+    files = store_files(FAISS_INDEX_DIR)
+    if files is None or not MANIFEST_PATH.exists():
+        return None
+    with open(MANIFEST_PATH, "r", encoding="utf-8") as f:
+        manifest = json.load(f)
+    if manifest.get("config") != config:
+        logger.info("Ingest config changed since last run; rebuilding from scratch")
+        return None
+    if manifest.get("build") != files.get("build"):
+        logger.warning("manifest.json does not describe the published build; rebuilding from scratch")
+        return None
+    index = faiss.read_index(str(FAISS_INDEX_DIR / files["index"]))
+    if not isinstance(index, faiss.IndexIDMap2):
+        logger.info("Existing index is not ID-mapped; rebuilding from scratch")
+        return None
+    store = StoreWriter(FAISS_INDEX_DIR, files)
+    if index.ntotal != len(store):
+        logger.warning("Index/metadata size mismatch (%s vs %s); rebuilding", index.ntotal, len(store))
+        return None
+    if config["dedup_threshold"] and store.signatures(NUM_PERM) is None:
+        logger.info("No stored MinHash signatures; rebuilding from scratch")
+        return None
+    return index, store, manifest
+
+
+def _atomic_write_json(path: Path, data) -> None:
+    tmp = path.with_suffix(path.suffix + ".tmp")
+    with open(tmp, "w", encoding="utf-8") as f:
+        json.dump(data, f, ensure_ascii=False, indent=0)
+    os.replace(tmp, path)
+
+
+def save(index, store: StoreWriter, manifest: dict) -> str:
+    """Writes a new build next to the published one and switches current.json to it; returns the build id."""
+    build = new_build_id()
+    files = {"build": build, "index": build_file("index", build)}
+    faiss.write_index(index, str(FAISS_INDEX_DIR / files["index"]))
+    files.update(store.write(manifest["next_id"], build))
+    # manifest first: if we stop before publishing, the next run sees a build mismatch and rebuilds
+    manifest["build"] = build
+    _atomic_write_json(MANIFEST_PATH, manifest)
+    publish_build(FAISS_INDEX_DIR, files)
+    return build
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Build or refresh the FAISS index from protocols_corpus.jsonl")
+    parser.add_argument("--full", action="store_true", help="Ignore manifest.json and re-embed the whole corpus")
+    parser.add_argument("--workers", type=int, default=1, help="Embedding processes (default: 1, in-process)")
+    parser.add_argument("--cache", default=str(EMBEDDING_CACHE_PATH), help="Embedding cache file (SQLite)")
+    parser.add_argument("--cache-max-mb", type=int, default=2048, help="Embedding cache size limit, MB")
+    parser.add_argument("--no-cache", action="store_true", help="Do not read or write the embedding cache")
+    parser.add_argument(
+        "--dedup-threshold", type=float, default=DEFAULT_DEDUP_THRESHOLD,
+        help=f"MinHash similarity above which chunks are collapsed into one vector, 0 disables (default: {DEFAULT_DEDUP_THRESHOLD})",
+    )
+    args = parser.parse_args()
+
     FAISS_INDEX_DIR.mkdir(parents=True, exist_ok=True)
-    faiss.write_index(index, str(FAISS_INDEX_PATH))
-    metadata = [{"text": c["text"], "protocol_id": c["protocol_id"], "icd_codes": c["icd_codes"]} for c in chunks_meta]
-    with open(METADATA_PATH, "w", encoding="utf-8") as f:
-        json.dump(metadata, f, ensure_ascii=False, indent=0)
-    logger.info("Done. Index: %s (%s vectors). Metadata: %s", FAISS_INDEX_PATH, len(chunks_meta), METADATA_PATH)
+    if not CORPUS_PATH.exists():
+        raise FileNotFoundError(f"Corpus not found: {CORPUS_PATH}")
+
+    config = build_config(args.dedup_threshold)
+    protocols = load_corpus()
+    hashes = {pid: protocol_hash(entries) for pid, entries in protocols.items()}
+
+    previous = None if args.full else load_previous(config)
+    if previous is None:
+        index, store = None, StoreWriter(FAISS_INDEX_DIR)
+        manifest = {"config": config, "next_id": 0, "protocols": {}}
+    else:
+        index, store, manifest = previous
+
+    known = manifest["protocols"]
+    changed = [pid for pid, h in hashes.items() if known.get(pid, {}).get("hash") != h]
+    removed = [pid for pid in known if pid not in hashes]
+    logger.info(
+        "Protocols: %s total, %s new/changed, %s removed, %s unchanged",
+        len(hashes), len(changed), len(removed), len(hashes) - len(changed),
+    )
+    if index is not None and not changed and not removed:
+        logger.info("Index is up to date: %s (build %s, %s vectors)", FAISS_INDEX_DIR, manifest.get("build"), index.ntotal)
+        return
+
+    # A vector owned by a changed protocol may also stand for collapsed chunks of other protocols;
+    # those are re-chunked too, so their chunks are re-assigned instead of silently dropped.
+    reprocess = set(changed) | set(removed)
+    pending = list(reprocess)
+    while pending:
+        for vid in known.get(pending.pop(), {}).get("ids", []):
+            for other in store.also_protocols(vid):
+                if other not in reprocess:
+                    reprocess.add(other)
+                    pending.append(other)
+    rechunk = [pid for pid in hashes if pid in reprocess]
+    if len(rechunk) > len(changed):
+        logger.info("Re-chunking %s unchanged protocols that share collapsed chunks", len(rechunk) - len(changed))
+
+    stale_ids = [i for pid in reprocess for i in known.get(pid, {}).get("ids", [])]
+    if index is not None and stale_ids:
+        index.remove_ids(np.array(stale_ids, dtype=np.int64))
+    store.remove(stale_ids, reprocess)
+    for pid in removed:
+        del known[pid]
+
+    dedup = None
+    if args.dedup_threshold:
+        dedup = NearDupIndex(args.dedup_threshold)
+        live = store.live_ids()
+        if len(live):
+            dedup.add_many(live.tolist(), store.signatures(NUM_PERM)[live])
+
+    splitter = TokenChunker.from_model(EMBEDDING_MODEL_NAME, CHUNK_TOKENS, CHUNK_OVERLAP_TOKENS)
+    logger.info("Chunking to %s tokens (%s without special tokens), overlap %s", splitter.max_tokens, splitter.budget, splitter.overlap)
+    new_chunks = []
+    collapsed = 0
+    next_id = manifest["next_id"]
+    for pid in rechunk:
+        ids = []
+        for chunk in chunk_protocol(pid, protocols[pid], splitter):
+            sig = None
+            if dedup is not None:
+                sig = dedup.signature(chunk["body"])
+                match = dedup.query(sig)
+                if match is not None:
+                    if store.protocol_of(match) != pid:
+                        store.link(match, chunk)
+                    collapsed += 1
+                    continue
+                dedup.add(next_id, sig)
+            chunk["id"] = next_id
+            store.add(next_id, chunk, sig)
+            ids.append(next_id)
+            next_id += 1
+            new_chunks.append(chunk)
+        known[pid] = {"hash": hashes[pid], "ids": ids}
+    manifest["next_id"] = next_id
+    if dedup is not None:
+        logger.info("Near-duplicate chunks collapsed: %s", collapsed)
+
+    if not len(store):
+        raise RuntimeError("No chunks produced from corpus.")
+
+    if new_chunks:
+        logger.info("Chunks to embed: %s", len(new_chunks))
+        cache = None if args.no_cache else EmbeddingCache(Path(args.cache), EMBEDDING_MODEL_NAME, args.cache_max_mb * 1024 ** 2)
+        arr = embed_chunks(new_chunks, max(1, args.workers), cache)
+        if cache is not None:
+            cache.log_stats()
+            cache.close()
+        if index is None:
+            index = faiss.IndexIDMap2(faiss.IndexFlatIP(arr.shape[1]))
+        index.add_with_ids(arr, np.array([c["id"] for c in new_chunks], dtype=np.int64))
+
+    build = save(index, store, manifest)
+    logger.info("Done. Index: %s, build %s (%s vectors)", FAISS_INDEX_DIR, build, index.ntotal)
 
 
 if __name__ == "__main__":
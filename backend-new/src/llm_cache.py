@@ -0,0 +1,191 @@
+"""
+Persistent exact-match cache of LLM chat responses (SQLite, stdlib only).
+
+Evaluation reruns and resubmitted anamneses send byte-identical chat requests; a hit answers in
+about a millisecond instead of a 10-60 s completion. The key is a sha256 over the model, the prompts
+version, the exact messages, temperature and max_tokens, so any change to the prompt or to the
+sampling parameters is a different entry. Only successful completions are stored.
+
+The file holds at most max_entries responses (least recently used are evicted first) and an entry
+expires ttl_seconds after it was stored. WAL mode lets several uvicorn workers share one file.
+
+A request can skip the cache entirely (the API honours `Cache-Control: no-cache`). Lookups are
+counted in llm_cache_requests_total{result="hit|miss|bypass"} on /metrics and in stats().
+"""
+import hashlib
+import json
+import os
+import sqlite3
+import threading
+import time
+from pathlib import Path
+from typing import Any, Dict, List, Optional
+
+from metrics import Counter
+
+DEFAULT_PATH = os.path.join("data", "llm_cache.sqlite")
+DEFAULT_MAX_ENTRIES = 10_000
+DEFAULT_TTL_SECONDS = 86_400.0
+EVICT_TO = 0.9  # eviction leaves 90% of max_entries
+RESYNC_EVERY = 1000  # re-read COUNT(*) every N puts (other workers write to the same file)
+
+LOOKUPS = Counter("llm_cache_requests_total", "LLM response cache lookups by result.", ("result",))
+
+
+def cache_key(
+    model: str,
+    messages: List[Dict[str, str]],
+    temperature: float,
+    max_tokens: int,
+    prompts_version: Any = "",
+) -> str:
+    payload = json.dumps(
+        {
+            "model": model,
+            "prompts_version": str(prompts_version),
+            "messages": messages,
+            "temperature": temperature,
+            "max_tokens": max_tokens,
+        },
+        ensure_ascii=False,
+        sort_keys=True,
+        separators=(",", ":"),
+    )
+    return hashlib.sha256(payload.encode("utf-8")).hexdigest()
+
+
+class LLMResponseCache:
+    """Thread-safe LRU + TTL response cache in SQLite. max_entries=0 disables it, ttl_seconds=0 never expires."""
+
+    def __init__(
+        self,
+        path: str = DEFAULT_PATH,
+        max_entries: int = DEFAULT_MAX_ENTRIES,
+        ttl_seconds: float = DEFAULT_TTL_SECONDS,
+    ):
+        self.path = Path(path)
+        self.max_entries = max_entries
+        self.ttl_seconds = ttl_seconds
+        self.hits = self.misses = self.bypassed = self.evicted = self.expired = 0
+        self.saved_ms = 0.0  # LLM latency the hits did not have to wait for
+        self._lock = threading.Lock()
+        self._db: Optional[sqlite3.Connection] = None
+        self._entries = 0  # rows in the table; seeded once, then kept up to date by this process
+        self._puts = 0
+        if self.enabled:
+            self.path.parent.mkdir(parents=True, exist_ok=True)
+            self._db = sqlite3.connect(str(self.path), check_same_thread=False, timeout=5.0)
+            self._db.execute("PRAGMA journal_mode=WAL")
+            self._db.execute("PRAGMA synchronous=NORMAL")
+            self._db.execute(
+                "CREATE TABLE IF NOT EXISTS responses ("
+                " key TEXT PRIMARY KEY, model TEXT NOT NULL, response TEXT NOT NULL,"
+                " created REAL NOT NULL, last_used REAL NOT NULL, latency_ms REAL NOT NULL) WITHOUT ROWID"
+            )
+            self._db.execute("CREATE INDEX IF NOT EXISTS responses_lru ON responses(last_used)")
+            self._db.commit()
+            self._entries = self._count()
+
+    @property
+    def enabled(self) -> bool:
+        return self.max_entries > 0
+
+    def _is_expired(self, created: float, now: float) -> bool:
+        return self.ttl_seconds > 0 and now - created > self.ttl_seconds
+
+    def get(self, key: str) -> Optional[str]:
+        """Cached response text or None."""
+        if self._db is None:
+            return None
+        now = time.time()
+        with self._lock:
+            row = self._db.execute(
+                "SELECT response, created, latency_ms FROM responses WHERE key = ?", (key,)
+            ).fetchone()
+            if row is not None and self._is_expired(row[1], now):
+                cur = self._db.execute("DELETE FROM responses WHERE key = ?", (key,))
+                self._db.commit()
+                self._entries -= cur.rowcount
+                self.expired += 1
+                row = None
+            if row is None:
+                self.misses += 1
+            else:
+                self._db.execute("UPDATE responses SET last_used = ? WHERE key = ?", (now, key))
+                self._db.commit()
+                self.hits += 1
+                self.saved_ms += row[2]
+        LOOKUPS.inc(result="hit" if row is not None else "miss")
+        return row[0] if row is not None else None
+
+    def put(self, key: str, model: str, response: str, latency_ms: float) -> None:
+        if self._db is None:
+            return
+        now = time.time()
+        with self._lock:
+            cur = self._db.execute(
+                "INSERT OR IGNORE INTO responses VALUES (?, ?, ?, ?, ?, ?)",
+                (key, model, response, now, now, latency_ms),
+            )
+            if cur.rowcount:
+                self._entries += 1
+            else:
+                self._db.execute(
+                    "UPDATE responses SET model = ?, response = ?, created = ?, last_used = ?, latency_ms = ?"
+                    " WHERE key = ?",
+                    (model, response, now, now, latency_ms, key),
+                )
+            self._db.commit()
+            self._puts += 1
+            if self._puts % RESYNC_EVERY == 0:
+                self._entries = self._count()
+            if self._entries > self.max_entries:
+                self._evict(now)
+
+    def record_bypass(self) -> None:
+        with self._lock:
+            self.bypassed += 1
+        LOOKUPS.inc(result="bypass")
+
+    def _count(self) -> int:
+        return self._db.execute("SELECT COUNT(*) FROM responses").fetchone()[0]
+
+    def _evict(self, now: float) -> None:
+        """Drop expired entries, then the least recently used ones down to EVICT_TO * max_entries."""
+        if self.ttl_seconds > 0:
+            cur = self._db.execute("DELETE FROM responses WHERE created < ?", (now - self.ttl_seconds,))
+            self.expired += cur.rowcount
+        self._entries = self._count()
+        excess = self._entries - int(self.max_entries * EVICT_TO)
+        if excess > 0:
+            cur = self._db.execute(
+                "DELETE FROM responses WHERE key IN (SELECT key FROM responses ORDER BY last_used LIMIT ?)",
+                (excess,),
+            )
+            self._entries -= cur.rowcount
+            self.evicted += cur.rowcount
+        self._db.commit()
+
+    def stats(self) -> dict:
+        with self._lock:
+            entries = self._entries if self._db is not None else 0
+        total = self.hits + self.misses
+        return {
+            "path": str(self.path) if self._db is not None else None,
+            "entries": entries,
+            "max_entries": self.max_entries,
+            "ttl_seconds": self.ttl_seconds,
+            "hits": self.hits,
+            "misses": self.misses,
+            "bypassed": self.bypassed,
+            "hit_rate": round(self.hits / total, 4) if total else 0.0,
+            "expired": self.expired,
+            "evicted": self.evicted,
+            "saved_seconds": round(self.saved_ms / 1000, 1),
+        }
+
+    def close(self) -> None:
+        with self._lock:
+            if self._db is not None:
+                self._db.close()
+                self._db = None
@@ -1,10 +1,34 @@
 """
 Backend-new: full API (auth, history, diagnose, frontend).
 Diagnosis logic is in diagnosis_engine — replace that module to plug in a different model.
+
+GET /metrics exposes request counters, in-flight gauges and per-stage latency histograms (auth, embed,
+faiss_search, llm, json_parse, history_write) in the Prometheus text format; every response carries a
+Server-Timing header with the same stages (see metrics.py).
+
+With TRACE_FILE set, every request is also traced: a root span per request with nested spans for
+auth, supabase calls, run_diagnosis, embed, faiss_search, llm and history_write, written as OTLP/JSON
+to a rotating local file (see tracing.py). The X-Trace-Id response header names the trace.
+
+Identical LLM requests (same model, messages, temperature, max_tokens) are answered from a persistent
+SQLite cache (see llm_cache.py); send `Cache-Control: no-cache` to bypass it for one request. Hit
+rate is in /health and /metrics.
+
+POST /admin/reload-index swaps in a freshly ingested FAISS index without a restart: the new index
+is loaded, validated and warmed with a test query in a worker thread, then swapped in on the event
+loop. Requests already running keep the index they started with. It acts on one process only —
+with several uvicorn workers call it once per worker (or roll the workers).
 """
+import asyncio
+import json
 import os
 import logging
+import secrets
+import sys
+import time
+from pathlib import Path
 from contextlib import asynccontextmanager
+from datetime import datetime, timezone
 from typing import List, Optional
 
 from dotenv import load_dotenv
@@ -12,7 +36,7 @@ load_dotenv()
 
 import uvicorn
 from fastapi import Depends, FastAPI, Header, HTTPException, Request
-from fastapi.responses import JSONResponse, HTMLResponse
+from fastapi.responses import JSONResponse, HTMLResponse, Response
 from fastapi.staticfiles import StaticFiles
 from fastapi.middleware.cors import CORSMiddleware
 from pydantic import BaseModel, Field
@@ -21,13 +45,39 @@ from openai import AsyncOpenAI, APIError, APIConnectionError, RateLimitError
 from langchain_community.embeddings import HuggingFaceEmbeddings
 import faiss
 
+# Sibling modules are imported by bare name; under `uvicorn src.main:app` src/ is not on sys.path
+sys.path.insert(0, str(Path(__file__).resolve().parent))
+from index_store import MetadataStore, index_version, read_faiss_index, store_files
+from llm_cache import LLMResponseCache
+from metrics import CONTENT_TYPE as METRICS_CONTENT_TYPE, MetricsMiddleware, render as render_metrics, stage
+from onnx_encoder import OnnxEncoder, load_onnx_encoder
+from query_cache import QueryEmbeddingCache
+from tracing import TracingMiddleware, stats as tracing_stats
+
 # -------------------- Configuration --------------------
 LLM_BACKEND = os.getenv("LLM_BACKEND", "hf_local").strip().lower()
 LITELLM_BASE_URL = os.getenv("LITELLM_BASE_URL", "https://hub.qazcode.ai/v1")
 LITELLM_API_KEY = os.getenv("LITELLM_API_KEY", "")
 HF_MODEL_NAME = os.getenv("HF_MODEL_NAME", "Qwen/Qwen2.5-0.5B-Instruct")
 EMBEDDING_MODEL_NAME = os.getenv("EMBEDDING_MODEL", "cointegrated/rubert-tiny2")
+# Query encoder: torch (HuggingFaceEmbeddings) | onnx | onnx-int8 (see onnx_encoder.py)
+EMBEDDING_BACKEND = os.getenv("EMBEDDING_BACKEND", "torch").strip().lower()
+ONNX_CACHE_DIR = os.getenv("ONNX_CACHE_DIR", os.path.join("data", "onnx"))
+# LRU + TTL cache of query vectors (query_cache.py); size 0 disables, empty path keeps it in memory only
+QUERY_CACHE_SIZE = int(os.getenv("QUERY_CACHE_SIZE", "1024"))
+QUERY_CACHE_TTL = float(os.getenv("QUERY_CACHE_TTL", "3600"))
+QUERY_CACHE_PATH = os.getenv("QUERY_CACHE_PATH", "").strip() or None
+# Exact-match LLM response cache (llm_cache.py, SQLite); size 0 disables
+LLM_CACHE_SIZE = int(os.getenv("LLM_CACHE_SIZE", "10000"))
+LLM_CACHE_TTL = float(os.getenv("LLM_CACHE_TTL", "86400"))
+LLM_CACHE_PATH = os.getenv("LLM_CACHE_PATH", "").strip() or os.path.join("data", "llm_cache.sqlite")
 FAISS_INDEX_PATH = os.path.join("data", "faiss_index")
+FAISS_MMAP = os.getenv("FAISS_MMAP", "1").strip().lower() in ("1", "true", "yes")
+FAISS_PREFETCH = os.getenv("FAISS_PREFETCH", "0").strip().lower() in ("1", "true", "yes")
+# /admin/reload-index: disabled (403) until ADMIN_TOKEN is set; index_dir must lie under INDEX_ROOT
+ADMIN_TOKEN = os.getenv("ADMIN_TOKEN", "").strip()
+INDEX_ROOT = os.getenv("INDEX_ROOT", "").strip() or os.path.dirname(FAISS_INDEX_PATH)
+WARMUP_QUERY = "кашель, температура 38.5, одышка"
 _project_root = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
 _local_frontend = os.path.join(_project_root, "frontend", "dist")
 _sibling_frontend = os.path.normpath(os.path.join(_project_root, "..", "frontend", "dist"))
@@ -59,40 +109,138 @@ logger = logging.getLogger(__name__)
 class AppState:
     faiss_index: Optional[faiss.Index] = None
     faiss_metadata: Optional[List[dict]] = None
-    embeddings: Optional[HuggingFaceEmbeddings] = None
+    embeddings: Optional[HuggingFaceEmbeddings | OnnxEncoder] = None
+    query_cache: Optional[QueryEmbeddingCache] = None
     llm_client: Optional[AsyncOpenAI] = None
+    llm_cache: Optional[LLMResponseCache] = None
     model_id: str = "gpt-oss"
     hf_model: Optional[object] = None
     hf_tokenizer: Optional[object] = None
+    index_dir: Optional[str] = None
+    index_version: Optional[str] = None
+    index_loaded_at: Optional[str] = None
+    index_load_ms: Optional[int] = None
+    index_reload: dict = {"status": "idle"}
+    index_reload_task: Optional[asyncio.Task] = None
 
 
 state = AppState()
 
 
-@asynccontextmanager
-async def lifespan(app: FastAPI):
-    logger.info("Starting diagnosis service (backend-new)...")
-    state.embeddings = HuggingFaceEmbeddings(model_name=EMBEDDING_MODEL_NAME)
+def _metadata_by_vector_id(entries: list) -> list | dict:
+    """Incremental ingest writes an ID-mapped index: metadata rows carry the FAISS id they belong to."""
+    if entries and isinstance(entries[0], dict) and "id" in entries[0]:
+        return {int(m["id"]): m for m in entries}
+    return entries
+
 
-    index_path = os.path.join(FAISS_INDEX_PATH, "index.faiss")
-    meta_path = os.path.join(FAISS_INDEX_PATH, "metadata.json")
-    if os.path.isfile(index_path) and os.path.isfile(meta_path):
+def _load_embeddings():
+    """ONNX encoder when EMBEDDING_BACKEND asks for it and passes the parity check, else PyTorch."""
+    if EMBEDDING_BACKEND != "torch":
         try:
-            state.faiss_index = faiss.read_index(index_path)
-            with open(meta_path, "r", encoding="utf-8") as f:
-                import json
-                state.faiss_metadata = json.load(f)
-            if state.faiss_index.ntotal != len(state.faiss_metadata):
-                state.faiss_index = None
-                state.faiss_metadata = None
-            else:
-                logger.info("FAISS index loaded (%d vectors)", state.faiss_index.ntotal)
+            return load_onnx_encoder(EMBEDDING_MODEL_NAME, EMBEDDING_BACKEND, ONNX_CACHE_DIR)
         except Exception as e:
-            logger.error("Failed to load FAISS: %s", e)
-            state.faiss_index = None
-            state.faiss_metadata = None
+            logger.warning("Embedding backend %s unavailable (%s); falling back to PyTorch", EMBEDDING_BACKEND, e)
+    return HuggingFaceEmbeddings(model_name=EMBEDDING_MODEL_NAME)
+
+
+def _now_iso() -> str:
+    return datetime.now(timezone.utc).isoformat(timespec="seconds")
+
+
+def _load_knowledge_base(index_dir: str) -> tuple:
+    """
+    Load index + metadata + version from index_dir. Raises FileNotFoundError / ValueError.
+    current.json is read once and both files come from the build it names, so a concurrent ingest
+    cannot hand us an index and a store from different runs.
+    """
+    files = store_files(index_dir)
+    meta_path = os.path.join(index_dir, "metadata.json")
+    index_path = os.path.join(index_dir, files["index"] if files else "index.faiss")
+    if not os.path.isfile(index_path) or not (files or os.path.isfile(meta_path)):
+        raise FileNotFoundError(f"FAISS index not found at {index_path}")
+    version = files["build"] if files and files.get("build") else index_version(index_dir)
+    index = read_faiss_index(index_path, FAISS_MMAP, FAISS_PREFETCH)
+    if files:
+        metadata = MetadataStore(index_dir, files)
     else:
-        logger.warning("FAISS index not found at %s", index_path)
+        with open(meta_path, "r", encoding="utf-8") as f:
+            metadata = _metadata_by_vector_id(json.load(f))
+    if index.ntotal != len(metadata):
+        raise ValueError(f"Index has {index.ntotal} vectors but metadata has {len(metadata)} rows")
+    return index, metadata, version
+
+
+def _warm_knowledge_base(index, metadata) -> int:
+    """Validate a loaded index with a test query (dimension, non-empty hits, metadata rows); returns ms."""
+    import numpy as np
+
+    if index.ntotal == 0:
+        raise ValueError("Index is empty")
+    t0 = time.perf_counter()
+    vec = np.array([state.embeddings.embed_query(WARMUP_QUERY)], dtype=np.float32)
+    if vec.shape[1] != index.d:
+        raise ValueError(f"Index dimension {index.d} != embedding dimension {vec.shape[1]} ({EMBEDDING_MODEL_NAME})")
+    faiss.normalize_L2(vec)
+    _, indices = index.search(vec, min(5, index.ntotal))
+    hits = [int(i) for i in indices[0] if i >= 0]
+    if not hits:
+        raise ValueError("Test query returned no results")
+    for i in hits:
+        metadata[i]
+    return int((time.perf_counter() - t0) * 1000)
+
+
+def _open_knowledge_base(index_dir: str) -> tuple:
+    """Load + validate + warm (runs in a worker thread for /admin/reload-index)."""
+    t0 = time.perf_counter()
+    index, metadata, version = _load_knowledge_base(index_dir)
+    load_ms = int((time.perf_counter() - t0) * 1000)
+    warmup_ms = _warm_knowledge_base(index, metadata)
+    logger.info(
+        "FAISS index %s (version %s) loaded: %d vectors, load %dms, test query %dms",
+        index_dir, version, index.ntotal, load_ms, warmup_ms,
+    )
+    return index, metadata, version, load_ms
+
+
+def _install_knowledge_base(index_dir: str, index, metadata, version: str, load_ms: int) -> None:
+    # Runs on the event loop with no await in between, so no request sees a mixed pair;
+    # run_diagnosis takes its own reference to both at the start.
+    state.faiss_index, state.faiss_metadata = index, metadata
+    state.index_dir = index_dir
+    state.index_version = version
+    state.index_loaded_at = _now_iso()
+    state.index_load_ms = load_ms
+
+
+async def _reload_index(index_dir: str) -> None:
+    state.index_reload = {"status": "loading", "index_dir": index_dir, "started_at": _now_iso()}
+    try:
+        loaded = await asyncio.to_thread(_open_knowledge_base, index_dir)
+    except Exception as e:
+        logger.error("Index reload from %s failed: %s", index_dir, e)
+        state.index_reload.update(status="failed", error=str(e), finished_at=_now_iso())
+        return
+    _install_knowledge_base(index_dir, *loaded)
+    state.index_reload.update(status="ok", version=state.index_version, finished_at=_now_iso())
+
+
+@asynccontextmanager
+async def lifespan(app: FastAPI):
+    logger.info("Starting diagnosis service (backend-new)...")
+    state.embeddings = _load_embeddings()
+    state.query_cache = QueryEmbeddingCache(EMBEDDING_MODEL_NAME, QUERY_CACHE_SIZE, QUERY_CACHE_TTL, QUERY_CACHE_PATH)
+
+    try:
+        t0 = time.perf_counter()
+        index, metadata, version = _load_knowledge_base(FAISS_INDEX_PATH)
+        _install_knowledge_base(FAISS_INDEX_PATH, index, metadata, version, int((time.perf_counter() - t0) * 1000))
+        logger.info("FAISS index loaded (%d vectors)", state.faiss_index.ntotal)
+    except FileNotFoundError as e:
+        logger.warning("%s", e)
+    except Exception as e:
+        logger.error("Failed to load FAISS: %s", e)
 
     if LLM_BACKEND == "hf_local":
         try:
@@ -112,6 +260,7 @@ async def lifespan(app: FastAPI):
             base_url=LITELLM_BASE_URL, api_key=LITELLM_API_KEY or "dummy",
             timeout=120.0, max_retries=3
         )
+        state.llm_cache = LLMResponseCache(LLM_CACHE_PATH, LLM_CACHE_SIZE, LLM_CACHE_TTL)
         try:
             models = await state.llm_client.models.list()
             for m in models.data:
@@ -128,11 +277,18 @@ async def lifespan(app: FastAPI):
         logger.warning("ensure_admin_user failed: %s", e)
 
     yield
+    if state.query_cache is not None and state.query_cache.path is not None:
+        saved = await asyncio.to_thread(state.query_cache.save)
+        logger.info("Saved %d query vectors to %s", saved, state.query_cache.path)
+    if state.llm_cache is not None:
+        state.llm_cache.close()
     logger.info("Shutdown complete.")
 
 
 app = FastAPI(title="AI Diagnosis API (backend-new)", version="0.1.0", lifespan=lifespan)
 app.add_middleware(CORSMiddleware, allow_origins=["*"], allow_methods=["*"], allow_headers=["*"])
+app.add_middleware(MetricsMiddleware)
+app.add_middleware(TracingMiddleware)
 
 
 # -------------------- Models --------------------
@@ -168,6 +324,11 @@ class LoginRequest(BaseModel):
     password: str
 
 
+class ReloadIndexRequest(BaseModel):
+    index_dir: Optional[str] = None
+    wait: bool = False
+
+
 def _auth_error_response(msg: str, is_register: bool) -> tuple:
     msg_lower = msg.lower()
     if "rate limit" in msg_lower or "too many" in msg_lower:
@@ -187,7 +348,8 @@ async def _get_current_user_optional(authorization: Optional[str] = Header(None)
         return None
     try:
         from supabase_client import auth_user
-        return await auth_user(token)
+        with stage("auth"):
+            return await auth_user(token)
     except Exception:
         return None
 
@@ -321,7 +483,8 @@ async def history_post(body: HistoryItemCreate, user: dict = Depends(get_current
             "inputPreview": (body.inputPreview or "")[:500],
             "inputText": body.inputText,
         }
-        row = await history_insert(user_id, item)
+        with stage("history_write"):
+            row = await history_insert(user_id, item)
         if not row:
             return JSONResponse(status_code=500, content={"error": "Failed to save"})
         return _db_row_to_history_item(row)
@@ -370,7 +533,87 @@ async def history_clear_route(user: dict = Depends(get_current_user)):
 @app.get("/health")
 async def health():
     llm_ready = state.llm_client is not None or (state.hf_model is not None and state.hf_tokenizer is not None)
-    return {"status": "ok", "rag_loaded": state.faiss_index is not None, "llm_backend": LLM_BACKEND, "llm_ready": llm_ready}
+    return {
+        "status": "ok",
+        "rag_loaded": state.faiss_index is not None,
+        "llm_backend": LLM_BACKEND,
+        "llm_ready": llm_ready,
+        "llm_cache": state.llm_cache.stats() if state.llm_cache is not None else None,
+        "embeddings": {
+            "backend": getattr(state.embeddings, "backend", "torch") if state.embeddings is not None else None,
+            "parity_cosine": getattr(state.embeddings, "parity_cosine", None),
+            "query_cache": state.query_cache.stats() if state.query_cache is not None else None,
+        },
+        "index": {
+            "dir": state.index_dir,
+            "version": state.index_version,
+            "vectors": state.faiss_index.ntotal if state.faiss_index is not None else 0,
+            "loaded_at": state.index_loaded_at,
+            "load_ms": state.index_load_ms,
+            "reload": dict(state.index_reload),
+        },
+        "tracing": tracing_stats(),
+    }
+
+
+@app.get("/metrics")
+async def metrics():
+    """Prometheus scrape endpoint (this process only)."""
+    return Response(render_metrics(), media_type=METRICS_CONTENT_TYPE)
+
+
+def _check_admin_token(token: Optional[str]) -> None:
+    if not ADMIN_TOKEN:
+        raise HTTPException(status_code=403, detail="Admin endpoints are disabled (ADMIN_TOKEN is not set)")
+    if token is None or not secrets.compare_digest(token.encode(), ADMIN_TOKEN.encode()):
+        raise HTTPException(status_code=403, detail="Invalid admin token")
+
+
+def _resolve_index_dir(index_dir: Optional[str]) -> str:
+    """FAISS_INDEX_PATH or a subdirectory of INDEX_ROOT (symlinks and .. resolved first)."""
+    if not index_dir:
+        return FAISS_INDEX_PATH
+    path, root = Path(index_dir).resolve(), Path(INDEX_ROOT).resolve()
+    if path != Path(FAISS_INDEX_PATH).resolve() and (path == root or not path.is_relative_to(root)):
+        raise HTTPException(status_code=400, detail=f"index_dir must be inside INDEX_ROOT ({root})")
+    return str(path)
+
+
+@app.post("/admin/reload-index")
+async def admin_reload_index(
+    body: Optional[ReloadIndexRequest] = None,
+    x_admin_token: Optional[str] = Header(None),
+):
+    """
+    Load, validate and warm an index directory (default data/faiss_index) in the background and swap it in.
+    Returns 202 right away (progress in /health -> index.reload) unless wait=true.
+    Requires the X-Admin-Token header (403 while ADMIN_TOKEN is unset); index_dir must lie under INDEX_ROOT.
+    """
+    _check_admin_token(x_admin_token)
+    if state.embeddings is None:
+        return JSONResponse(status_code=503, content={"error": "Embeddings model not loaded"})
+    body = body or ReloadIndexRequest()
+    index_dir = _resolve_index_dir(body.index_dir)
+    if state.index_reload_task is not None and not state.index_reload_task.done():
+        return JSONResponse(status_code=409, content={"error": "Index reload already in progress"})
+
+    state.index_reload_task = asyncio.create_task(_reload_index(index_dir))
+    if not body.wait:
+        return JSONResponse(status_code=202, content={"status": "loading", "index_dir": index_dir})
+
+    await asyncio.shield(state.index_reload_task)
+    if state.index_reload["status"] != "ok":
+        return JSONResponse(
+            status_code=422,
+            content={"error": "Index reload failed", "detail": state.index_reload.get("error")},
+        )
+    return {
+        "status": "reloaded",
+        "index_dir": index_dir,
+        "version": state.index_version,
+        "vectors": state.faiss_index.ntotal,
+        "load_ms": state.index_load_ms,
+    }
 
 
 @app.get("/diagnose", response_class=HTMLResponse)
@@ -387,6 +630,12 @@ async def diagnose_get():
     """
 
 
+def _cache_allowed(req: Optional[Request]) -> bool:
+    """`Cache-Control: no-cache` (or no-store) makes the request bypass the LLM response cache."""
+    directives = (req.headers.get("Cache-Control", "") if req else "").lower()
+    return "no-cache" not in directives and "no-store" not in directives
+
+
 @app.post("/diagnose", response_model=DiagnoseResponse)
 async def diagnose(body: DiagnoseRequest, req: Request):
     from diagnosis_engine import run_diagnosis
@@ -409,7 +658,7 @@ async def diagnose(body: DiagnoseRequest, req: Request):
 
     try:
         system_prompt = _load_system_prompt()
-        diagnoses_list = await run_diagnosis(query, state, system_prompt)
+        diagnoses_list = await run_diagnosis(query, state, system_prompt, use_cache=_cache_allowed(req))
         out = [DiagnosisItem(**d) for d in diagnoses_list]
 
         if req:
@@ -428,7 +677,8 @@ async def diagnose(body: DiagnoseRequest, req: Request):
                         "inputPreview": query[:500] if query else "",
                         "inputText": query,
                     }
-                    await history_insert(user["id"], item)
+                    with stage("history_write"):
+                        await history_insert(user["id"], item)
                 except Exception as e:
                     logger.warning("Failed to save to history: %s", e)
 
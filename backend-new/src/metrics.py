@@ -0,0 +1,210 @@
+"""
+In-process Prometheus metrics and Server-Timing for the API.
+
+GET /metrics renders every metric in the Prometheus text format (0.0.4); nothing is pushed anywhere,
+so a scraper or a plain curl is enough. Metrics are per process: with several uvicorn workers each
+one reports its own numbers.
+
+  http_requests_total{method,route,status}        counter
+  http_requests_in_flight                         gauge
+  http_request_duration_seconds{method,route}     histogram
+  stage_duration_seconds{stage}                   histogram (embed, faiss_search, llm, json_parse, ...)
+  stage_in_flight{stage}                          gauge
+
+Code marks a stage with `with stage("llm"): ...` (sync or async code, any thread). Besides the
+histogram, the duration is added to the current request's Server-Timing header
+(`embed;dur=12.1, llm;dur=2310.4, total;dur=2330.9`), so one slow response shows where its time went.
+Work done outside a request (startup, background tasks) only feeds the histograms. Each stage is also a
+tracing span (tracing.py), so the same names show up nested in the span file.
+"""
+import threading
+import time
+from contextlib import contextmanager
+from contextvars import ContextVar
+from typing import Dict, Iterator, Optional, Sequence, Tuple
+
+from tracing import Span, span
+
+CONTENT_TYPE = "text/plain; version=0.0.4; charset=utf-8"
+# Seconds: from a cached embedding (~1 ms) to a slow 120B completion (~2 min)
+LATENCY_BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0, 60.0, 120.0)
+
+# Stage durations of the request being handled, in ms (summed when a stage repeats)
+_request_stages: ContextVar[Optional[Dict[str, float]]] = ContextVar("request_stages", default=None)
+
+
+def _escape(value: str) -> str:
+    return str(value).replace("\\", "\\\\").replace("\n", "\\n").replace('"', '\\"')
+
+
+def _format_labels(names: Sequence[str], values: Sequence[str], extra: str = "") -> str:
+    parts = [f'{n}="{_escape(v)}"' for n, v in zip(names, values)]
+    if extra:
+        parts.append(extra)
+    return "{" + ",".join(parts) + "}" if parts else ""
+
+
+def _format_value(value: float) -> str:
+    return repr(float(value)) if value != int(value) else str(int(value))
+
+
+class _Metric:
+    kind = ""
+
+    def __init__(self, name: str, help_text: str, labels: Sequence[str] = ()):
+        self.name = name
+        self.help = help_text
+        self.labels = tuple(labels)
+        self._lock = threading.Lock()
+        REGISTRY.append(self)
+
+    def _key(self, labels: Dict[str, str]) -> Tuple[str, ...]:
+        return tuple(str(labels.get(n, "")) for n in self.labels)
+
+    def header(self) -> list:
+        return [f"# HELP {self.name} {self.help}", f"# TYPE {self.name} {self.kind}"]
+
+
+class Counter(_Metric):
+    kind = "counter"
+
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self._values: Dict[Tuple[str, ...], float] = {}
+
+    def inc(self, amount: float = 1.0, **labels: str) -> None:
+        key = self._key(labels)
+        with self._lock:
+            self._values[key] = self._values.get(key, 0.0) + amount
+
+    def render(self) -> list:
+        with self._lock:
+            items = sorted(self._values.items())
+        return self.header() + [f"{self.name}{_format_labels(self.labels, k)} {_format_value(v)}" for k, v in items]
+
+
+class Gauge(Counter):
+    kind = "gauge"
+
+    def dec(self, amount: float = 1.0, **labels: str) -> None:
+        self.inc(-amount, **labels)
+
+
+class Histogram(_Metric):
+    kind = "histogram"
+
+    def __init__(self, name: str, help_text: str, labels: Sequence[str] = (), buckets: Sequence[float] = LATENCY_BUCKETS):
+        super().__init__(name, help_text, labels)
+        self.buckets = tuple(sorted(buckets))
+        # key -> (per-bucket counts, not cumulative; sum; count)
+        self._series: Dict[Tuple[str, ...], list] = {}
+
+    def observe(self, value: float, **labels: str) -> None:
+        key = self._key(labels)
+        i = next((i for i, b in enumerate(self.buckets) if value <= b), len(self.buckets))
+        with self._lock:
+            series = self._series.get(key)
+            if series is None:
+                series = self._series[key] = [[0] * (len(self.buckets) + 1), 0.0, 0]
+            series[0][i] += 1
+            series[1] += value
+            series[2] += 1
+
+    def render(self) -> list:
+        with self._lock:
+            items = sorted((k, (list(s[0]), s[1], s[2])) for k, s in self._series.items())
+        lines = self.header()
+        for key, (counts, total, count) in items:
+            cumulative = 0
+            for bound, n in zip(self.buckets + (float("inf"),), counts):
+                cumulative += n
+                le = "+Inf" if bound == float("inf") else _format_value(bound)
+                labels = _format_labels(self.labels, key, 'le="%s"' % le)
+                lines.append(f"{self.name}_bucket{labels} {cumulative}")
+            lines.append(f"{self.name}_sum{_format_labels(self.labels, key)} {repr(total)}")
+            lines.append(f"{self.name}_count{_format_labels(self.labels, key)} {count}")
+        return lines
+
+
+REGISTRY: list = []
+
+REQUESTS = Counter("http_requests_total", "HTTP requests by route and status.", ("method", "route", "status"))
+IN_FLIGHT = Gauge("http_requests_in_flight", "HTTP requests being handled.")
+REQUEST_SECONDS = Histogram("http_request_duration_seconds", "HTTP request latency.", ("method", "route"))
+STAGE_SECONDS = Histogram("stage_duration_seconds", "Latency of one pipeline stage.", ("stage",))
+STAGE_IN_FLIGHT = Gauge("stage_in_flight", "Pipeline stages running right now.", ("stage",))
+
+
+def render() -> str:
+    lines = []
+    for metric in REGISTRY:
+        lines.extend(metric.render())
+    return "\n".join(lines) + "\n"
+
+
+def observe_stage(name: str, seconds: float) -> None:
+    """Record an already measured stage (histogram + Server-Timing of the current request)."""
+    STAGE_SECONDS.observe(seconds, stage=name)
+    stages = _request_stages.get()
+    if stages is not None:
+        stages[name] = stages.get(name, 0.0) + seconds * 1000
+
+
+@contextmanager
+def stage(name: str) -> Iterator[Span]:
+    """Time a pipeline stage; it is also a tracing span (yielded, for attributes)."""
+    STAGE_IN_FLIGHT.inc(stage=name)
+    t0 = time.perf_counter()
+    try:
+        with span(name) as s:
+            yield s
+    finally:
+        STAGE_IN_FLIGHT.dec(stage=name)
+        observe_stage(name, time.perf_counter() - t0)
+
+
+def server_timing(stages: Dict[str, float], total_ms: float) -> str:
+    parts = [f"{name};dur={ms:.1f}" for name, ms in stages.items()]
+    parts.append(f"total;dur={total_ms:.1f}")
+    return ", ".join(parts)
+
+
+class MetricsMiddleware:
+    """
+    ASGI middleware: request counter/latency by route template, in-flight gauge and the Server-Timing
+    header. Paths in `skip` (the scrape itself) are not counted.
+    """
+
+    def __init__(self, app, skip: Sequence[str] = ("/metrics",)):
+        self.app = app
+        self.skip = set(skip)
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] != "http" or scope["path"] in self.skip:
+            await self.app(scope, receive, send)
+            return
+        stages: Dict[str, float] = {}
+        token = _request_stages.set(stages)
+        status = {"code": 500}
+        t0 = time.perf_counter()
+
+        async def send_with_timing(message):
+            if message["type"] == "http.response.start":
+                status["code"] = message["status"]
+                total_ms = (time.perf_counter() - t0) * 1000
+                headers = list(message.get("headers", []))
+                headers.append((b"server-timing", server_timing(stages, total_ms).encode("latin-1")))
+                message = {**message, "headers": headers}
+            await send(message)
+
+        IN_FLIGHT.inc()
+        try:
+            await self.app(scope, receive, send_with_timing)
+        finally:
+            IN_FLIGHT.dec()
+            _request_stages.reset(token)
+            # Router stores the matched route in the scope; unmatched paths share one label
+            route = scope.get("route")
+            label = (getattr(route, "path", "") or "/") if route is not None else "unmatched"
+            REQUESTS.inc(method=scope["method"], route=label, status=str(status["code"]))
+            REQUEST_SECONDS.observe(time.perf_counter() - t0, method=scope["method"], route=label)
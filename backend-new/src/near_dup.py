@@ -0,0 +1,84 @@
+"""
+Near-duplicate chunk detection (MinHash + LSH) for ingest, stdlib + numpy only.
+
+Protocols share whole boilerplate sections (organisational info, references, drug tables); such
+chunks are embedded once and the other protocols are attached to that vector (see ingest.py).
+Similarity is the Jaccard estimate over word 3-gram shingles; LSH banding finds candidates, which
+are then checked against the full signature. Same algorithm and parameters as clindiag/near_dup.py.
+"""
+import re
+import zlib
+from typing import Dict, Hashable, List, Optional
+
+import numpy as np
+
+DEFAULT_THRESHOLD = 0.9
+NUM_PERM = 64
+BANDS = 16
+SHINGLE = 3
+_P = 4294967291   # largest prime < 2^32, so a*x + b fits in uint64
+
+_WORD = re.compile(r"\w+", re.UNICODE)
+
+
+class NearDupIndex:
+    """MinHash signatures + LSH buckets; keys are whatever the caller uses to identify a kept chunk."""
+
+    def __init__(self, threshold: float = DEFAULT_THRESHOLD, num_perm: int = NUM_PERM, bands: int = BANDS, seed: int = 1):
+        if num_perm % bands:
+            raise ValueError("num_perm must be divisible by bands")
+        self.threshold = threshold
+        self.rows = num_perm // bands
+        self.bands = bands
+        rng = np.random.default_rng(seed)
+        self._a = rng.integers(1, _P, size=num_perm, dtype=np.uint64)
+        self._b = rng.integers(0, _P, size=num_perm, dtype=np.uint64)
+        self._buckets: List[Dict[bytes, list]] = [{} for _ in range(bands)]
+        self._sigs: Dict[Hashable, np.ndarray] = {}
+
+    def __len__(self) -> int:
+        return len(self._sigs)
+
+    def signature(self, text: str) -> np.ndarray:
+        words = _WORD.findall(text.lower())
+        if len(words) <= SHINGLE:
+            shingles = {" ".join(words)}
+        else:
+            shingles = {" ".join(words[i:i + SHINGLE]) for i in range(len(words) - SHINGLE + 1)}
+        hashes = np.fromiter(
+            (zlib.crc32(s.encode("utf-8")) for s in shingles), dtype=np.uint64, count=len(shingles)
+        )
+        return ((np.outer(self._a, hashes) + self._b[:, None]) % _P).min(axis=1).astype(np.uint32)
+
+    def _band_keys(self, sig: np.ndarray):
+        for band in range(self.bands):
+            yield band, sig[band * self.rows:(band + 1) * self.rows].tobytes()
+
+    def query(self, sig: np.ndarray) -> Optional[Hashable]:
+        """Key of the most similar added chunk with similarity >= threshold, or None."""
+        best, best_sim = None, self.threshold
+        seen = set()
+        for band, key in self._band_keys(sig):
+            for cand in self._buckets[band].get(key, ()):
+                if cand in seen:
+                    continue
+                seen.add(cand)
+                sim = float(np.mean(self._sigs[cand] == sig))
+                if sim >= best_sim:
+                    best, best_sim = cand, sim
+        return best
+
+    def add(self, key: Hashable, sig: np.ndarray) -> None:
+        self._sigs[key] = sig
+        for band, band_key in self._band_keys(sig):
+            self._buckets[band].setdefault(band_key, []).append(key)
+
+    def add_many(self, keys: List[Hashable], sigs: np.ndarray) -> None:
+        """add() for a batch, e.g. the signatures an earlier ingest stored; sigs is uint32[len(keys), num_perm]."""
+        for key, sig in zip(keys, sigs):
+            self._sigs[key] = sig
+        for band in range(self.bands):
+            cols = np.ascontiguousarray(sigs[:, band * self.rows:(band + 1) * self.rows], dtype=np.uint32)
+            buckets = self._buckets[band]
+            for key, band_key in zip(keys, cols.view(f"V{self.rows * 4}").ravel().tolist()):
+                buckets.setdefault(band_key, []).append(key)
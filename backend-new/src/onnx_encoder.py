@@ -0,0 +1,239 @@
+"""
+ONNX Runtime query encoder (optionally int8-quantized) for the embedding model.
+
+Every /diagnose request embeds one short query; under PyTorch on CPU that is a large, fixed
+slice of latency. OnnxEncoder exports the transformer of the sentence-transformers model to
+ONNX (pooling and normalization are done in numpy, following the model's own Pooling /
+Normalize modules), can dynamic-quantize the weights to int8, and runs it under ONNX Runtime
+with a fixed number of intra-op threads.
+
+Backends (EMBEDDING_BACKEND):
+  torch      — langchain HuggingFaceEmbeddings, as before
+  onnx       — ONNX Runtime, float32
+  onnx-int8  — ONNX Runtime, int8 weights
+
+The export is done once and cached in <cache_dir>/<model>/ (model.onnx, model.int8.onnx,
+encoder.json, tokenizer files). On load the ONNX vectors are compared with the PyTorch model
+on PARITY_TEXTS; if the minimum cosine is below the threshold ParityError is raised and the
+caller stays on PyTorch.
+
+Requires onnxruntime; the export also needs torch (already pulled in by sentence-transformers).
+"""
+import inspect
+import json
+import logging
+import os
+from pathlib import Path
+from typing import List, Optional
+
+import numpy as np
+
+BACKENDS = ("torch", "onnx", "onnx-int8")
+ONNX_OPSET = 14
+# Minimum cosine between ONNX and PyTorch vectors on PARITY_TEXTS
+PARITY_MIN_COSINE = {"onnx": 0.9999, "onnx-int8": 0.98}
+PARITY_TEXTS = (
+    "кашель, температура 38.5, одышка",
+    "боль в грудной клетке при физической нагрузке, иррадиирует в левую руку",
+    "ребёнок 3 лет, сыпь на коже, зуд, после приёма амоксициллина",
+    "головная боль, тошнота, светобоязнь, ригидность затылочных мышц",
+    "жажда, частое мочеиспускание, глюкоза натощак 9 ммоль/л",
+)
+
+logger = logging.getLogger(__name__)
+
+
+class ParityError(RuntimeError):
+    """ONNX vectors drifted too far from the PyTorch model."""
+
+
+def default_threads() -> int:
+    """ONNX_THREADS, else the core count capped at 4 (a single short query does not scale further)."""
+    env = os.getenv("ONNX_THREADS", "").strip()
+    return int(env) if env else max(1, min(4, os.cpu_count() or 1))
+
+
+def _model_dir(cache_dir, model_name: str) -> Path:
+    return Path(cache_dir) / model_name.replace("/", "__")
+
+
+def _pooling_mode(st_model) -> str:
+    for module in st_model:
+        if type(module).__name__ == "Pooling":
+            # sentence-transformers < 5 exposes get_pooling_mode_str(), newer versions a pooling_mode attribute
+            if hasattr(module, "get_pooling_mode_str"):
+                mode = module.get_pooling_mode_str()
+            else:
+                mode = module.pooling_mode
+            if mode not in ("cls", "mean", "max"):
+                raise ValueError(f"Pooling mode {mode} is not supported by the ONNX encoder")
+            return mode
+    raise ValueError("Model has no Pooling module")
+
+
+def export_model(st_model, model_name: str, out_dir, quantize: bool = True) -> Path:
+    """Export the transformer of a SentenceTransformer to out_dir (plus an int8 copy if quantize)."""
+    import torch
+
+    out_dir = Path(out_dir)
+    out_dir.mkdir(parents=True, exist_ok=True)
+    transformer = st_model[0]
+    auto_model = transformer.auto_model.eval()
+    tokenizer = transformer.tokenizer
+
+    dummy = tokenizer(["пример запроса"], return_tensors="pt")
+    input_names = [name for name in ("input_ids", "attention_mask", "token_type_ids") if name in dummy]
+
+    class _Hidden(torch.nn.Module):
+        def __init__(self):
+            super().__init__()
+            self.model = auto_model
+
+        def forward(self, *inputs):
+            return self.model(**dict(zip(input_names, inputs))).last_hidden_state
+
+    axes = {name: {0: "batch", 1: "seq"} for name in [*input_names, "last_hidden_state"]}
+    kwargs = {}
+    if "dynamo" in inspect.signature(torch.onnx.export).parameters:
+        kwargs["dynamo"] = False  # TorchScript exporter: dynamic_axes behave the same across torch versions
+    logger.info("Exporting %s to ONNX: %s", model_name, out_dir)
+    with torch.no_grad():
+        torch.onnx.export(
+            _Hidden(),
+            tuple(dummy[name] for name in input_names),
+            str(out_dir / "model.onnx"),
+            input_names=input_names,
+            output_names=["last_hidden_state"],
+            dynamic_axes=axes,
+            opset_version=ONNX_OPSET,
+            do_constant_folding=True,
+            **kwargs,
+        )
+    tokenizer.save_pretrained(str(out_dir))
+    with open(out_dir / "encoder.json", "w", encoding="utf-8") as f:
+        json.dump(
+            {
+                "model": model_name,
+                "pooling": _pooling_mode(st_model),
+                "normalize": any(type(m).__name__ == "Normalize" for m in st_model),
+                "max_seq_length": st_model.max_seq_length,
+                "inputs": input_names,
+            },
+            f,
+            ensure_ascii=False,
+            indent=2,
+        )
+    if quantize:
+        quantize_model(out_dir)
+    return out_dir
+
+
+def quantize_model(model_dir) -> Path:
+    """Dynamic int8 weight quantization: model.onnx -> model.int8.onnx."""
+    from onnxruntime.quantization import QuantType, quantize_dynamic
+
+    model_dir = Path(model_dir)
+    target = model_dir / "model.int8.onnx"
+    logger.info("Quantizing to int8: %s", target)
+    quantize_dynamic(str(model_dir / "model.onnx"), str(target), weight_type=QuantType.QInt8)
+    return target
+
+
+class OnnxEncoder:
+    """
+    Exported model under ONNX Runtime. embed_query()/embed_documents() match langchain's
+    Embeddings and encode() matches SentenceTransformer.encode, so it drops in for either.
+    """
+
+    def __init__(self, model_dir, quantized: bool = False, threads: Optional[int] = None):
+        import onnxruntime as ort
+        from transformers import AutoTokenizer
+
+        model_dir = Path(model_dir)
+        with open(model_dir / "encoder.json", "r", encoding="utf-8") as f:
+            config = json.load(f)
+        self.model_name: str = config["model"]
+        self.pooling: str = config["pooling"]
+        self.normalize: bool = config["normalize"]
+        self.max_seq_length: int = config["max_seq_length"]
+        self.input_names: List[str] = config["inputs"]
+        self.backend = "onnx-int8" if quantized else "onnx"
+        self.threads = threads or default_threads()
+        self.parity_cosine: Optional[float] = None
+
+        options = ort.SessionOptions()
+        options.intra_op_num_threads = self.threads
+        options.inter_op_num_threads = 1
+        options.execution_mode = ort.ExecutionMode.ORT_SEQUENTIAL
+        options.graph_optimization_level = ort.GraphOptimizationLevel.ORT_ENABLE_ALL
+        path = model_dir / ("model.int8.onnx" if quantized else "model.onnx")
+        self.session = ort.InferenceSession(str(path), options, providers=["CPUExecutionProvider"])
+        self.tokenizer = AutoTokenizer.from_pretrained(str(model_dir))
+
+    def _pool(self, hidden: np.ndarray, mask: np.ndarray) -> np.ndarray:
+        if self.pooling == "cls":
+            return hidden[:, 0]
+        mask = mask[..., None].astype(hidden.dtype)
+        if self.pooling == "max":
+            return np.where(mask > 0, hidden, -1e9).max(axis=1)
+        return (hidden * mask).sum(axis=1) / np.clip(mask.sum(axis=1), 1e-9, None)
+
+    def encode(self, sentences, batch_size: int = 32, convert_to_numpy: bool = True, normalize_embeddings: bool = False, **_) -> np.ndarray:
+        single = isinstance(sentences, str)
+        texts = [sentences] if single else list(sentences)
+        out = []
+        for start in range(0, len(texts), batch_size):
+            enc = self.tokenizer(
+                texts[start : start + batch_size],
+                padding=True,
+                truncation=True,
+                max_length=self.max_seq_length,
+                return_tensors="np",
+            )
+            feeds = {name: enc[name].astype("int64") for name in self.input_names}
+            hidden = self.session.run(None, feeds)[0]
+            out.append(self._pool(hidden, enc["attention_mask"]))
+        vectors = np.concatenate(out).astype("float32") if out else np.zeros((0, 0), dtype="float32")
+        if self.normalize or normalize_embeddings:
+            vectors /= np.clip(np.linalg.norm(vectors, axis=1, keepdims=True), 1e-12, None)
+        return vectors[0] if single else vectors
+
+    def embed_query(self, text: str) -> List[float]:
+        return self.encode([text])[0].tolist()
+
+    def embed_documents(self, texts: List[str]) -> List[List[float]]:
+        return self.encode(texts).tolist()
+
+
+def check_parity(reference, encoder: OnnxEncoder, min_cosine: float, texts=PARITY_TEXTS) -> float:
+    """Minimum cosine between reference and encoder vectors; raises ParityError below min_cosine."""
+    expected = reference.encode(list(texts), convert_to_numpy=True, normalize_embeddings=True)
+    actual = encoder.encode(list(texts), normalize_embeddings=True)
+    cosine = float((np.asarray(expected, dtype="float32") * actual).sum(axis=1).min())
+    if cosine < min_cosine:
+        raise ParityError(f"{encoder.backend}: minimum cosine {cosine:.5f} < {min_cosine}")
+    encoder.parity_cosine = cosine
+    return cosine
+
+
+def load_onnx_encoder(model_name: str, backend: str, cache_dir, threads: Optional[int] = None) -> OnnxEncoder:
+    """
+    Export (first run only), load and parity-check an ONNX encoder. Errors (missing onnxruntime,
+    ParityError, export failures) propagate; falling back to PyTorch is up to the caller.
+    """
+    from sentence_transformers import SentenceTransformer
+
+    if backend not in BACKENDS or backend == "torch":
+        raise ValueError(f"Unknown ONNX encoder backend: {backend} (expected onnx or onnx-int8)")
+    quantized = backend == "onnx-int8"
+    reference = SentenceTransformer(model_name, device="cpu")
+    model_dir = _model_dir(cache_dir, model_name)
+    if not (model_dir / "encoder.json").exists():
+        export_model(reference, model_name, model_dir, quantize=quantized)
+    elif quantized and not (model_dir / "model.int8.onnx").exists():
+        quantize_model(model_dir)
+
+    encoder = OnnxEncoder(model_dir, quantized, threads)
+    cosine = check_parity(reference, encoder, PARITY_MIN_COSINE[backend])
+    logger.info("Query encoder %s (%s threads) passed the parity check, min cosine %.5f", backend, encoder.threads, cosine)
+    return encoder
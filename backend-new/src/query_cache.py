@@ -0,0 +1,158 @@
+"""
+In-memory LRU + TTL cache of query embedding vectors.
+
+Clinicians and evaluation runs resubmit the same anamneses all the time, and every /diagnose
+re-encoded the query. Entries are keyed by (embedding model name, normalized query text), bounded
+by max_entries (least recently used go first) and expire ttl_seconds after they were stored.
+
+Normalization is the one the ingest cache uses (NFC + collapsed whitespace). Case is kept: the
+model distinguishes it, and a cached vector must be exactly what the model would have returned.
+
+With a path the cache survives restarts: load() on construction, save() on shutdown (atomic
+write, expired entries dropped). Same file format as clindiag/query_cache.py.
+"""
+import logging
+import os
+import pickle
+import threading
+import time
+from collections import OrderedDict
+from pathlib import Path
+from typing import Callable, Optional, Tuple
+
+import numpy as np
+
+from embedding_cache import normalize_text
+
+DEFAULT_MAX_ENTRIES = 1024
+DEFAULT_TTL_SECONDS = 3600.0
+
+logger = logging.getLogger(__name__)
+
+
+class QueryEmbeddingCache:
+    """Thread-safe LRU + TTL cache of query vectors. max_entries=0 disables it, ttl_seconds=0 never expires."""
+
+    def __init__(
+        self,
+        model_name: str,
+        max_entries: int = DEFAULT_MAX_ENTRIES,
+        ttl_seconds: float = DEFAULT_TTL_SECONDS,
+        path: Optional[str] = None,
+    ):
+        self.model_name = model_name
+        self.max_entries = max_entries
+        self.ttl_seconds = ttl_seconds
+        self.path = Path(path) if path else None
+        self.hits = self.misses = self.evicted = self.expired = 0
+        # key -> (time.time() when stored, vector), least recently used first
+        self._entries: "OrderedDict[Tuple[str, str], Tuple[float, np.ndarray]]" = OrderedDict()
+        self._lock = threading.Lock()
+        if self.path is not None and self.enabled:
+            self.load()
+
+    @property
+    def enabled(self) -> bool:
+        return self.max_entries > 0
+
+    def _key(self, text: str) -> Tuple[str, str]:
+        return self.model_name, normalize_text(text)
+
+    def _is_expired(self, stored_at: float, now: float) -> bool:
+        return self.ttl_seconds > 0 and now - stored_at > self.ttl_seconds
+
+    def get(self, text: str) -> Optional[np.ndarray]:
+        """Cached (read-only) vector or None."""
+        if not self.enabled:
+            return None
+        key = self._key(text)
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is not None and self._is_expired(entry[0], time.time()):
+                del self._entries[key]
+                self.expired += 1
+                entry = None
+            if entry is None:
+                self.misses += 1
+                return None
+            self._entries.move_to_end(key)
+            self.hits += 1
+            return entry[1]
+
+    def put(self, text: str, vector) -> np.ndarray:
+        vec = np.array(vector, dtype=np.float32)
+        vec.setflags(write=False)
+        if not self.enabled:
+            return vec
+        key = self._key(text)
+        with self._lock:
+            self._entries[key] = (time.time(), vec)
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.max_entries:
+                self._entries.popitem(last=False)
+                self.evicted += 1
+        return vec
+
+    def get_or_compute(self, text: str, compute: Callable[[str], object]) -> np.ndarray:
+        vec = self.get(text)
+        if vec is None:
+            vec = self.put(text, compute(text))
+        return vec
+
+    def clear(self) -> None:
+        with self._lock:
+            self._entries.clear()
+
+    def stats(self) -> dict:
+        total = self.hits + self.misses
+        return {
+            "enabled": self.enabled,
+            "entries": len(self._entries),
+            "max_entries": self.max_entries,
+            "ttl_seconds": self.ttl_seconds,
+            "hits": self.hits,
+            "misses": self.misses,
+            "hit_rate": round(self.hits / total, 4) if total else 0.0,
+            "evicted": self.evicted,
+            "expired": self.expired,
+            "path": str(self.path) if self.path else None,
+        }
+
+    def load(self) -> int:
+        """Read this model's unexpired entries from path; returns how many were loaded."""
+        if self.path is None or not self.path.exists():
+            return 0
+        try:
+            with open(self.path, "rb") as f:
+                rows = pickle.load(f)
+        except Exception as e:
+            logger.warning("Query cache %s not loaded: %s", self.path, e)
+            return 0
+        now = time.time()
+        loaded = 0
+        with self._lock:
+            # Stored least recently used first, so the tail is what to keep
+            for model, text, stored_at, vec in rows[-self.max_entries:]:
+                if model != self.model_name or self._is_expired(stored_at, now):
+                    continue
+                self._entries[(model, text)] = (stored_at, np.frombuffer(vec, dtype=np.float32))
+                loaded += 1
+        return loaded
+
+    def save(self) -> int:
+        """Atomically write unexpired entries to path; returns how many were written."""
+        if self.path is None or not self.enabled:
+            return 0
+        now = time.time()
+        with self._lock:
+            rows = [
+                (model, text, stored_at, vec.tobytes())
+                for (model, text), (stored_at, vec) in self._entries.items()
+                if not self._is_expired(stored_at, now)
+            ]
+        self.path.parent.mkdir(parents=True, exist_ok=True)
+        tmp = self.path.with_name(self.path.name + ".tmp")
+        with open(tmp, "wb") as f:
+            pickle.dump(rows, f, protocol=pickle.HIGHEST_PROTOCOL)
+        os.replace(tmp, self.path)
+        return len(rows)
@@ -1,10 +1,12 @@
-"""Supabase Auth and PostgREST client (httpx)."""
+"""Supabase Auth and PostgREST client (httpx). Each call is a CLIENT tracing span with the HTTP status."""
 import os
 import logging
 from typing import Any, Optional
 
 import httpx
 
+from tracing import KIND_CLIENT, current_span, traced
+
 logger = logging.getLogger(__name__)
 
 SUPABASE_URL = os.getenv("SUPABASE_URL", "").rstrip("/")
@@ -36,8 +38,23 @@ def _is_rate_limit_error(msg: str) -> bool:
     return "rate limit" in msg.lower() or "too many" in msg.lower() or "429" in msg
 
 
+async def _trace_response(response: httpx.Response) -> None:
+    # Runs in the caller's task, so current_span() is the @traced function that made the request
+    span = current_span()
+    span.set("http.request.method", response.request.method)
+    span.set("url.path", response.request.url.path)
+    span.set("http.response.status_code", response.status_code)
+    if response.status_code >= 500:
+        span.set_error(f"HTTP {response.status_code}")
+
+
+def _client(timeout: float) -> httpx.AsyncClient:
+    return httpx.AsyncClient(timeout=timeout, event_hooks={"response": [_trace_response]})
+
+
+@traced("supabase.auth_signup", KIND_CLIENT)
 async def auth_signup(email: str, password: str, name: Optional[str] = None) -> dict[str, Any]:
-    async with httpx.AsyncClient(timeout=15.0) as client:
+    async with _client(15.0) as client:
         payload: dict[str, Any] = {"email": email, "password": password}
         if name:
             payload["options"] = {"data": {"full_name": name}}
@@ -54,8 +71,9 @@ async def auth_signup(email: str, password: str, name: Optional[str] = None) ->
         return data
 
 
+@traced("supabase.auth_signin", KIND_CLIENT)
 async def auth_signin(email: str, password: str) -> dict[str, Any]:
-    async with httpx.AsyncClient(timeout=15.0) as client:
+    async with _client(15.0) as client:
         r = await client.post(
             f"{SUPABASE_URL}/auth/v1/token?grant_type=password",
             headers=DEFAULT_HEADERS,
@@ -75,8 +93,9 @@ async def auth_signin(email: str, password: str) -> dict[str, Any]:
         return data
 
 
+@traced("supabase.auth_user", KIND_CLIENT)
 async def auth_user(access_token: str) -> Optional[dict[str, Any]]:
-    async with httpx.AsyncClient(timeout=10.0) as client:
+    async with _client(10.0) as client:
         r = await client.get(
             f"{SUPABASE_URL}/auth/v1/user",
             headers={**DEFAULT_HEADERS, "Authorization": f"Bearer {access_token}"},
@@ -99,10 +118,11 @@ def _rest_headers(token: Optional[str] = None) -> dict[str, str]:
     return h
 
 
+@traced("supabase.ensure_admin_user", KIND_CLIENT)
 async def ensure_admin_user(email: str = "admin@example.com", password: str = "asdf1234") -> None:
     if not (SUPABASE_URL and SUPABASE_SERVICE_ROLE_KEY):
         return
-    async with httpx.AsyncClient(timeout=15.0) as client:
+    async with _client(15.0) as client:
         r = await client.post(
             f"{SUPABASE_URL}/auth/v1/admin/users",
             headers=ADMIN_HEADERS,
@@ -144,8 +164,9 @@ async def ensure_admin_user(email: str = "admin@example.com", password: str = "a
         logger.warning("Admin user %s not found in list", email)
 
 
+@traced("supabase.history_list", KIND_CLIENT)
 async def history_list(user_id: str) -> list[dict[str, Any]]:
-    async with httpx.AsyncClient(timeout=15.0) as client:
+    async with _client(15.0) as client:
         r = await client.get(
             f"{SUPABASE_URL}/rest/v1/analysis_history",
             headers=_rest_headers(),
@@ -157,8 +178,9 @@ async def history_list(user_id: str) -> list[dict[str, Any]]:
         return r.json() if r.content else []
 
 
+@traced("supabase.history_insert", KIND_CLIENT)
 async def history_insert(user_id: str, item: dict[str, Any]) -> Optional[dict[str, Any]]:
-    async with httpx.AsyncClient(timeout=15.0) as client:
+    async with _client(15.0) as client:
         row = {
             "user_id": user_id,
             "primary_diagnosis": item.get("primaryDiagnosis", ""),
@@ -182,8 +204,9 @@ async def history_insert(user_id: str, item: dict[str, Any]) -> Optional[dict[st
         return out[0] if isinstance(out, list) and out else out
 
 
+@traced("supabase.history_delete", KIND_CLIENT)
 async def history_delete(user_id: str, item_id: str) -> bool:
-    async with httpx.AsyncClient(timeout=10.0) as client:
+    async with _client(10.0) as client:
         r = await client.delete(
             f"{SUPABASE_URL}/rest/v1/analysis_history",
             headers=_rest_headers(),
@@ -192,8 +215,9 @@ async def history_delete(user_id: str, item_id: str) -> bool:
         return r.status_code in (200, 204)
 
 
+@traced("supabase.history_clear", KIND_CLIENT)
 async def history_clear(user_id: str) -> bool:
-    async with httpx.AsyncClient(timeout=10.0) as client:
+    async with _client(10.0) as client:
         r = await client.delete(
             f"{SUPABASE_URL}/rest/v1/analysis_history",
             headers=_rest_headers(),
@@ -0,0 +1,91 @@
+"""
+Chunking driven by the embedding model's tokenizer (same algorithm as clindiag/token_chunker.py).
+
+Every chunk fits the encoder's max_seq_length together with its special tokens, overlap is counted
+in tokens, and cuts are moved back to a paragraph, sentence or word boundary where possible. Needs a
+fast HuggingFace tokenizer (return_offsets_mapping).
+"""
+from typing import List, Optional, Tuple
+
+DEFAULT_OVERLAP_TOKENS = 48
+_SENTENCE_END = (".", "!", "?", ";", ":")
+
+
+class TokenChunker:
+    def __init__(self, tokenizer, max_tokens: int, overlap: int = DEFAULT_OVERLAP_TOKENS):
+        """max_tokens is the model limit including special tokens."""
+        self.tokenizer = tokenizer
+        self.max_tokens = max_tokens
+        self.budget = max_tokens - tokenizer.num_special_tokens_to_add()
+        if self.budget <= 0:
+            raise ValueError(f"Chunk limit too small: {max_tokens} tokens")
+        self.overlap = max(0, min(overlap, self.budget // 2))
+
+    @classmethod
+    def from_model(
+        cls,
+        model_name: str,
+        max_tokens: Optional[int] = None,
+        overlap: int = DEFAULT_OVERLAP_TOKENS,
+    ) -> "TokenChunker":
+        """Tokenizer and max_seq_length come from the sentence-transformers model; max_tokens is capped by it."""
+        from sentence_transformers import SentenceTransformer
+
+        model = SentenceTransformer(model_name, device="cpu")
+        limit = model.max_seq_length
+        return cls(model.tokenizer, min(max_tokens, limit) if max_tokens else limit, overlap)
+
+    def _offsets(self, text: str) -> List[Tuple[int, int]]:
+        enc = self.tokenizer(
+            text, add_special_tokens=False, return_offsets_mapping=True, verbose=False
+        )
+        return [tuple(o) for o in enc["offset_mapping"]]
+
+    def count(self, text: str) -> int:
+        return len(self._offsets(text))
+
+    def _cut(self, text: str, offsets: list, start: int, end: int) -> int:
+        """Exclusive chunk end in [start + budget/2, end]: paragraph > sentence > word boundary."""
+        word = None
+        for i in range(end, start + self.budget // 2, -1):
+            gap = text[offsets[i - 1][1]:offsets[i][0]]
+            if "\n" in gap:
+                return i
+            if gap and text[offsets[i - 1][1] - 1] in _SENTENCE_END:
+                return i
+            if gap and word is None:
+                word = i
+        return word or end
+
+    def _word_start(self, text: str, offsets: list, i: int, limit: int) -> int:
+        """First token in [i, limit) that starts a word, else i."""
+        for j in range(i, limit):
+            if j == 0 or offsets[j][0] > offsets[j - 1][1]:
+                return j
+        return i
+
+    def split_text(self, text: str) -> List[str]:
+        offsets = self._offsets(text)
+        n = len(offsets)
+        if n <= self.budget:
+            return [text.strip()] if text.strip() else []
+
+        chunks = []
+        start = 0
+        while start < n:
+            end = min(start + self.budget, n)
+            if end < n:
+                end = self._cut(text, offsets, start, end)
+            chunk = text[offsets[start][0]:offsets[end - 1][1]].strip()
+            # Re-tokenizing the substring can add a token or two at word joins
+            extra = self.count(chunk) - self.budget
+            while extra > 0 and end - start > 1:
+                end = max(start + 1, end - extra)
+                chunk = text[offsets[start][0]:offsets[end - 1][1]].strip()
+                extra = self.count(chunk) - self.budget
+            if chunk:
+                chunks.append(chunk)
+            if end >= n:
+                break
+            start = self._word_start(text, offsets, max(end - self.overlap, start + 1), end)
+        return chunks